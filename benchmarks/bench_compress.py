@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Compresses the tiles of the example images, and 512 KB of them repeated
+(the size of a whole ROM), in both modes; shows the ratio and the speed of
+compressing and decompressing them.
+
+Usage: python benchmarks/bench_compress.py"""
+
+from __future__ import print_function
+import glob, os
+import support
+import twcompress, twimage
+
+ROM_SIZE = 512 * 1024
+
+def main():
+    paths = sorted(glob.glob(os.path.join(support.EXAMPLES, '*', 'tw', '*.png')) +
+                   glob.glob(os.path.join(support.EXAMPLES, '*', 'tw', 'img', '*.png')))
+    tiles = ''
+    for path in paths:
+        converted = twimage.convert_file(path)
+        if not converted.error:
+            tiles += converted.tiles
+    print('{0} images, {1} tiles'.format(len(paths), len(tiles) // twcompress.TILE_BYTES))
+
+    rom = (tiles * (ROM_SIZE // len(tiles) + 1))[:ROM_SIZE]
+    for name, data in (('examples', tiles), ('512 KB', rom)):
+        for mode in twcompress.MODES:
+            compressed = twcompress.compress(data, mode)
+            assert twcompress.decompress(compressed) == data
+            compress_time = support.best_time(lambda: twcompress.compress(data, mode))
+            decompress_time = support.best_time(lambda: twcompress.decompress(compressed))
+            kilobytes = len(data) / 1024.0
+            print('{0:8} {1:4} {2:7} -> {3:7} bytes ({4:.1f}%), compress {5:.0f} KB/s, decompress {6:.0f} KB/s'.format(
+                name, mode, len(data), len(compressed), 100.0 * len(compressed) / len(data),
+                kilobytes / compress_time, kilobytes / decompress_time))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Times the parsing of the expressions of the ccadv example with the
+Twine expression lexer, against the path it replaced (str.replace, then
+Python's tokenize module), with the expression cache disabled. Also
+checks that both give the same symbols.
+
+Usage: python benchmarks/bench_expressions.py"""
+
+from __future__ import print_function
+import os, re, tokenize
+from cStringIO import StringIO
+import support
+import twexpression
+
+def old_tokens(program):
+    """The symbol stream of the previous path"""
+    program = program.replace('&&', ' and ').replace('||', ' or ').replace('!', ' not ').replace('$', '').strip()
+    type_map = {
+        tokenize.NUMBER: "(literal)",
+        tokenize.STRING: "(literal)",
+        tokenize.OP: "(operator)",
+        tokenize.NAME: "(name)",
+        }
+    tokens = []
+    for t in tokenize.generate_tokens(StringIO(program).next):
+        if t[0] in type_map:
+            tokens.append((type_map[t[0]], t[1]))
+        elif t[0] == tokenize.ENDMARKER:
+            break
+        elif t[0] != tokenize.NL:
+            raise SyntaxError("Syntax error")
+    tokens.append(("(end)", "(end)"))
+    return tokens
+
+def story_expressions(path):
+    with open(path) as f:
+        source = f.read()
+    return (re.findall(r'<<(?:if|print)\s+(.*?)>>', source) +
+            [assignment.split('=', 1)[-1].replace(' to ', ' ', 1) for assignment in re.findall(r'<<set\s+(.*?)>>', source)])
+
+def main():
+    expressions = story_expressions(os.path.join(support.EXAMPLES, 'ccadv', 'tw', 'ccadv.txt'))
+    def symbols(tokens):
+        return [(s.id, s.value) for s in twexpression.tokenize(tokens)]
+    for expression in expressions:
+        assert symbols(list(twexpression.tokenize_twine(expression))) == symbols(old_tokens(expression)), expression
+
+    twexpression.cache.enabled = False
+    passes = 200
+    def parse(lexer):
+        for i in range(passes):
+            for expression in expressions:
+                twexpression.Parser(list(lexer(expression))).expression()
+
+    old = support.best_time(lambda: parse(old_tokens)) / passes
+    new = support.best_time(lambda: parse(twexpression.tokenize_twine)) / passes
+    print('{0} expressions, same symbols with both lexers'.format(len(expressions)))
+    print('str.replace + tokenize: {0:.3f} ms per pass'.format(old * 1000))
+    print('Twine lexer:            {0:.3f} ms per pass ({1:.1f}x faster)'.format(new * 1000, old / new))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Times Passage._parse_commands on generated passages of 12.5k to 100k
+tokens (text, links, list items and nested <<if>> blocks), against the
+parser it replaced, which took the tokens from a list with pop(0). The
+time of the current parser should double with the number of tokens.
+
+Usage: python benchmarks/bench_parser.py"""
+
+from __future__ import print_function
+import support
+from twparser import Passage, TextCmd, ImageCmd, LinkCmd, ListCmd, EndMacro
+
+class PopPassage(Passage):
+    """Parses the tokens as before, with pop(0)"""
+
+    def _parse_commands(self, tokens):
+        commands = []
+        close_block = False
+
+        while tokens and not close_block:
+            token = tokens.pop(0)
+            tk_type = token[0]
+            if tk_type == 'tx':
+                commands.append(TextCmd(token))
+            elif tk_type == 'mc':
+                macro = self._parse_macro(token, tokens)
+                if macro:
+                    if isinstance(macro, EndMacro):
+                        close_block = True
+                    else:
+                        commands.append(macro)
+            elif tk_type == 'im':
+                commands.append(ImageCmd(token))
+            elif tk_type == 'lk':
+                commands.append(LinkCmd(token))
+            elif tk_type in ('ul','ol'):
+                commands.append(ListCmd(token, self._parse_commands(list(token[1]))))
+
+        return commands
+
+def make_tokens(count):
+    pattern = [('tx', 'Some text '), ('mc', ('if', ' $x gt 1')), ('lk', 'North'), ('mc', ('if', ' $y')),
+               ('ul', [('lk', 'a|b')]), ('mc', ('endif', '')), ('mc', ('endif', ''))]
+    return (pattern * (count // len(pattern) + 1))[:count]
+
+def parse_time(cls, tokens):
+    def parse():
+        passage = cls.__new__(cls)
+        passage.title = 'Benchmark'
+        passage.warnings = []
+        passage._block_stack = []
+        passage._parse_commands(list(tokens) if cls is PopPassage else iter(tokens))
+    return support.best_time(parse)
+
+def main():
+    print('{0:>8} {1:>10} {2:>10}'.format('tokens', 'pop(0)', 'iterator'))
+    previous = None
+    for count in (12500, 25000, 50000, 100000):
+        tokens = make_tokens(count)
+        old, new = parse_time(PopPassage, tokens), parse_time(Passage, tokens)
+        growth = ' (x{0:.2f})'.format(new / previous) if previous else ''
+        print('{0:>8} {1:>9.3f}s {2:>9.3f}s{3}'.format(count, old, new, growth))
+        previous = new
+
+
+if __name__ == '__main__':
+    main()
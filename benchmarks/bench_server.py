@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Compares the latency of a build run as a new twee2sam.py process (cold)
+with the same build sent to a running "twee2sam.py --serve" through
+twee2samc.py (warm), on the simple example and on a generated story.
+
+Both rebuild a destination that was already built, so the difference is
+the start-up, the imports and the caches the server keeps in memory.
+Needs Unix domain sockets.
+
+Usage: python benchmarks/bench_server.py [passages of the generated story]"""
+
+from __future__ import print_function
+import sys, os, shutil, subprocess, tempfile, time
+import support
+
+TWEE2SAM = os.path.join(support.ROOT, 'twee2sam.py')
+TWEE2SAMC = os.path.join(support.ROOT, 'twee2samc.py')
+
+def generated_story(passages):
+    parts = [':: Start\nThe start. [[P1]]\n']
+    for i in range(1, passages + 1):
+        parts.append(':: P{0}\n<<set $visits = $visits + 1>>Passage {0}, visited <<print $visits>> times.\n'
+                     '<<if $visits gt 3>>[[Back|Start]]<<endif>>\n[[P{1}]]\n'.format(i, i % passages + 1))
+    return ''.join(parts)
+
+def run(command, env=None):
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call(command, stdout=devnull, env=env)
+
+def latency(command, env=None):
+    return support.best_time(lambda: run(command, env), repeat=5)
+
+def main(argv):
+    passages = int(argv[1]) if len(argv) > 1 else 2000
+    work = tempfile.mkdtemp(prefix='twee2sam-bench-')
+    socket_path = os.path.join(work, 'server.sock')
+    env = dict(os.environ, TWEE2SAM_SOCKET=socket_path)
+    devnull = open(os.devnull, 'w')
+    server = subprocess.Popen([sys.executable, TWEE2SAM, '--serve', '--socket', socket_path], stdout=devnull)
+    try:
+        while not os.path.exists(socket_path):
+            if server.poll() is not None:
+                raise SystemExit('the compile server did not start')
+            time.sleep(0.05)
+
+        generated = os.path.join(work, 'generated.txt')
+        with open(generated, 'w') as f:
+            f.write(generated_story(passages))
+        stories = [('simple example', os.path.join(support.EXAMPLES, 'simple', 'tw', 'Simple.txt')),
+                   ('{0} passages'.format(passages), generated)]
+
+        print('{0:<16} {1:>9} {2:>9}'.format('', 'cold', 'warm'))
+        for name, source in stories:
+            destination = os.path.join(work, 'out-' + os.path.basename(source))
+            os.mkdir(destination)
+            arguments = [source, destination]
+            # Builds it once each way first
+            run([sys.executable, TWEE2SAM] + arguments)
+            run([sys.executable, TWEE2SAMC] + arguments, env)
+            cold = latency([sys.executable, TWEE2SAM] + arguments)
+            warm = latency([sys.executable, TWEE2SAMC] + arguments, env)
+            print('{0:<16} {1:>7.0f}ms {2:>7.0f}ms'.format(name, cold * 1000, warm * 1000))
+    finally:
+        server.terminate()
+        server.wait()
+        devnull.close()
+        shutil.rmtree(work)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
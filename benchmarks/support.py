@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+
+"""Shared by the benchmarks: makes the lib modules and the tw submodule
+importable, and times things"""
+
+import os, sys, time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(ROOT, 'lib'), os.path.join(ROOT, 'tw')]
+
+EXAMPLES = os.path.join(ROOT, 'example')
+
+def best_time(function, repeat=3):
+    """Shortest time, in seconds, of a few calls of function"""
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        function()
+        times.append(time.time() - start)
+    return min(times)
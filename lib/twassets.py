@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+"""Stages the images and music of a story into the destination directory.
+
+Files are identified by the SHA-1 of their contents. The hash is kept along
+with the size and modification time it was computed for, so a file that
+didn't change is neither read nor copied again; a new copy is a reflink or
+a hard link when the filesystem allows it."""
+
+import os, shutil, hashlib, errno
+import cPickle as pickle
+
+try:
+    import fcntl
+except ImportError:
+    # Not on Windows
+    fcntl = None
+
+# ioctl that makes a file share the blocks of another (Linux)
+FICLONE = 0x40049409
+
+class AssetStager(object):
+    """Copies the assets, keeping their hashes from one build to the next;
+    with a path, they are also kept on disk between runs"""
+
+    FILE_NAME = '.twee2sam.assets'
+
+    def __init__(self, path=None, links=True):
+        self.path = path
+        # False to always make real copies
+        self.links = links
+        # File path -> (size, mtime, hash)
+        self.hashes = {}
+        # Destination path -> (hash, size, mtime) it had when it was staged
+        self.staged = {}
+        # How the files of the current build were staged: 'kept',
+        # 'reflinked', 'linked' or 'copied' -> count
+        self.counts = {}
+        if path:
+            self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                self.hashes, self.staged = pickle.load(f)
+        except Exception:
+            # Missing or unreadable; the files will be hashed again
+            pass
+
+    def content_hash(self, path):
+        """SHA-1 of the file's contents"""
+        stat = file_stat(path)
+        known = self.hashes.get(path)
+        if known and known[:2] == stat:
+            return known[2]
+
+        digest = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), ''):
+                digest.update(chunk)
+        self.hashes[path] = stat + (digest.hexdigest(),)
+        return digest.hexdigest()
+
+    def stage(self, src, dst):
+        """Makes dst a copy of src, unless it already is one; returns how"""
+        digest = self.content_hash(src)
+        try:
+            dst_stat = file_stat(dst)
+        except OSError:
+            dst_stat = None
+
+        if dst_stat and (self.staged.get(dst) == (digest,) + dst_stat or self.content_hash(dst) == digest):
+            how = 'kept'
+        else:
+            if dst_stat:
+                os.remove(dst)
+            how = self._link(src, dst)
+            if not how:
+                shutil.copyfile(src, dst)
+                how = 'copied'
+            dst_stat = file_stat(dst)
+
+        self.staged[dst] = (digest,) + dst_stat
+        self.counts[how] = self.counts.get(how, 0) + 1
+        return how
+
+    def _link(self, src, dst):
+        if not self.links:
+            return None
+
+        if fcntl:
+            try:
+                with open(src, 'rb') as source:
+                    with open(dst, 'wb') as target:
+                        fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+                return 'reflinked'
+            except (IOError, OSError):
+                # Not supported by the filesystem
+                if os.path.exists(dst):
+                    os.remove(dst)
+
+        if hasattr(os, 'link'):
+            try:
+                os.link(src, dst)
+                return 'linked'
+            except OSError as e:
+                if e.errno == errno.EEXIST:
+                    raise
+        return None
+
+    def commit(self):
+        """Ends a build, saving the hashes for the next one"""
+        if self.path:
+            with open(self.path, 'wb') as f:
+                pickle.dump((self.hashes, self.staged), f, pickle.HIGHEST_PROTOCOL)
+        self.counts = {}
+
+
+def file_stat(path):
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime
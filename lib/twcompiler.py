@@ -0,0 +1,1317 @@
+# -*- coding: utf-8 -*-
+
+"""Compiles twee stories into SAM scripts, entirely in memory.
+
+The tiddlywiki module (from the tw submodule) and the other lib modules
+must be importable."""
+
+import re, os.path, multiprocessing, hashlib, copy
+import cPickle as pickle
+from collections import OrderedDict
+from operator import itemgetter
+from tiddlywiki import TiddlyWiki
+from twparser import TwParser
+import twparser
+import twexpression
+import twsam
+import twlayout
+import twstrings
+
+__version__ = "0.10"
+
+class CompileError(Exception):
+    """Error that prevents the story from being compiled"""
+
+    def __init__(self, msg, diagnostics=None):
+        Exception.__init__(self, msg)
+        # Diagnostics reported before the error
+        self.diagnostics = diagnostics or []
+
+
+class CompileOptions(object):
+    """Options for compile_story()"""
+
+    DEFAULTS = {
+        'jobs': 1,                  # number of passages to generate in parallel
+        'merge_html': None,         # TiddlyWiki HTML to merge into the story
+        'prune_unreachable': False, # drop the passages that can't be reached
+        'entry_points': (),         # passages reachable besides 'Start'
+        'display_mode': 'auto',     # 'auto' shares the displayed passages as
+                                    # subroutines when it saves space; 'inline'
+                                    # always copies them into each script
+        'passes': twsam.DEFAULT_PASSES, # optimization passes to run, in order
+        'fold_constants': True,     # simplify the expressions before generating them
+        'max_variables': 26,        # SAM variables the story may use, A to Z
+        'pack_flags': True,         # pack the boolean variables into shared ones
+        'menu_dispatch': 'indexed', # 'indexed' jumps straight to the chosen link's
+                                    # target; 'linear' compares the choice with
+                                    # each link in turn
+        'wrap_text': False,         # wrap the text and break it into pages at
+                                    # compile time, instead of leaving it to SAM
+                                    # and cutting it at the end of the buffer
+        'text_columns': 28,         # width of the SAM text window, in characters
+        'text_rows': 18,            # lines of text the window shows on each page
+        'string_pool': False,       # share the text repeated across the scripts;
+                                    # adds a level of calls to the passages
+        'asset_id': None            # function giving an id of an image or music
+                                    # file's contents, to merge the identical ones
+    }
+
+    def __init__(self, **kwargs):
+        for name, default in CompileOptions.DEFAULTS.items():
+            setattr(self, name, kwargs.pop(name, default))
+        if kwargs:
+            raise TypeError('Unknown compile options: {0}'.format(', '.join(sorted(kwargs))))
+
+
+class CompileSession(object):
+    """Keeps the parsed passages and generated scripts from one compilation
+    to the next, so recompiling an edited story only redoes what changed"""
+
+    def __init__(self, cache=None):
+        self.twp = None
+        self.cache = cache
+
+
+class CompileResult(object):
+    """Everything produced by compile_story()"""
+
+    def __init__(self):
+        # Script file name -> SAM source, in passage index order
+        self.scripts = OrderedDict()
+        self.script_list = ''
+        # Image and music paths, as referenced by the story
+        self.images = []
+        self.music = []
+        self.image_list = ''
+        self.music_list = ''
+        # (referenced path, destination file name) of each asset to copy
+        self.assets = []
+        # (level, message) pairs, level being 'warning' or 'error'
+        self.diagnostics = []
+        # Titles of the unreachable passages that were left out, and the
+        # size of the scripts they would have produced
+        self.pruned = []
+        self.pruned_size = 0
+        # Titles of the passages nothing links to, calls or displays
+        self.unreferenced = []
+        self.regenerated = 0
+        self.reused = 0
+        # SAM variables used, and how many of them hold temporaries
+        self.variables = 0
+        self.temp_variables = 0
+        # Boolean variables packed, and the variables they were packed into
+        self.flags = 0
+        self.flag_variables = 0
+        # Menus, and the estimated bytes and steps per choice of their
+        # dispatch code, as generated and as the other menu_dispatch would
+        self.menus = 0
+        self.menu_cost = [0, 0.0]
+        self.other_menu_cost = [0, 0.0]
+        # Page breaks the text layout added
+        self.page_breaks = 0
+        # Phrases shared by the string pool, and the bytes it saved
+        self.pooled_strings = 0
+        self.pool_saving = 0
+        # (path, path of the identical asset used instead) of the merged assets
+        self.merged_assets = []
+
+    def files(self):
+        """Returns the (file name, contents) of every text file to output"""
+        return ([('Script.list.txt', self.script_list)] + self.scripts.items() +
+                [('Images.txt', self.image_list), ('Music.list.txt', self.music_list)])
+
+
+def compile_story(sources, options=None, session=None):
+    """Compiles a story, given as a list of twee source strings, into a CompileResult"""
+    options = options or CompileOptions()
+    session = session or CompileSession()
+    result = CompileResult()
+
+    # construct a TW object
+
+    tw = TiddlyWiki()
+
+    if options.merge_html:
+        tw.addHtml(options.merge_html)
+
+    if not sources:
+        raise CompileError('no source files specified')
+
+    for source in sources:
+        tw.addTwee(source)
+
+    #
+    # Parse the file
+    #
+
+    # The passages are only parsed when their scripts need to be generated;
+    # the ones that didn't change since the previous compilation are kept as is.
+    twp = TwParser(tw, lazy=True, previous=session.twp)
+
+
+    # 'Start' _must_ be the first script
+    if not 'Start' in twp.passages:
+        raise CompileError('"Start" passage not found.')
+
+    cache = session.cache
+    graph = PassageGraph(twp, cache)
+
+    passages = twp.passages.values()
+    if options.prune_unreachable:
+        reachable = graph.reachable(['Start'] + list(options.entry_points))
+        passages = [passage for passage in passages if passage.title in reachable]
+        result.pruned = [title for title in twp.passages if not title in reachable]
+
+
+    #
+    # Number the passages
+    #
+
+    graph.number(['Start'] + [passage.title for passage in passages])
+    passage_indexes = graph.indexes
+    result.unreferenced = graph.unreferenced(sorted(passage_indexes, key=passage_indexes.get),
+                                             ['Start'] + list(options.entry_points))
+
+
+    #
+    # Check the targets of every link, call and display
+    #
+
+    # A missing link target stops the build; a missing call or display
+    # target is left out, as it always was
+    dangling_links = 0
+    for title, kind, target in graph.dangling([passage.title for passage in passages]):
+        if kind == 'link':
+            result.diagnostics.append(('error', 'Error on {0}: link target passage not found: "{1}"'.format(title, target)))
+            dangling_links += 1
+        else:
+            result.diagnostics.append(('warning', 'Warning on {0}: {1} target passage not found: "{2}"; it is left out'.format(
+                title, kind, target)))
+
+    if dangling_links:
+        raise CompileError('{0} link(s) point to nonexisting passages'.format(dangling_links), result.diagnostics)
+
+    cycle = graph.display_cycle([passage.title for passage in passages])
+    if cycle:
+        raise CompileError('Display cycle: {0}'.format(' -> '.join(cycle)), result.diagnostics)
+
+
+    #
+    # Pack the variables that only ever hold booleans
+    #
+
+    flags = {}
+    if options.pack_flags:
+        facts = []
+        for passage in passages:
+            previous = cache.previous(passage) if cache else None
+            facts.append(previous.var_facts if previous else variable_facts(passage.commands))
+        flags = flag_layout(facts)
+        result.flags = len(flags)
+        result.flag_variables = len(set(word for word, bit in flags.values()))
+
+
+    #
+    # Choose the displayed passages to share as subroutines
+    #
+
+    subroutines = {}
+    if options.display_mode == 'auto':
+        for title in display_subroutines(twp, graph, [passage.title for passage in passages]):
+            subroutines[title] = len(passage_indexes) + len(subroutines)
+    elif options.display_mode != 'inline':
+        raise CompileError('Unknown display mode: {0}'.format(options.display_mode))
+    subroutine_order = sorted(subroutines, key=subroutines.get)
+
+    #
+    # Generate the file list
+    #
+    passage_order = [psg for psg, idx in sorted(passage_indexes.items(), key=itemgetter(1))]
+
+    result.script_list = ''.join(script_name(twp.passages[passage_name].title) + '\n' for passage_name in passage_order)
+    result.script_list += ''.join(subroutine_name(title) + '\n' for title in subroutine_order)
+
+
+    #
+    # Generate SAM scripts
+    #
+
+    # A holds the chosen menu option
+    # B counts the options the linear menu dispatch compares A with
+    # The following ones are available
+    if options.max_variables > VariableFactory.MAX_VARIABLES:
+        raise CompileError('SAM has only {0} variables'.format(VariableFactory.MAX_VARIABLES))
+    menu_variables = 2 if options.menu_dispatch == 'linear' else 1
+    variables = VariableFactory(menu_variables)
+
+    image_list = []
+    music_list = []
+
+    # Asset id -> path of the first asset with it
+    asset_paths = {}
+    def asset_id(path):
+        return options.asset_id(path) if options.asset_id else path
+
+    def canonical(path):
+        first = asset_paths.setdefault(asset_id(path), path)
+        if first != path and not (path, first) in result.merged_assets:
+            result.merged_assets.append((path, first))
+        return first
+
+    # The subroutines are merged after all the passages
+    jobs = [(passage.title, False) for passage in passages] + [(title, True) for title in subroutine_order]
+
+    if not options.menu_dispatch in ('indexed', 'linear'):
+        raise CompileError('Unknown menu dispatch: {0}'.format(options.menu_dispatch))
+    layout = None
+    if options.wrap_text:
+        if options.text_columns < 1 or options.text_rows < 1:
+            raise CompileError('The text window must be at least 1x1 characters')
+        layout = (options.text_columns, options.text_rows)
+    codegen = Codegen(twp, passage_indexes, subroutines, options.passes, options.fold_constants, flags, options.menu_dispatch,
+                      layout)
+
+    reused = {}
+    pending = []
+    for title, as_subroutine in jobs:
+        generated = cache.lookup(twp.passages[title], codegen, as_subroutine) if cache else None
+        if generated:
+            reused[title, as_subroutine] = generated
+        else:
+            pending.append((title, as_subroutine))
+
+    pool = None
+    if options.jobs > 1 and pending:
+        pool = multiprocessing.Pool(options.jobs, init_worker, (codegen, twexpression.cache.enabled))
+        generated_scripts = from_workers(pool.imap(generate_in_worker, pending))
+    else:
+        generated_scripts = (generate_script(codegen, twp.passages[title], as_subroutine)
+                             for title, as_subroutine in pending)
+
+    generated_text = {}
+    try:
+        scripts = [reused.get(job) or next(generated_scripts) for job in jobs]
+
+        indexes = [subroutines[title] if as_subroutine else passage_indexes[title] for title, as_subroutine in jobs]
+        temp_base = temp_bases(dict(zip(indexes, scripts)), result.diagnostics)
+
+        # Merges the scripts in passage order, so the images, music and
+        # variables are numbered exactly as in a serial run
+        for index, generated in zip(indexes, scripts):
+            result.diagnostics.extend(generated.messages)
+            result.page_breaks += generated.page_breaks
+            if generated.menu_cost:
+                result.menus += 1
+                for total, cost in ((result.menu_cost, generated.menu_cost[0]), (result.other_menu_cost, generated.menu_cost[1])):
+                    total[0] += cost[0]
+                    total[1] += cost[1]
+            if cache:
+                cache.store(generated)
+            generated_text[generated.key] = generated.resolve(variables, image_list, music_list, temp_base[index], canonical)
+    except CompileError as e:
+        e.diagnostics = result.diagnostics
+        raise
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+
+    result.variables = variables.next_available
+    result.temp_variables = variables.temp_count
+    if result.variables > options.max_variables:
+        raise CompileError('The story needs {0} variables, but only {1} are available ({2} named, {3} temporary, {4} for the menus)'.format(
+                               result.variables, options.max_variables, result.variables - result.temp_variables - menu_variables,
+                               result.temp_variables, menu_variables),
+                           result.diagnostics)
+
+    #
+    # Share the repeated text
+    #
+
+    phrases = []
+    if options.string_pool:
+        keys = [(passage_name, False) for passage_name in passage_order] + [(title, True) for title in subroutine_order]
+        texts = [generated_text[key] for key in keys]
+        pooled, phrases = twstrings.pool_strings(texts, len(passage_indexes) + len(subroutines),
+                                                 cache.previous_phrases() if cache else ())
+        generated_text.update(zip(keys, pooled))
+        result.script_list += ''.join(pool_name(i) + '\n' for i in range(len(phrases)))
+        result.pooled_strings = len(phrases)
+        result.pool_saving = (sum(len(text) for text in texts) - sum(len(text) for text in pooled) -
+                              sum(len(twstrings.pool_script(phrase)) + twstrings.SCRIPT_OVERHEAD for phrase in phrases))
+
+    if cache:
+        cache.store_phrases(phrases)
+        cache.commit()
+    session.twp = twp
+
+    for passage_name in passage_order:
+        result.scripts[script_name(passage_name)] = generated_text[passage_name, False]
+    for title in subroutine_order:
+        result.scripts[subroutine_name(title)] = generated_text[title, True]
+    for i, phrase in enumerate(phrases):
+        result.scripts[pool_name(i)] = twstrings.pool_script(phrase)
+
+    result.regenerated = len(pending)
+    result.reused = len(reused)
+
+    if result.pruned:
+        result.pruned_size = pruned_size(codegen, result.pruned, variables, image_list, music_list,
+                                         lambda path: asset_paths.get(asset_id(path), path))
+
+
+    #
+    # Builds the image and music lists
+    #
+    def build_list(file_list, item_extension, item_suffix = '', empty_item = 'blank'):
+        items = []
+        # Item name -> file path
+        names = {}
+        for file_path in file_list:
+            base_name = name_to_identifier(os.path.splitext(os.path.basename(file_path))[0])
+            item_name = base_name
+            copy_number = 1
+            while item_name in names:
+                copy_number += 1
+                item_name = '{0}_{1}'.format(base_name, copy_number)
+            if item_name != base_name:
+                result.diagnostics.append(('warning', 'Warning: "{0}" and "{1}" are both named {2}; the second one is renamed to {3}'.format(
+                    names[base_name], file_path, base_name, item_name)))
+            names[item_name] = file_path
+            items.append(item_name + item_suffix + '\n')
+            result.assets.append((file_path, '%s.%s' % (item_name, item_extension)))
+
+        if not file_list:
+            items.append(empty_item + item_suffix + '\n')
+
+        return ''.join(items)
+
+    result.images = image_list
+    result.music = music_list
+    result.image_list = build_list(image_list, 'png')
+    result.music_list = build_list(music_list, 'epsgmod', '.epsgmod', 'empty')
+
+    return result
+
+
+#
+# Passage graph
+#
+
+def passage_edges(commands):
+    """Yields the (kind, target title) of every link, call and display in the commands"""
+    for cmd in commands:
+        if cmd.kind in ('link', 'call', 'display') and getattr(cmd, 'target', None):
+            yield cmd.kind, cmd.target
+        if cmd.children:
+            for edge in passage_edges(cmd.children):
+                yield edge
+
+# Passages Twine reads by their title, which nothing needs to link to
+SPECIAL_PASSAGES = frozenset(['StoryTitle', 'StorySubtitle', 'StoryAuthor', 'StoryMenu', 'StoryIncludes'])
+
+class PassageGraph(object):
+    """Indexes, outgoing and incoming edges of the passages, built once after parsing"""
+
+    def __init__(self, twp, cache=None):
+        self.titles = twp.passages.keys()
+        self.indexes = {}
+        # title -> [(kind, target title)]
+        self.outgoing = {}
+        # title -> [(kind, source title)]
+        self.incoming = {}
+
+        for passage in twp.passages.values():
+            # The edges of an unchanged passage are known without parsing it
+            previous = cache.previous(passage) if cache else None
+            if previous:
+                self.outgoing[passage.title] = previous.edges
+            else:
+                self.outgoing[passage.title] = list(passage_edges(passage.commands))
+
+        for title in self.titles:
+            for kind, target in self.outgoing[title]:
+                self.incoming.setdefault(target, []).append((kind, title))
+
+    def number(self, titles):
+        """Gives the next free index to each of the titles, in order"""
+        for title in titles:
+            if not title in self.indexes:
+                self.indexes[title] = len(self.indexes)
+
+    def reachable(self, roots):
+        """Returns the titles of the passages that can be reached from the roots"""
+        reachable = set()
+        pending = [title for title in roots if title in self.outgoing]
+        while pending:
+            title = pending.pop()
+            if title in reachable:
+                continue
+            reachable.add(title)
+            for kind, target in self.outgoing[title]:
+                if target in self.outgoing and not target in reachable:
+                    pending.append(target)
+        return reachable
+
+    def unreferenced(self, titles, roots):
+        """Returns the given passages, besides the roots and the special
+        ones, that no other passage links to, calls or displays"""
+        return [title for title in titles
+                if not title in roots and not title in SPECIAL_PASSAGES and
+                not [source for kind, source in self.incoming.get(title, ()) if source != title]]
+
+    def dangling(self, titles):
+        """Yields the (title, kind, target) of every edge from the given
+        passages whose target doesn't exist"""
+        for title in titles:
+            for kind, target in self.outgoing[title]:
+                if not target in self.outgoing:
+                    yield title, kind, target
+
+    def display_cycle(self, titles):
+        """Returns the path of a cycle of displays starting from one of the
+        given passages, or None if there is none"""
+        done = set()
+        for root in titles:
+            if root in done:
+                continue
+            path = [root]
+            pending = [iter(self.outgoing[root])]
+            while pending:
+                for kind, target in pending[-1]:
+                    if kind != 'display' or not target in self.outgoing or target in done:
+                        continue
+                    if target in path:
+                        return path[path.index(target):] + [target]
+                    path.append(target)
+                    pending.append(iter(self.outgoing[target]))
+                    break
+                else:
+                    done.add(path.pop())
+                    pending.pop()
+        return None
+
+
+# Booleans packed into each variable; 8 keeps the values within 0..255
+FLAG_BITS = 8
+
+def normalize_variable(name):
+    return name.replace('$', '').strip()
+
+def variable_facts(commands):
+    """Returns the variables the commands set, as (name, kind) pairs, kind
+    being 'bool', 'num' or the name of the variable whose value is copied,
+    and the names of the variables they read"""
+    sets = []
+    reads = set()
+
+    def visit(commands):
+        for cmd in commands:
+            expr = getattr(cmd, 'expr', None) if cmd.kind in ('set', 'if', 'print') else None
+            if expr is not None:
+                reads.update(normalize_variable(name) for name in twexpression.variable_names(expr))
+            if cmd.kind == 'set' and expr is not None:
+                value = twexpression.simplify(expr)
+                if twexpression.is_boolean(value):
+                    kind = 'bool'
+                elif value.id == '(name)':
+                    kind = normalize_variable(value.value)
+                else:
+                    kind = 'num'
+                sets.append((normalize_variable(cmd.target), kind))
+            if cmd.children:
+                visit(cmd.children)
+
+    visit(commands)
+    return sets, sorted(reads)
+
+def flag_layout(facts):
+    """Given the variable_facts() of every passage, returns name -> (packed
+    variable, bit) for the variables that are only ever set to 0 or 1"""
+    names = set()
+    numeric = set()
+    copies = []
+    for sets, reads in facts:
+        names.update(reads)
+        for name, kind in sets:
+            names.add(name)
+            if kind == 'num':
+                numeric.add(name)
+            elif kind != 'bool':
+                copies.append((name, kind))
+
+    # A copy of a number is a number
+    changed = True
+    while changed:
+        changed = False
+        for name, source in copies:
+            if source in numeric and not name in numeric:
+                numeric.add(name)
+                changed = True
+
+    booleans = sorted(names - numeric)
+    if len(booleans) < 2:
+        # Nothing to gain
+        return {}
+    return dict((name, ('*flags{0}'.format(i // FLAG_BITS), i % FLAG_BITS)) for i, name in enumerate(booleans))
+
+
+# Bytes it takes to call a subroutine ('{index}c\n') and to return from it
+CALL_SIZE = 5
+RETURN_SIZE = 2
+
+def display_subroutines(twp, graph, titles):
+    """Returns the titles of the displayed passages that are smaller shared
+    as subroutines than copied into each of the given passages"""
+    uses = {}
+    for title in titles:
+        for kind, target in graph.outgoing[title]:
+            if kind == 'display' and target in twp.passages:
+                uses[target] = uses.get(target, 0) + 1
+
+    subroutines = []
+    for target in sorted(uses, key=graph.indexes.get):
+        if uses[target] < 2 or not can_be_subroutine(twp, twp.passages[target].commands):
+            continue
+        size = estimate_size(twp, twp.passages[target].commands)
+        shared = size + RETURN_SIZE + len(subroutine_name(target)) + 1 + uses[target] * CALL_SIZE
+        if shared < uses[target] * size:
+            subroutines.append(target)
+    return subroutines
+
+def can_be_subroutine(twp, commands):
+    """A displayed passage can only be called if it doesn't need the caller's
+    menu, doesn't flush the caller's text and doesn't return from the caller"""
+    for cmd in commands:
+        if cmd.kind in ('link', 'list', 'image', 'return'):
+            return False
+        if cmd.kind == 'display' and cmd.target in twp.passages:
+            if not can_be_subroutine(twp, twp.passages[cmd.target].commands):
+                return False
+        if cmd.children and not can_be_subroutine(twp, cmd.children):
+            return False
+    return True
+
+def estimate_size(twp, commands):
+    """Rough size of the script generated for the commands, when inlined"""
+    size = 0
+    for cmd in commands:
+        if cmd.kind == 'text':
+            size += len(cmd.text.strip()) + 3
+        elif cmd.kind == 'display':
+            if cmd.target in twp.passages:
+                size += estimate_size(twp, twp.passages[cmd.target].commands)
+        else:
+            size += 8
+        if cmd.children:
+            size += estimate_size(twp, cmd.children)
+    return size
+
+def temp_bases(scripts, diagnostics):
+    """Gives each script (by index) the first variable slot its temporaries
+    can use, so the ones that are live across a call can't be overwritten by
+    the scripts it calls; every other script starts at slot 0"""
+    # (caller, callee, slots the callee must leave alone)
+    calls = []
+    for index, generated in scripts.items():
+        for target, position in generated.calls:
+            if target in scripts:
+                calls.append((index, target, generated.live_slots(position)))
+
+    while True:
+        base = dict.fromkeys(scripts, 0)
+        for attempt in range(len(scripts) + 1):
+            changed = False
+            for caller, callee, live in calls:
+                if base[callee] < base[caller] + live:
+                    base[callee] = base[caller] + live
+                    changed = True
+            if not changed:
+                return base
+
+        # Only the calls that lead back to the caller can keep raising the
+        # slots; nothing can protect the temporaries from those
+        broken = [call for call in calls if base[call[1]] < base[call[0]] + call[2]]
+        for caller, callee, live in broken:
+            diagnostics.append(('warning', 'Warning on {0}: the call to "{1}" may overwrite the conditions of its links, as it calls back'.format(
+                                    scripts[caller].title, scripts[callee].title)))
+        calls = [call for call in calls if not call in broken]
+
+def pruned_size(codegen, pruned, variables, image_list, music_list, canonical=None):
+    """Measures the scripts the pruned passages would have produced, without
+    disturbing the numbering of the ones that were kept"""
+    codegen = copy.copy(codegen)
+    codegen.passage_indexes = passage_indexes = dict(codegen.passage_indexes)
+    for title in pruned:
+        passage_indexes[title] = len(passage_indexes) + len(codegen.subroutines)
+
+    variables = copy.deepcopy(variables)
+    image_list = list(image_list)
+    music_list = list(music_list)
+
+    size = 0
+    for title in pruned:
+        try:
+            generated = generate_script(codegen, codegen.twp.passages[title])
+        except CompileError:
+            # Dead code is allowed to be broken
+            continue
+        size += len(generated.resolve(variables, image_list, music_list, canonical=canonical))
+        size += len(script_name(title)) + 1
+    return size
+
+
+def name_to_identifier(s):
+    return re.sub(r'[^0-9A-Za-z]', '_', s)
+
+def script_name(s):
+    return name_to_identifier(s) + '.twsam'
+
+def subroutine_name(s):
+    return name_to_identifier(s) + '__display.twsam'
+
+def pool_name(i):
+    return 'String{0}__pool.twsam'.format(i)
+
+
+
+#
+# Per-passage code generation
+#
+
+class GeneratedScript(object):
+    """Script of a single passage, with its references to the story-wide
+    images, music and variables left as placeholders"""
+
+    RE_PLACEHOLDER = re.compile(r'\x00([vim])(\d+)\x00')
+
+    def __init__(self, title, source_hash, subroutine=False):
+        self.title = title
+        self.source_hash = source_hash
+        # True for the shared script of a displayed passage
+        self.subroutine = subroutine
+        self.text = ''
+        self.images = []
+        self.music = []
+        self.var_names = []
+        self.var_ops = []
+        # (level, message) pairs, level being 'warning' or 'error'
+        self.messages = []
+        # (kind, passage title) -> value the script depends on
+        self.depends = {}
+        # (kind, target title) of the links, calls and displays
+        self.edges = []
+        # Codegen.settings() of the options it was generated with
+        self.settings = None
+        # [name, first position, last position] of the temporaries, in order
+        self.temps = []
+        # (script index, position) of the calls
+        self.calls = []
+        # variable_facts() of the passage
+        self.var_facts = ([], [])
+        # twsam.menu_cost() of the menu as generated, and with the other dispatch
+        self.menu_cost = None
+        # Page breaks added by the text layout
+        self.page_breaks = 0
+
+    @property
+    def key(self):
+        return self.title, self.subroutine
+
+    def temp_slots(self):
+        """Allocates the temporaries to slots, reusing the slots of the ones
+        that are no longer live; returns name -> slot"""
+        slots = {}
+        live = []
+        for name, start, end in sorted(self.temps, key=itemgetter(1)):
+            live = [(other_end, slot) for other_end, slot in live if other_end >= start]
+            used = set(slot for other_end, slot in live)
+            slot = min(set(range(len(used) + 1)) - used)
+            slots[name] = slot
+            live.append((end, slot))
+        return slots
+
+    def live_slots(self, position):
+        """Number of slots that must be kept intact at the given position"""
+        slots = self.temp_slots()
+        return max([slots[name] + 1 for name, start, end in self.temps if start < position <= end] or [0])
+
+    def resolve(self, variables, image_list, music_list, temp_base=0, canonical=None):
+        """Registers the references into the shared state and returns the final
+        text; canonical maps each asset path to the one to use instead"""
+        canonical = canonical or (lambda path: path)
+        temps = {}
+        slots = self.temp_slots()
+        for op, name in self.var_ops:
+            if op == 'temp':
+                temps[name] = variables.temp_var(temp_base + slots[name])
+            elif op == 'set':
+                variables.set_var(temps.get(name, name))
+            else:
+                variables.get_var(temps.get(name, name))
+
+        for path in map(canonical, self.images):
+            if not path in image_list:
+                image_list.append(path)
+
+        for path in map(canonical, self.music):
+            if not path in music_list:
+                music_list.append(path)
+
+        def replace(match):
+            kind, num = match.group(1), int(match.group(2))
+            if kind == 'v':
+                name = self.var_names[num]
+                return variables.ref(temps.get(name, name))
+            elif kind == 'i':
+                return str(image_list.index(canonical(self.images[num])))
+            else:
+                return str(music_list.index(canonical(self.music[num])))
+
+        return GeneratedScript.RE_PLACEHOLDER.sub(replace, self.text)
+
+
+class VariableRecorder(object):
+    """Stands in for the VariableFactory while a single passage is generated"""
+
+    def __init__(self, generated):
+        self.generated = generated
+        self.next_temp = 0
+
+    def set_var(self, name):
+        return self._placeholder('set', name) + '.'
+
+    def get_var(self, name):
+        return self._placeholder('get', name) + ':'
+
+    def new_temp_var(self):
+        temp = '*temp{0}'.format(self.next_temp)
+        self.next_temp += 1
+        self.generated.var_ops.append(('temp', temp))
+        return temp
+
+    def _placeholder(self, op, name):
+        self.generated.var_ops.append((op, name))
+        if not name in self.generated.var_names:
+            self.generated.var_names.append(name)
+        return '\x00v{0}\x00'.format(self.generated.var_names.index(name))
+
+
+class Codegen(object):
+    """Everything the scripts are generated from, besides the passages themselves"""
+
+    def __init__(self, twp, passage_indexes, subroutines=None, passes=twsam.DEFAULT_PASSES, fold_constants=True, flags=None,
+                 menu_dispatch='indexed', layout=None):
+        self.twp = twp
+        self.passage_indexes = passage_indexes
+        # Displayed passage title -> index of its shared script
+        self.subroutines = subroutines or {}
+        self.passes = tuple(passes)
+        self.fold_constants = fold_constants
+        # Variable name -> (packed variable, bit)
+        self.flags = flags or {}
+        self.menu_dispatch = menu_dispatch
+        # (columns, rows) of the text window to lay the text out for, or None
+        self.layout = layout
+
+    def settings(self):
+        """The options that change the generated code, for the build cache"""
+        return self.passes, self.fold_constants, self.menu_dispatch, self.layout
+
+    def new_layout(self):
+        return twlayout.TextLayout(self.layout[0], self.layout[1], twsam.MAX_STRING) if self.layout else None
+
+
+def generate_script(codegen, passage, as_subroutine=False):
+    """Generates the script of a passage or, with as_subroutine, the shared
+    script its <<display>>s call"""
+    twp = codegen.twp
+    passage_indexes = codegen.passage_indexes
+    subroutines = codegen.subroutines
+    generated = GeneratedScript(passage.title, text_hash(passage.text), as_subroutine)
+    generated.settings = codegen.settings()
+    generated.edges = list(passage_edges(passage.commands))
+    generated.var_facts = variable_facts(passage.commands)
+    if not as_subroutine:
+        # The passage's own script already reports them
+        for msg in passage.warnings:
+            generated.messages.append(('warning', 'Warning on {0}: {1}'.format(passage.title, msg)))
+    variables = VariableRecorder(generated)
+    image_list = generated.images
+    music_list = generated.music
+    ops = []
+    # The op list being filled: the script's, or the body of a block
+    blocks = [ops]
+
+    def out(op):
+        blocks[-1].append(op)
+        out.position += 1
+
+    out.position = 0
+
+    # Where the text goes on the screen, when it's laid out
+    layout = codegen.new_layout()
+
+    def check_print(soft=True):
+        if check_print.pending:
+            out(twsam.Flush(soft))
+            check_print.in_buffer = 0
+            check_print.pending = False
+            if layout:
+                layout.page()
+
+    check_print.pending = False
+    check_print.in_buffer = 0
+
+    def warning(msg):
+        generated.messages.append(('warning', 'Warning on {0}: {1}'.format(passage.title, msg)))
+
+    def out_string(msg, wrap=True):
+        # go through the string and replace characters
+        msg = ''.join(map(lambda x: {'"': "'", '[': '{', ']':'}'}[x] if x in ('"','[','{') else x, msg))
+        if layout and wrap:
+            out_pieces(layout.lay_out(msg))
+            return
+        msg = fit_string(msg)
+
+        out(twsam.Text(msg))
+
+    def out_pieces(pieces):
+        for piece in pieces:
+            if piece is None:
+                # Only there to show the text before it
+                out(twsam.Flush(soft=True))
+                generated.page_breaks += 1
+            else:
+                out(twsam.Text(piece))
+
+    def fit_string(msg):
+        MAX_LEN = 512
+        # Checks for buffer overflow
+        if check_print.in_buffer + len(msg) > MAX_LEN - 1:
+            warning("The text exceeds the maximum buffer size; try to intersperse the text with some <<pause>> macros")
+            remaining = max(0, MAX_LEN - 1 -  check_print.in_buffer)
+            msg = msg[:remaining]
+
+        check_print.in_buffer += len(msg)
+        return msg
+
+    def out_set(cmd):
+        expr = sam_expr(cmd.expr)
+        flag = packed_flag(cmd.target)
+        if flag:
+            word, bit = flag
+            expr = twexpression.flag_assign(variables.get_var(word).replace(':', ''), bit, expr)
+            out(twsam.Set(expr, variables.set_var(word)))
+        else:
+            out(twsam.Set(expr, variables.set_var(cmd.target)))
+
+    def packed_flag(name):
+        name = normalize_variable(name)
+        flag = codegen.flags.get(name)
+        generated.depends[('flag', name)] = flag
+        return flag
+
+    def out_block(cond, commands, compact=True):
+        block = twsam.Block(cond, [], compact)
+        if len(blocks) == 1:
+            out_block.start = out.position
+        out(block)
+        blocks.append(block.body)
+        commands()
+        blocks.pop()
+
+    def out_if(cmd):
+        skipped = layout.copy() if layout else None
+        out_block(sam_expr(cmd.expr), lambda: process_command_list(cmd.children, True), compact=False)
+        if layout:
+            layout.join(skipped)
+
+    def out_print(cmd):
+        # print a numeric qvariable
+        if layout:
+            out_pieces(layout.number())
+        out(twsam.Print(sam_expr(cmd.expr)))
+
+    def sam_expr(expr):
+        def var_locator(name):
+            flag = packed_flag(name)
+            if flag:
+                word, bit = flag
+                return variables.get_var(word).replace(':', ''), bit
+            return variables.get_var(name).replace(':', '')
+        return twexpression.to_sam(expr, var_locator = var_locator, fold = codegen.fold_constants)
+
+    def out_call(cmd):
+        call_target = passage_indexes.get(cmd.target)
+        generated.depends[('index', cmd.target)] = call_target
+        if call_target is not None:
+            generated.calls.append((call_target, out.position))
+            out(twsam.Call(call_target))
+
+    # Outputs all the text
+
+    links = []
+
+    def register_link(cmd, is_conditional):
+        temp_var = variables.new_temp_var() if is_conditional else None
+        links.append((cmd, temp_var))
+        if temp_var:
+            # Cleared before the outermost block, so it's live from there to the menu
+            ops.insert(len(ops) - 1, twsam.ClearFlag(variables.set_var(temp_var)))
+            generated.temps.append([temp_var, out_block.start, out_block.start])
+            out(twsam.SetFlag(variables.set_var(temp_var)))
+
+    def read_temp(temp_var):
+        for temp in generated.temps:
+            if temp[0] == temp_var:
+                temp[2] = out.position
+        return variables.get_var(temp_var)
+
+    def process_command_list(commands, is_conditional=False):
+        for cmd in commands:
+            if cmd.kind == 'text':
+                text = cmd.text.strip()
+                if text:
+                    out_string(text)
+                    check_print.pending = True
+            elif cmd.kind == 'print':
+                out_print(cmd)
+            elif cmd.kind == 'image':
+                check_print()
+                if not cmd.path in image_list:
+                    image_list.append(cmd.path)
+                out(twsam.Image('\x00i{0}\x00'.format(image_list.index(cmd.path))))
+            elif cmd.kind == 'link':
+                register_link(cmd, is_conditional)
+                out_string(cmd.actual_label())
+            elif cmd.kind == 'list':
+                for lcmd in cmd.children:
+                    if lcmd.kind == 'link':
+                        register_link(lcmd, is_conditional)
+            elif cmd.kind == 'pause':
+                check_print.pending = True
+                check_print(soft=False)
+            elif cmd.kind == 'set':
+                out_set(cmd)
+            elif cmd.kind == 'if':
+                out_if(cmd)
+            elif cmd.kind == 'call':
+                out_call(cmd)
+            elif cmd.kind == 'return':
+                out(twsam.Return())
+            elif cmd.kind == 'music':
+                if not cmd.path in music_list:
+                    music_list.append(cmd.path)
+                out(twsam.Music('\x00m{0}\x00'.format(music_list.index(cmd.path))))
+            elif cmd.kind == 'display':
+                out_display(cmd)
+
+    # Titles of the passages being inlined, to catch display cycles
+    displaying = [passage.title]
+
+    def out_display(cmd):
+        target = twp.passages.get(cmd.target)
+        generated.depends[('passage', cmd.target)] = text_hash(target.text) if target else None
+        if not target:
+            # Already reported by the validation
+            return
+
+        subroutine = subroutines.get(cmd.target)
+        generated.depends[('subroutine', cmd.target)] = subroutine
+        if subroutine is not None:
+            shown = codegen.new_layout()
+            display_effect(target.commands, shown)
+            if layout:
+                # The subroutine lays its text out from the start of a line
+                out_pieces(layout.append(shown))
+            generated.calls.append((subroutine, out.position))
+            out(twsam.Call(subroutine))
+            return
+
+        if cmd.target in displaying:
+            raise CompileError('Display cycle: {0}'.format(' -> '.join(displaying + [cmd.target])))
+        displaying.append(cmd.target)
+        process_command_list(target.commands)
+        displaying.pop()
+
+    def display_effect(commands, shown):
+        # Tracks the text the called subroutine leaves in the buffer, as if it
+        # were inlined, and where it lays it out when starting on a new page
+        for cmd in commands:
+            if cmd.kind == 'text':
+                text = cmd.text.strip()
+                if text:
+                    if shown:
+                        shown.lay_out(text)
+                    else:
+                        fit_string(text)
+                    check_print.pending = True
+            elif cmd.kind == 'print':
+                if shown:
+                    shown.number()
+            elif cmd.kind == 'pause':
+                check_print.pending = False
+                check_print.in_buffer = 0
+                if shown:
+                    shown.page()
+            elif cmd.kind == 'if':
+                skipped = shown.copy() if shown else None
+                display_effect(cmd.children, shown)
+                if shown:
+                    shown.join(skipped)
+            elif cmd.kind == 'display' and cmd.target in twp.passages:
+                if shown and cmd.target in subroutines:
+                    nested = codegen.new_layout()
+                    display_effect(twp.passages[cmd.target].commands, nested)
+                    shown.append(nested)
+                else:
+                    display_effect(twp.passages[cmd.target].commands, shown)
+
+    process_command_list(passage.commands)
+
+    if as_subroutine:
+        # The caller flushes the text and shows its own menu
+        out(twsam.Return())
+        generated.text = twsam.render(twsam.optimize(ops, codegen.passes))
+        return generated
+
+    check_print()
+
+    # Builds the menu from the links
+
+    if links:
+        if layout:
+            check_print.in_buffer = layout.chars
+        # Outputs the options separated by line breaks, max 28 chars per line
+        for link, temp_var in links:
+            if temp_var:
+                out_block(read_temp(temp_var), lambda: out_string(link.actual_label()[:28] + '\n', wrap=False))
+            else:
+                out_string(link.actual_label()[:28] + '\n', wrap=False)
+
+        out(twsam.Choice())
+        check_print.in_buffer = 0
+
+        # Outputs the menu destinations
+        targets = []
+        for link, temp_var in links:
+            generated.depends[('index', link.target)] = passage_indexes.get(link.target)
+            if not link.target in passage_indexes:
+                raise CompileError('Link points to a nonexisting passage: "{0}"'.format(link.target))
+            targets.append(passage_indexes[link.target])
+
+        indexed = codegen.menu_dispatch == 'indexed'
+        if indexed:
+            conditions = [(i, read_temp(temp_var)) for i, (link, temp_var) in enumerate(links) if temp_var]
+            if conditions:
+                out(twsam.MenuRemap(conditions))
+            out(twsam.MenuDispatch(targets))
+        else:
+            out(twsam.MenuStart())
+            for (link, temp_var), target in zip(links, targets):
+                case = twsam.MenuCase(target)
+                if temp_var:
+                    out_block(read_temp(temp_var), lambda: out(case))
+                else:
+                    out(case)
+
+        conditional = [bool(temp_var) for link, temp_var in links]
+        generated.menu_cost = (twsam.menu_cost(targets, conditional, indexed),
+                               twsam.menu_cost(targets, conditional, not indexed))
+
+    else:
+        # No links? Generates an infinite loop.
+        out(twsam.Halt())
+
+    generated.text = twsam.render(twsam.optimize(ops, codegen.passes))
+    return generated
+
+
+
+#
+# Worker processes
+#
+
+# The parsed story is sent once to each worker process
+_worker_state = None
+
+def init_worker(codegen, expr_cache):
+    global _worker_state
+    _worker_state = codegen
+    # A spawned worker (as on Windows) imports the modules anew, with the
+    # default settings
+    twexpression.cache.enabled = expr_cache
+
+def generate_in_worker(job):
+    """Returns the script, and the hits and misses of the expression cache
+    it took to generate it"""
+    codegen = _worker_state
+    title, as_subroutine = job
+    hits, misses = twexpression.cache.hits, twexpression.cache.misses
+    generated = generate_script(codegen, codegen.twp.passages[title], as_subroutine)
+    return generated, twexpression.cache.hits - hits, twexpression.cache.misses - misses
+
+def from_workers(results):
+    """Yields the scripts made by the workers, adding their expression cache
+    lookups to this process's statistics"""
+    for generated, hits, misses in results:
+        twexpression.cache.add_stats(hits, misses)
+        yield generated
+
+
+
+#
+# Incremental builds
+#
+
+class BuildCache(object):
+    """Keeps the unresolved scripts of the previous build, so the passages that
+    didn't change don't need to be parsed or generated again, and the phrases
+    of its string pool, so they keep their numbers; with a path, they are
+    also kept on disk between runs"""
+
+    FILE_NAME = '.twee2sam.cache'
+
+    def __init__(self, path=None):
+        self.path = path
+        self.version = (__version__, twparser.__version__)
+        self.scripts = {}
+        self.phrases = []
+        self._previous = {}
+        self._previous_phrases = []
+        if path:
+            self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                version, previous, phrases = pickle.load(f)
+        except Exception:
+            # Missing or unreadable; everything will be generated again
+            return
+
+        if version == self.version:
+            self._previous = previous
+            self._previous_phrases = phrases
+
+    def lookup(self, passage, codegen, subroutine=False):
+        """Returns the previous script of the passage, if it is still valid"""
+        generated = self._previous.get((passage.title, subroutine))
+        if not generated or generated.source_hash != text_hash(passage.text):
+            return None
+        if generated.settings != codegen.settings():
+            return None
+
+        twp = codegen.twp
+
+        for (kind, title), value in generated.depends.items():
+            if kind == 'passage':
+                current = text_hash(twp.passages[title].text) if title in twp.passages else None
+            elif kind == 'subroutine':
+                current = codegen.subroutines.get(title)
+            elif kind == 'flag':
+                current = codegen.flags.get(title)
+            else:
+                current = codegen.passage_indexes.get(title)
+            if current != value:
+                return None
+
+        return generated
+
+    def previous(self, passage):
+        """Returns the previous script of the passage if its source didn't
+        change, for what it says about the passage itself (its edges and
+        variables), whether or not the script is still valid"""
+        generated = self._previous.get((passage.title, False))
+        if generated and generated.source_hash == text_hash(passage.text):
+            return generated
+        return None
+
+    def store(self, generated):
+        self.scripts[generated.key] = generated
+
+    def previous_phrases(self):
+        """Returns the phrases of the previous build's string pool, in order"""
+        return self._previous_phrases
+
+    def store_phrases(self, phrases):
+        self.phrases = phrases
+
+    def commit(self):
+        """Ends a build; its scripts are the ones the next build will look up"""
+        if self.path:
+            with open(self.path, 'wb') as f:
+                pickle.dump((self.version, self.scripts, self.phrases), f, pickle.HIGHEST_PROTOCOL)
+
+        self._previous = self.scripts
+        self._previous_phrases = self.phrases
+        self.scripts = {}
+        self.phrases = []
+
+
+def text_hash(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+
+class VariableFactory(object):
+
+    # One per letter
+    MAX_VARIABLES = 26
+
+    def __init__(self, first_available):
+        self.next_available = first_available
+
+        self.vars = {}
+        self.never_used = []
+        self.never_set = []
+
+        # Temporary slots in use
+        self.temp_count = 0
+
+    def set_var(self, name):
+        name = self._normalize_name(name)
+
+        if not name in self.vars:
+            self._create_var(name)
+            self.never_used.append(name)
+
+        if name in self.never_set:
+            self.never_set.remove(name)
+
+        return '{0}.'.format(self.vars[name])
+
+    def get_var(self, name):
+        name = self._normalize_name(name)
+
+        if not name in self.vars:
+            self._create_var(name)
+            self.never_set.append(name)
+
+        if name in self.never_used:
+            self.never_used.remove(name)
+
+        return '{0}:'.format(self.vars[name])
+
+    def ref(self, name):
+        return self.vars[self._normalize_name(name)]
+
+    def temp_var(self, slot):
+        """Name of the variable of a temporary slot; the slots are shared by all the scripts"""
+        self.temp_count = max(self.temp_count, slot + 1)
+        return '*temp{0}'.format(slot)
+
+    def _create_var(self, name):
+        self.vars[name] = self._num_to_ref(self.next_available)
+        self.next_available += 1
+
+    def _num_to_ref(self, num):
+        if num >= VariableFactory.MAX_VARIABLES:
+            # Past Z; compile_story() reports it
+            return '?'
+        return chr(ord('A') + num)
+
+    def _normalize_name(self, name):
+        return name.replace('$', '').strip()
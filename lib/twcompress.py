@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+
+"""Phantasy Star Gaiden tile compression, the format SAM decompresses the
+images from (.psgcompr, as BMP2Tile writes it).
+
+The data is a little endian count of tiles, then each tile on its own:
+a byte with 2 bits for each of its 4 bitplanes (the first one in the top
+bits), then the bytes of the bitplanes that need them:
+
+- 00: the 8 bytes are $00
+- 01: the 8 bytes are $ff
+- 10: the 8 bytes follow as they are
+- 11: a byte n follows. $00-$03: the bitplane is a copy of bitplane n of
+  the tile; $10-$13: it's a copy of bitplane n-$10, inverted. Otherwise n
+  is a mask, followed by a common byte, then by a byte for each bit set
+  in the mask (the first byte being the top bit); the other bytes are the
+  common one.
+
+A bitplane can only refer to the ones before it in the same tile, so the
+best encoding of each one can be found on its own."""
+
+import struct
+from collections import Counter
+
+TILE_BYTES = 32
+PLANE_BYTES = 8
+
+METHOD_ZEROS = 0
+METHOD_ONES = 1
+METHOD_RAW = 2
+METHOD_COMPRESSED = 3
+
+COPY = 0x00
+COPY_INVERTED = 0x10
+# Values of n that aren't masks
+RESERVED = frozenset(range(COPY, COPY + 4) + range(COPY_INVERTED, COPY_INVERTED + 4))
+
+MODES = ('fast', 'max')
+
+
+def compress(data, mode='fast'):
+    """Compresses tile data (4bpp planar, 32 bytes per tile). The fast mode
+    only tries the most common byte of each bitplane as the common byte of
+    a mask; the max mode tries all of them"""
+    if len(data) % TILE_BYTES:
+        raise ValueError('the tile data must be a multiple of {0} bytes'.format(TILE_BYTES))
+    if not mode in MODES:
+        raise ValueError('Unknown compression mode: {0}'.format(mode))
+
+    data = bytearray(data)
+    count = len(data) // TILE_BYTES
+    out = bytearray(struct.pack('<H', count))
+    for start in range(0, len(data), TILE_BYTES):
+        # The 4 bytes of each row are the row's bit in each bitplane
+        planes = [data[start + plane:start + TILE_BYTES:4] for plane in range(4)]
+        methods = 0
+        encoded = bytearray()
+        for plane, values in enumerate(planes):
+            method, code = encode_plane(values, planes[:plane], mode)
+            methods = methods << 2 | method
+            encoded += code
+        out.append(methods)
+        out += encoded
+    return str(out)
+
+def encode_plane(values, previous, mode):
+    """Returns the shortest (method, bytes) for a bitplane"""
+    if not any(values):
+        return METHOD_ZEROS, ''
+    if all(value == 0xff for value in values):
+        return METHOD_ONES, ''
+
+    for plane, other in enumerate(previous):
+        if other == values:
+            return METHOD_COMPRESSED, chr(COPY + plane)
+    for plane, other in enumerate(previous):
+        if all(a ^ b == 0xff for a, b in zip(other, values)):
+            return METHOD_COMPRESSED, chr(COPY_INVERTED + plane)
+
+    best = METHOD_RAW, str(values)
+    counts = Counter(values).most_common()
+    commons = [value for value, count in counts] if mode == 'max' else [counts[0][0]]
+    for common in commons:
+        mask = 0
+        rest = bytearray()
+        for value in values:
+            mask <<= 1
+            if value != common:
+                mask |= 1
+                rest.append(value)
+        if mask in RESERVED or 2 + len(rest) >= len(best[1]):
+            continue
+        best = METHOD_COMPRESSED, chr(mask) + chr(common) + str(rest)
+    return best
+
+
+def decompress(data):
+    """Reference decompressor; returns the tile data"""
+    data = bytearray(data)
+    if len(data) < 2:
+        raise ValueError('truncated data')
+    count = data[0] | data[1] << 8
+    pos = 2
+
+    def take(size):
+        if pos + size > len(data):
+            raise ValueError('truncated data')
+        return data[pos:pos + size]
+
+    out = bytearray()
+    for tile in range(count):
+        methods = take(1)[0]
+        pos += 1
+        planes = []
+        for plane in range(4):
+            method = methods >> (6 - plane * 2) & 3
+            if method == METHOD_ZEROS:
+                values = bytearray(PLANE_BYTES)
+            elif method == METHOD_ONES:
+                values = bytearray('\xff' * PLANE_BYTES)
+            elif method == METHOD_RAW:
+                values = take(PLANE_BYTES)
+                pos += PLANE_BYTES
+            else:
+                code = take(1)[0]
+                pos += 1
+                if code in RESERVED:
+                    source = code & 0x0f
+                    if source >= plane:
+                        raise ValueError('tile {0} copies a bitplane it has not decoded yet'.format(tile))
+                    values = bytearray(planes[source])
+                    if code & COPY_INVERTED:
+                        values = bytearray(value ^ 0xff for value in values)
+                else:
+                    common = take(1)[0]
+                    pos += 1
+                    values = bytearray()
+                    for bit in range(PLANE_BYTES):
+                        if code & (0x80 >> bit):
+                            values += take(1)
+                            pos += 1
+                        else:
+                            values.append(common)
+            planes.append(values)
+        for row in range(PLANE_BYTES):
+            out += bytearray(planes[plane][row] for plane in range(4))
+    return str(out)
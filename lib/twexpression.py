@@ -3,6 +3,8 @@
 
 import sys
 import re
+import threading
+from collections import OrderedDict
 
 # symbol (token type) registry
 
@@ -13,6 +15,7 @@ class symbol_base(object):
     id = None
     value = None
     first = second = third = None
+    parser = None
 
     def nud(self):
         raise SyntaxError("Syntax error (%r)." % self.id)
@@ -27,6 +30,18 @@ class symbol_base(object):
         out = map(str, filter(None, out))
         return "(" + " ".join(out) + ")"
 
+    def __reduce__(self):
+        # The symbol classes are created on the fly, so they can't be pickled
+        # by name; they are looked up again in the symbol table instead.
+        state = dict(self.__dict__)
+        state.pop('parser', None)
+        return restore_symbol, (type(self).id, state)
+
+def restore_symbol(id, state):
+    s = symbol_table[id]()
+    s.__dict__.update(state)
+    return s
+
 def symbol(id, bp=0):
     try:
         s = symbol_table[id]
@@ -47,29 +62,23 @@ def symbol(id, bp=0):
 def infix(id, bp):
     def led(self, left):
         self.first = left
-        self.second = expression(bp)
+        self.second = self.parser.expression(bp)
         return self
     symbol(id, bp).led = led
 
 def infix_r(id, bp):
     def led(self, left):
         self.first = left
-        self.second = expression(bp-1)
+        self.second = self.parser.expression(bp-1)
         return self
     symbol(id, bp).led = led
 
 def prefix(id, bp):
     def nud(self):
-        self.first = expression(bp)
+        self.first = self.parser.expression(bp)
         return self
     symbol(id).nud = nud
 
-def advance(id=None):
-    global token
-    if id and token.id != id:
-        raise SyntaxError("Expected %r" % id)
-    token = next()
-
 def method(s):
     # decorator
     assert issubclass(s, symbol_base)
@@ -106,8 +115,8 @@ symbol(")")
 @method(symbol("("))
 def nud(self):
     # parenthesized form; replaced by tuple former below
-    expr = expression()
-    advance(")")
+    expr = self.parser.expression()
+    self.parser.advance(")")
     return expr
 
 symbol(")"); symbol(",")
@@ -116,13 +125,13 @@ symbol(")"); symbol(",")
 def led(self, left):
     self.first = left
     self.second = []
-    if token.id != ")":
+    if self.parser.token.id != ")":
         while 1:
-            self.second.append(expression())
-            if token.id != ",":
+            self.second.append(self.parser.expression())
+            if self.parser.token.id != ",":
                 break
-            advance(",")
-    advance(")")
+            self.parser.advance(",")
+    self.parser.advance(")")
     return self
 
 symbol(":"); symbol("=")
@@ -139,36 +148,54 @@ def constant(id):
 constant("true")
 constant("false")
 
-# python tokenizer
-
-def tokenize_python(program):
-    import tokenize
-    from cStringIO import StringIO
-    type_map = {
-        tokenize.NUMBER: "(literal)",
-        tokenize.STRING: "(literal)",
-        tokenize.OP: "(operator)",
-        tokenize.NAME: "(name)",
-        }
-    for t in tokenize.generate_tokens(StringIO(program).next):
-        try:
-            yield type_map[t[0]], t[1]
-        except KeyError:
-            if t[0] == tokenize.NL:
-                continue
-            if t[0] == tokenize.ENDMARKER:
-                break
-            else:
-                raise SyntaxError("Syntax error")
+# twine tokenizer
+
+RE_TOKEN = re.compile(r"""
+    \s*(?:
+      (?P<number>0[xX][0-9a-fA-F]+[lL]?|(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?[lLjJ]?)
+    | (?P<string>"(?:[^"\\\n]|\\.)*"|'(?:[^'\\\n]|\\.)*')
+    | \$(?P<variable>[A-Za-z_]\w*)
+    | (?P<name>[A-Za-z_]\w*)
+    | (?P<operator>\*\*|//|<<|>>|<=|>=|==|!=|<>|&&|\|\||[-+*/%<>=()\[\]{},:.&|^~!@;`])
+    )\s*""", flags=re.VERBOSE)
+
+# JS operators and Twine's textual comparison operators
+OPERATOR_ALIASES = {
+    '&&': 'and',
+    '||': 'or',
+    '!': 'not',
+    'eq': '==',
+    'neq': '!=',
+    'gt': '>',
+    'gte': '>=',
+    'lt': '<',
+    'lte': '<='
+}
+
+def tokenize_twine(program):
+    pos = 0
+    end = len(program.rstrip())
+    while pos < end:
+        match = RE_TOKEN.match(program, pos)
+        if not match:
+            raise SyntaxError("Syntax error")
+        pos = match.end()
+
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind in ('number', 'string'):
+            yield "(literal)", value
+        elif kind == 'variable' or (kind == 'name' and value not in OPERATOR_ALIASES):
+            yield "(name)", value
+        else:
+            yield "(operator)", OPERATOR_ALIASES.get(value, value)
     yield "(end)", "(end)"
 
 def tokenize(program):
     if isinstance(program, list):
         source = program
     else:
-        # Hack to make JS boolean operators work with the Python tokenizer
-        program = program.replace('&&', ' and ').replace('||', ' or ').replace('!', ' not ').replace('$', '').strip()
-        source = tokenize_python(program)
+        source = tokenize_twine(program)
     for id, value in source:
         if id == "(literal)":
             symbol = symbol_table[id]
@@ -189,22 +216,121 @@ def tokenize(program):
 
 # parser engine
 
-def expression(rbp=0):
-    global token
-    t = token
-    token = next()
-    left = t.nud()
-    while rbp < token.lbp:
-        t = token
-        token = next()
-        left = t.led(left)
-    return left
+class Parser(object):
+    """Parses a single expression, keeping its token stream in the instance"""
+
+    def __init__(self, program):
+        self.symbols = []
+        self.next = self._symbols(program).next
+        self.token = self.next()
+
+    def _symbols(self, program):
+        for s in tokenize(program):
+            s.parser = self
+            self.symbols.append(s)
+            yield s
+
+    def parse(self):
+        """Parses the whole expression; the tree keeps no reference to the parser"""
+        parsed = self.expression()
+        for s in self.symbols:
+            del s.parser
+        self.symbols = []
+        return parsed
+
+    def advance(self, id=None):
+        if id and self.token.id != id:
+            raise SyntaxError("Expected %r" % id)
+        self.token = self.next()
+
+    def expression(self, rbp=0):
+        t = self.token
+        self.token = self.next()
+        left = t.nud()
+        while rbp < self.token.lbp:
+            t = self.token
+            self.token = self.next()
+            left = t.led(left)
+        return left
+
+# expression cache
+
+class ExpressionCache(object):
+    """Bounded LRU cache for parsed expressions and generated SAM code"""
+
+    def __init__(self, size=1024):
+        self.size = size
+        self.enabled = True
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "<ExpressionCache {0} items, {1} hits, {2} misses>".format(len(self._items), self.hits, self.misses)
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            # Re-inserting marks it as the most recently used
+            self._items[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.hits = self.misses = 0
+
+    def reset_stats(self):
+        """Starts counting the lookups of a new build, keeping the items"""
+        with self._lock:
+            self.hits = self.misses = 0
+
+    def add_stats(self, hits, misses):
+        """Counts the lookups made by another process"""
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        ratio = 100.0 * self.hits / lookups if lookups else 0.0
+        return 'expression cache: {0} hits, {1} misses ({2:.1f}% hit rate)'.format(self.hits, self.misses, ratio)
+
+cache = ExpressionCache()
+
+def normalize(program):
+    """Collapses the whitespace of an expression, unless it contains string literals"""
+    if '"' in program or "'" in program:
+        return program.strip()
+    return ' '.join(program.split())
 
 def parse(program):
-    global token, next
-    next = tokenize(program).next
-    token = next()
-    return expression()
+    """Parses an expression; the trees of the cached ones are shared, so
+    they must not be modified"""
+    if not isinstance(program, basestring):
+        return Parser(program).parse()
+
+    source = normalize(program)
+    key = ('parse', source)
+    parsed = cache.get(key) if cache.enabled else None
+    if parsed is None:
+        parsed = Parser(source).parse()
+        if cache.enabled:
+            cache.put(key, parsed)
+    return parsed
 
 def test(program):
     print ">>>", program
@@ -233,18 +359,221 @@ OPERATOR_TABLE = {
     '%': '\\'
 }
 
-def to_sam(program, var_locator = lambda s: s + '?'):
-    parsed = parse(program) if isinstance(program, basestring) else program
+# Operator -> (inverse, used to rewrite 'not' comparisons)
+INVERSE_TABLE = {
+    'is': '!=',
+    '==': '!=',
+    '!=': '==',
+    '<>': '==',
+    '<': '>=',
+    '>=': '<',
+    '>': '<=',
+    '<=': '>'
+}
 
+BOOLEAN_OPERATORS = ('not', 'and', 'or') + tuple(INVERSE_TABLE)
+
+# Only values in this range are folded: SAM's arithmetic can't differ from
+# Python's there, however wide its integers are and whatever their sign.
+FOLD_MAX = 255
+
+FOLD_TABLE = {
+    '+': lambda x, y: x + y,
+    '-': lambda x, y: x - y,
+    '*': lambda x, y: x * y,
+    '/': lambda x, y: x // y if y else None,
+    '%': lambda x, y: x % y if y else None,
+    'is': lambda x, y: int(x == y),
+    '==': lambda x, y: int(x == y),
+    '!=': lambda x, y: int(x != y),
+    '<>': lambda x, y: int(x != y),
+    '<': lambda x, y: int(x < y),
+    '<=': lambda x, y: int(x <= y),
+    '>': lambda x, y: int(x > y),
+    '>=': lambda x, y: int(x >= y),
+    # Computed as SAM does, by multiplying or adding the operands
+    'and': lambda x, y: int(x * y > 0) if x * y <= FOLD_MAX else None,
+    'or': lambda x, y: int(x + y > 0) if x + y <= FOLD_MAX else None
+}
+
+def make_node(id, first=None, second=None, value=None):
+    s = symbol_table[id]()
+    s.first = first
+    s.second = second
+    s.value = value
+    return s
+
+def make_literal(value):
+    return make_node('(literal)', value=str(value))
+
+def int_value(parsed):
+    """Value of an integer literal or constant, or None"""
+    if parsed.id != '(literal)':
+        return None
+    value = CONST_TABLE.get(parsed.value, parsed.value)
+    return int(value) if value.isdigit() else None
+
+def is_boolean(parsed):
+    """True if the expression always evaluates to 0 or 1"""
+    return parsed.id in BOOLEAN_OPERATORS and parsed.second is not None or parsed.id == 'not' or int_value(parsed) in (0, 1)
+
+def is_pure(parsed):
+    """True if evaluating the expression has no effect besides its value"""
+    if parsed is None or parsed.id == '(name)' or parsed.id == '(literal)':
+        return True
+    return parsed.id != '(' and is_pure(parsed.first) and is_pure(parsed.second)
+
+def simplify(parsed):
+    """Returns an equivalent expression tree with the literal subexpressions
+    folded and the identities removed; the tree given isn't modified"""
+    if parsed.id in ('(literal)', '(name)'):
+        return parsed
+
+    if parsed.id == '(':
+        # It's a function call
+        return make_node('(', parsed.first, [simplify(param) for param in parsed.second])
+
+    first = simplify(parsed.first)
+
+    if parsed.id in ('+', '-') and not parsed.second:
+        if parsed.id == '+':
+            return first
+        if first.id == '-' and not first.second:
+            return first.first
+        if int_value(first) == 0:
+            return first
+        return make_node('-', first)
+
+    if parsed.id == 'not':
+        value = int_value(first)
+        if value is not None:
+            return make_literal(int(value == 0))
+        if first.id == 'not' and is_boolean(first.first):
+            return first.first
+        if first.id in INVERSE_TABLE:
+            return make_node(INVERSE_TABLE[first.id], first.first, first.second)
+        return make_node('not', first)
+
+    second = simplify(parsed.second)
+    x, y = int_value(first), int_value(second)
+
+    if x is not None and y is not None and parsed.id in FOLD_TABLE:
+        value = FOLD_TABLE[parsed.id](x, y)
+        if value is not None and 0 <= value <= FOLD_MAX:
+            return make_literal(value)
+
+    if parsed.id == '+':
+        if y == 0:
+            return first
+        if x == 0:
+            return second
+    elif parsed.id == '-':
+        if y == 0:
+            return first
+    elif parsed.id == '*':
+        if y == 1:
+            return first
+        if x == 1:
+            return second
+        if (x == 0 and is_pure(second)) or (y == 0 and is_pure(first)):
+            return make_literal(0)
+    elif parsed.id == '/':
+        if y == 1:
+            return first
+    elif parsed.id in ('and', 'or'):
+        # Only when the other operand is already 0 or 1
+        for constant, other in ((x, second), (y, first)):
+            if constant is None or not is_boolean(other) or not 0 <= constant < FOLD_MAX:
+                continue
+            if (parsed.id == 'and') == bool(constant):
+                return other
+            if is_pure(other):
+                return make_literal(int(parsed.id == 'or'))
+
+    return make_node(parsed.id, first, second)
+
+def variable_names(parsed):
+    """Yields the names of the variables the expression reads"""
+    if parsed.id == '(name)':
+        yield parsed.value
+    elif parsed.id == '(':
+        # The function name isn't a variable
+        for param in parsed.second:
+            for name in variable_names(param):
+                yield name
+    else:
+        for child in (parsed.first, parsed.second):
+            if child is not None:
+                for name in variable_names(child):
+                    yield name
+
+# Packed flags: a variable can hold several booleans, one per bit; SAM has
+# no bitwise operators, so the bits are read and written arithmetically.
+
+def flag_read(location, bit):
+    """SAM code that pushes the given bit of a variable"""
+    code = location + (' :' if location.isdigit() else ':')
+    if bit:
+        code += '{0}/'.format(1 << bit)
+    return code + '2\\'
+
+def flag_assign(location, bit, value):
+    """SAM code that pushes the variable with the given bit replaced by
+    value, the code of an expression that evaluates to 0 or 1"""
+    weight = '{0}*'.format(1 << bit) if bit else ''
+    word = location + (' :' if location.isdigit() else ':')
+    if value == '0':
+        # word - bit * weight
+        return word + flag_read(location, bit) + weight + '-'
+    # word + (value - bit) * weight
+    separator = ' ' if value[-1:].isdigit() and location[:1].isdigit() else ''
+    return word + value + separator + flag_read(location, bit) + '-' + weight + '+'
+
+def to_sam(program, var_locator = lambda s: s + '?', fold = True):
+    parsed = parse(program) if isinstance(program, basestring) else program
+    if not cache.enabled:
+        return generate_sam(simplify(parsed) if fold else parsed, var_locator, fold)
+
+    # The trees are shared, so what is worked out from one is cached under
+    # its text (which is the same in the -j workers) instead of kept on it
+    source = repr(parsed)
+    key = ('tree', source, fold)
+    prepared = cache.get(key)
+    if prepared is None:
+        tree = simplify(parsed) if fold else parsed
+        names = []
+        generate_sam(tree, lambda name: names.append(name) or name)
+        prepared = tree, names
+        cache.put(key, prepared)
+    tree, names = prepared
+
+    # The generated code depends on where each variable is located, so the
+    # locations are part of the key; the locator is still called for every
+    # variable, in the same order as the code generator would.
+    locations = tuple(var_locator(name) for name in names)
+    key = ('sam', source, locations, fold)
+    generated = cache.get(key)
+    if generated is None:
+        generated = generate_sam(tree, dict(zip(names, locations)).__getitem__, fold)
+        cache.put(key, generated)
+    return generated
+
+# A space after a number is only needed if another number follows
+RE_NUMBER_SPACE = re.compile(r'(?<=\d) (?=[^\d:]|$)')
+
+def generate_sam(parsed, var_locator, compact = False):
     def process_node(parsed):
         generated = []
         if parsed.id == '(literal)':
             # It's either a numeric literal or a constant
             generated += [CONST_TABLE.get(parsed.value, parsed.value), ' ']
         elif parsed.id == '(name)':
-            # It's reading a variable
+            # It's reading a variable, or one of the flags packed into it
             var_name = var_locator(parsed.value)
-            generated += [var_name, ' :' if var_name.isdigit() else ':']
+            if isinstance(var_name, tuple):
+                generated += [flag_read(*var_name)]
+            else:
+                generated += [var_name, ' :' if var_name.isdigit() else ':']
         elif parsed.id in ('+', '-'):
             # + and - can be either unary or binary.
             if parsed.second:
@@ -277,4 +606,67 @@ def to_sam(program, var_locator = lambda s: s + '?'):
 
         return ''.join(generated)
 
-    return process_node(parsed)
+    generated = process_node(parsed)
+    if compact and not '"' in generated and not "'" in generated:
+        generated = RE_NUMBER_SPACE.sub('', generated)
+    return generated
+
+
+#
+# Reference evaluator
+#
+
+RE_SAM_TOKEN = re.compile(r'\s*(?:(?P<variable>[A-Z]|\d+) ?:|(?P<number>\d+)|(?P<operator>[-+*/\\=<>r]))')
+
+def evaluate_sam(code, variables, random=lambda: 0, bits=16, signed=False):
+    """Runs the code of an expression as SAM's stack machine would, as a
+    reference for the tests. variables maps the variables (letters, or the
+    numbers of the locations) to their values, and random gives the values
+    of r. The values wrap to the given number of bits, as SAM's word size
+    isn't known here. Raises ZeroDivisionError on a division by zero"""
+    def word(value):
+        value &= (1 << bits) - 1
+        if signed and value >> (bits - 1):
+            value -= 1 << bits
+        return value
+
+    stack = []
+    pos = 0
+    end = len(code.rstrip())
+    while pos < end:
+        match = RE_SAM_TOKEN.match(code, pos)
+        if not match:
+            raise SyntaxError('Unexpected SAM code at {0}: {1!r}'.format(pos, code))
+        pos = match.end()
+        if match.group('variable'):
+            stack.append(word(variables[match.group('variable')]))
+        elif match.group('number'):
+            stack.append(word(int(match.group('number'))))
+        elif match.group('operator') == 'r':
+            stack.append(word(random()))
+        else:
+            operator = match.group('operator')
+            y = stack.pop()
+            x = stack.pop()
+            if operator == '+':
+                value = x + y
+            elif operator == '-':
+                value = x - y
+            elif operator == '*':
+                value = x * y
+            elif operator == '/':
+                # Truncates towards 0
+                value = abs(x) // abs(y) * (1 if (x < 0) == (y < 0) else -1)
+            elif operator == '\\':
+                # The sign of the dividend
+                value = abs(x) % abs(y) * (1 if x >= 0 else -1)
+            elif operator == '=':
+                value = int(x == y)
+            elif operator == '<':
+                value = int(x < y)
+            else:
+                value = int(x > y)
+            stack.append(word(value))
+    if len(stack) != 1:
+        raise SyntaxError('The SAM code leaves {0} values: {1!r}'.format(len(stack), code))
+    return stack[0]
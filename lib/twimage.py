@@ -0,0 +1,602 @@
+# -*- coding: utf-8 -*-
+
+"""Checks the images against what SAM can show, before they are converted:
+256x144 pixels, at most 16 colors and at most 320 distinct 8x8 tiles. Two
+tiles that only differ by a horizontal and/or vertical flip count as one,
+as the Master System can flip a tile when drawing it.
+
+Can also convert them into the tiles, tilemap and palette the Master
+System loads, and reduce the ones with too many colors to 16 of the 64
+colors of the Master System. The PNG decoder and encoder are pure Python,
+so none of this needs anything installed."""
+
+import struct, zlib, multiprocessing
+import cPickle as pickle
+
+WIDTH = 256
+HEIGHT = 144
+MAX_COLORS = 16
+MAX_TILES = 320
+TILE_SIZE = 8
+
+# Larger images aren't decoded at all
+MAX_PIXELS = 4096 * 4096
+
+PNG_SIGNATURE = '\x89PNG\r\n\x1a\n'
+
+# Color type -> samples per pixel
+CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+
+# Bit depths allowed for each color type
+BIT_DEPTHS = {0: (1, 2, 4, 8, 16), 2: (8, 16), 3: (1, 2, 4, 8), 4: (8, 16), 6: (8, 16)}
+
+# The values (in 0-255) of the 4 levels of each channel of the Master
+# System's colors
+SMS_LEVELS = (0, 85, 170, 255)
+
+# The 64 colors of the Master System, by their --BBGGRR value
+MASTER_PALETTE = [(red, green, blue) for blue in SMS_LEVELS for green in SMS_LEVELS for red in SMS_LEVELS]
+
+# Threshold map of the ordered dithering
+BAYER = ((0, 8, 2, 10), (12, 4, 14, 6), (3, 11, 1, 9), (15, 7, 13, 5))
+
+# How far (in 0-255) the dithering moves the colors; less than half the
+# distance between two levels, so the colors of the palette stay as they are
+DITHER_SPREAD = 64
+
+# (first column, first row, column step, row step) of the Adam7 passes
+ADAM7 = ((0, 0, 8, 8), (4, 0, 8, 8), (0, 4, 4, 8), (2, 0, 4, 4), (0, 2, 2, 4), (1, 0, 2, 2), (0, 1, 1, 2))
+
+
+class PNGError(ValueError):
+    """The file isn't a PNG this decoder can read"""
+
+
+def decode_png(data):
+    """Decodes a PNG; returns (width, height, pixels), pixels being a list of
+    rows, each a list of colors, each a tuple of samples (with alpha last
+    when there is transparency)"""
+    width, height, pixels, color_type, depth, palette, transparency = read_png(data)
+    return width, height, [[make_color(pixel, color_type, palette, transparency) for pixel in row] for row in pixels]
+
+def read_png(data):
+    """Decodes a PNG without applying its palette; returns (width, height,
+    pixels, color type, bit depth, palette, transparency), pixels being
+    a list of rows, each a list of tuples of samples"""
+    if not data.startswith(PNG_SIGNATURE):
+        raise PNGError('not a PNG file')
+
+    header = None
+    palette = None
+    transparency = None
+    compressed = []
+    pos = len(PNG_SIGNATURE)
+    while pos < len(data):
+        if pos + 8 > len(data):
+            raise PNGError('truncated chunk')
+        length, kind = struct.unpack('>I4s', data[pos:pos + 8])
+        body = data[pos + 8:pos + 8 + length]
+        crc = data[pos + 8 + length:pos + 12 + length]
+        if len(body) != length or len(crc) != 4:
+            raise PNGError('truncated chunk')
+        if zlib.crc32(kind + body) & 0xffffffff != struct.unpack('>I', crc)[0]:
+            raise PNGError('bad checksum in the {0} chunk'.format(kind))
+        pos += 12 + length
+
+        if kind == 'IHDR':
+            if length != 13:
+                raise PNGError('bad IHDR chunk')
+            header = struct.unpack('>IIBBBBB', body)
+        elif kind == 'PLTE':
+            palette = [tuple(bytearray(body[i:i + 3])) for i in range(0, len(body) - 2, 3)]
+        elif kind == 'tRNS':
+            transparency = bytearray(body)
+        elif kind == 'IDAT':
+            compressed.append(body)
+        elif kind == 'IEND':
+            break
+        elif not ord(kind[0]) & 0x20:
+            raise PNGError('unknown critical chunk {0}'.format(kind))
+
+    if not header:
+        raise PNGError('no IHDR chunk')
+    width, height, depth, color_type, compression, filter_method, interlace = header
+    if not color_type in CHANNELS or not depth in BIT_DEPTHS[color_type]:
+        raise PNGError('unsupported color type {0} with bit depth {1}'.format(color_type, depth))
+    if compression or filter_method or interlace > 1:
+        raise PNGError('unsupported compression, filter or interlace method')
+    if width * height > MAX_PIXELS:
+        raise PNGError('{0}x{1} pixels is too large'.format(width, height))
+    if color_type == 3 and not palette:
+        raise PNGError('no palette')
+
+    try:
+        raw = bytearray(zlib.decompress(''.join(compressed)))
+    except zlib.error as e:
+        raise PNGError('bad image data: {0}'.format(e))
+
+    channels = CHANNELS[color_type]
+    pixels = [[None] * width for y in range(height)]
+    passes = ADAM7 if interlace else ((0, 0, 1, 1),)
+    pos = 0
+    for x0, y0, dx, dy in passes:
+        columns = len(range(x0, width, dx))
+        rows = range(y0, height, dy)
+        if not columns or not rows:
+            continue
+        row_bytes = (columns * channels * depth + 7) // 8
+        samples = unfilter(raw, pos, len(rows), row_bytes, max(1, channels * depth // 8))
+        pos += len(rows) * (row_bytes + 1)
+        for y, line in zip(rows, samples):
+            values = unpack_samples(line, columns * channels, depth)
+            row = pixels[y]
+            for i, x in enumerate(range(x0, width, dx)):
+                row[x] = tuple(values[i * channels:(i + 1) * channels])
+
+    return width, height, pixels, color_type, depth, palette, transparency
+
+def unfilter(raw, pos, rows, row_bytes, bpp):
+    """Undoes the filter of each scanline; returns them as bytearrays"""
+    if len(raw) < pos + rows * (row_bytes + 1):
+        raise PNGError('truncated image data')
+    lines = []
+    previous = bytearray(row_bytes)
+    for y in range(rows):
+        kind = raw[pos]
+        line = raw[pos + 1:pos + 1 + row_bytes]
+        pos += row_bytes + 1
+        if kind == 1:
+            for i in range(bpp, row_bytes):
+                line[i] = (line[i] + line[i - bpp]) & 0xff
+        elif kind == 2:
+            for i in range(row_bytes):
+                line[i] = (line[i] + previous[i]) & 0xff
+        elif kind == 3:
+            for i in range(row_bytes):
+                left = line[i - bpp] if i >= bpp else 0
+                line[i] = (line[i] + ((left + previous[i]) >> 1)) & 0xff
+        elif kind == 4:
+            for i in range(row_bytes):
+                a = line[i - bpp] if i >= bpp else 0
+                b = previous[i]
+                c = previous[i - bpp] if i >= bpp else 0
+                p = a + b - c
+                pa, pb, pc = abs(p - a), abs(p - b), abs(p - c)
+                line[i] = (line[i] + (a if pa <= pb and pa <= pc else b if pb <= pc else c)) & 0xff
+        elif kind:
+            raise PNGError('unknown filter type {0}'.format(kind))
+        lines.append(line)
+        previous = line
+    return lines
+
+def unpack_samples(line, count, depth):
+    if depth == 8:
+        return list(line[:count])
+    if depth == 16:
+        return [line[i] << 8 | line[i + 1] for i in range(0, count * 2, 2)]
+    per_byte = 8 // depth
+    mask = (1 << depth) - 1
+    return [(line[i // per_byte] >> (8 - depth * (i % per_byte + 1))) & mask for i in range(count)]
+
+def make_color(pixel, color_type, palette, transparency):
+    if color_type == 3:
+        index = pixel[0]
+        if index >= len(palette):
+            raise PNGError('color index out of the palette')
+        if transparency is not None and index < len(transparency) and transparency[index] < 255:
+            return palette[index] + (transparency[index],)
+        return palette[index]
+    return pixel
+
+def write_png(width, height, rows, palette):
+    """Encodes an image with up to 16 colors as an indexed PNG; rows is a
+    list of rows of indexes into palette, a list of (red, green, blue)"""
+    def chunk(kind, body):
+        return struct.pack('>I', len(body)) + kind + body + struct.pack('>I', zlib.crc32(kind + body) & 0xffffffff)
+
+    raw = bytearray()
+    for row in rows:
+        raw.append(0)
+        for x in range(0, width, 2):
+            raw.append(row[x] << 4 | (row[x + 1] if x + 1 < width else 0))
+    return (PNG_SIGNATURE +
+            chunk('IHDR', struct.pack('>IIBBBBB', width, height, 4, 3, 0, 0, 0)) +
+            chunk('PLTE', str(bytearray(sample for color in palette for sample in color))) +
+            chunk('IDAT', zlib.compress(str(raw), 9)) +
+            chunk('IEND', ''))
+
+
+class ImageReport(object):
+    """What an image uses, and what SAM can't show of it"""
+
+    def __init__(self):
+        self.width = 0
+        self.height = 0
+        self.colors = 0
+        # Distinct tiles, as they are, and counting the flipped ones as one
+        self.tiles = 0
+        self.flipped_tiles = 0
+        self.problems = []
+
+    def summary(self):
+        if not self.width:
+            return 'unreadable'
+        return '{0}x{1}, {2} colors, {3} of {4} tiles ({5} without flips)'.format(
+            self.width, self.height, self.colors, self.flipped_tiles, MAX_TILES, self.tiles)
+
+
+def analyze(data):
+    """Returns the ImageReport of the contents of a PNG file"""
+    report = ImageReport()
+    try:
+        width, height, pixels = decode_png(data)
+    except PNGError as e:
+        report.problems.append('not a valid PNG image: {0}'.format(e))
+        return report
+
+    report.width, report.height = width, height
+    colors = {}
+    indexed = [[colors.setdefault(color, len(colors)) for color in row] for row in pixels]
+    report.colors = len(colors)
+
+    tiles = set()
+    flipped_tiles = set()
+    for ty in range(0, height - TILE_SIZE + 1, TILE_SIZE):
+        rows = indexed[ty:ty + TILE_SIZE]
+        for tx in range(0, width - TILE_SIZE + 1, TILE_SIZE):
+            tile = tuple(tuple(row[tx:tx + TILE_SIZE]) for row in rows)
+            tiles.add(tile)
+            mirrored = tuple(row[::-1] for row in tile)
+            flipped_tiles.add(min(tile, mirrored, tile[::-1], mirrored[::-1]))
+    report.tiles = len(tiles)
+    report.flipped_tiles = len(flipped_tiles)
+
+    if (width, height) != (WIDTH, HEIGHT):
+        report.problems.append('it is {0}x{1} pixels, but SAM images must be {2}x{3}'.format(width, height, WIDTH, HEIGHT))
+    if report.colors > MAX_COLORS:
+        report.problems.append('it has {0} colors, but SAM can only show {1}'.format(report.colors, MAX_COLORS))
+    if report.flipped_tiles > MAX_TILES:
+        report.problems.append('it needs {0} distinct tiles, but SAM can only show {1}; try simplifying it'.format(
+            report.flipped_tiles, MAX_TILES))
+    return report
+
+def analyze_file(path):
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except IOError as e:
+        report = ImageReport()
+        report.problems.append("it can't be read: {0}".format(e.strerror))
+        return report
+    return analyze(data)
+
+
+class TileData(object):
+    """An image as the Master System loads it"""
+
+    def __init__(self):
+        # 4 bits per pixel, as 4 bitplanes per row; 32 bytes per tile
+        self.tiles = ''
+        # One little endian word per 8x8 cell: the tile number, plus
+        # TILE_HFLIP and TILE_VFLIP
+        self.tilemap = ''
+        # The 16 colors, as --BBGGRR bytes
+        self.palette = ''
+        self.tile_count = 0
+        # Why it couldn't be converted, or None
+        self.error = None
+
+TILE_HFLIP = 1 << 9
+TILE_VFLIP = 1 << 10
+
+def sms_color(color, maximum=255):
+    """Converts a color, whose samples go up to maximum, to the --BBGGRR of
+    the Master System"""
+    if len(color) <= 2:
+        # Gray, with or without alpha
+        color = color[:1] * 3
+    red, green, blue = [(sample * 6 + maximum) // (maximum * 2) for sample in color[:3]]
+    return red | green << 2 | blue << 4
+
+def planar_tile(tile):
+    data = bytearray()
+    for row in tile:
+        for plane in range(4):
+            byte = 0
+            for index in row:
+                byte = byte << 1 | (index >> plane) & 1
+            data.append(byte)
+    return str(data)
+
+def convert(data):
+    """Converts the contents of a PNG file into TileData; identical tiles,
+    flipped or not, are stored once"""
+    result = TileData()
+    try:
+        width, height, pixels, color_type, depth, palette, transparency = read_png(data)
+    except PNGError as e:
+        result.error = 'not a valid PNG image: {0}'.format(e)
+        return result
+    if width % TILE_SIZE or height % TILE_SIZE:
+        result.error = 'it is {0}x{1} pixels, not a whole number of tiles'.format(width, height)
+        return result
+
+    # An indexed image keeps the order of its palette if it can; the others
+    # number their colors as they appear
+    used = set(pixel for row in pixels for pixel in row)
+    if color_type == 3 and max(used)[0] < MAX_COLORS:
+        numbers = dict((pixel, pixel[0]) for pixel in used)
+        colors = palette[:MAX_COLORS]
+    else:
+        numbers = {}
+        colors = []
+        for row in pixels:
+            for pixel in row:
+                if not pixel in numbers:
+                    numbers[pixel] = len(colors)
+                    colors.append(make_color(pixel, color_type, palette, transparency))
+        if len(colors) > MAX_COLORS:
+            result.error = 'it has {0} colors, but the Master System can only show {1}'.format(len(colors), MAX_COLORS)
+            return result
+    maximum = 255 if color_type == 3 else (1 << depth) - 1
+    result.palette = str(bytearray(sms_color(color, maximum) for color in colors).ljust(MAX_COLORS, '\0'))
+
+    indexed = [[numbers[pixel] for pixel in row] for row in pixels]
+    # Tile -> number, of the tiles stored so far
+    stored = {}
+    tiles = []
+    tilemap = []
+    for ty in range(0, height, TILE_SIZE):
+        rows = indexed[ty:ty + TILE_SIZE]
+        for tx in range(0, width, TILE_SIZE):
+            tile = tuple(tuple(row[tx:tx + TILE_SIZE]) for row in rows)
+            mirrored = tuple(row[::-1] for row in tile)
+            for flags, variant in ((0, tile), (TILE_HFLIP, mirrored), (TILE_VFLIP, tile[::-1]),
+                                   (TILE_HFLIP | TILE_VFLIP, mirrored[::-1])):
+                if variant in stored:
+                    tilemap.append(stored[variant] | flags)
+                    break
+            else:
+                stored[tile] = len(tiles)
+                tilemap.append(len(tiles))
+                tiles.append(planar_tile(tile))
+
+    if len(tiles) > MAX_TILES:
+        result.error = 'it needs {0} distinct tiles, but SAM can only show {1}'.format(len(tiles), MAX_TILES)
+        return result
+    result.tiles = ''.join(tiles)
+    result.tilemap = struct.pack('<{0}H'.format(len(tilemap)), *tilemap)
+    result.tile_count = len(tiles)
+    return result
+
+def convert_file(path):
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except IOError as e:
+        result = TileData()
+        result.error = "it can't be read: {0}".format(e.strerror)
+        return result
+    return convert(data)
+
+
+class ReducedImage(object):
+    """An image reduced to the colors the Master System can show"""
+
+    def __init__(self):
+        # The PNG file of the reduced image, or None if it didn't need it
+        self.png = None
+        # Colors before and after
+        self.colors = 0
+        self.reduced_colors = 0
+        # Why it couldn't be reduced, or None
+        self.error = None
+
+def color_distance(a, b):
+    """Squared distance between two colors, weighted for how the eye sees them"""
+    red, green, blue = a[0] - b[0], a[1] - b[1], a[2] - b[2]
+    return 2 * red * red + 4 * green * green + 3 * blue * blue
+
+def choose_palette(histogram):
+    """Chooses the 16 colors of the Master System that best stand for the
+    colors of the histogram ((red, green, blue) -> count)"""
+    # The colors are first gathered around their nearest color of the
+    # Master System: the candidates are only 64, and the squared distance
+    # to a candidate is the one to their average, plus a constant
+    bins = {}
+    for color, count in histogram.iteritems():
+        key = sms_color(color)
+        totals = bins.setdefault(key, [0, 0, 0, 0])
+        totals[0] += count
+        for channel in range(3):
+            totals[channel + 1] += color[channel] * count
+    if len(bins) <= MAX_COLORS:
+        return [MASTER_PALETTE[key] for key in sorted(bins)]
+
+    # costs[bin][candidate]
+    costs = []
+    for count, red, green, blue in bins.itervalues():
+        average = (float(red) / count, float(green) / count, float(blue) / count)
+        costs.append([count * color_distance(average, candidate) for candidate in MASTER_PALETTE])
+    candidates = range(len(MASTER_PALETTE))
+
+    def total(chosen):
+        return sum(min(row[i] for i in chosen) for row in costs)
+
+    # Greedily, then swapping a color for another while it helps
+    chosen = []
+    best = [float('inf')] * len(costs)
+    while len(chosen) < MAX_COLORS:
+        added = min((i for i in candidates if not i in chosen),
+                    key=lambda i: sum(min(cost, row[i]) for cost, row in zip(best, costs)))
+        chosen.append(added)
+        best = [min(cost, row[added]) for cost, row in zip(best, costs)]
+
+    current = total(chosen)
+    improved = True
+    while improved:
+        improved = False
+        for slot in range(len(chosen)):
+            others = chosen[:slot] + chosen[slot + 1:]
+            rest = [min(row[i] for i in others) for row in costs]
+            for i in candidates:
+                if i in chosen:
+                    continue
+                swapped = sum(min(cost, row[i]) for cost, row in zip(rest, costs))
+                if swapped < current:
+                    chosen[slot] = i
+                    current = swapped
+                    improved = True
+    return [MASTER_PALETTE[i] for i in sorted(chosen)]
+
+def reduce_colors(data, dither=False):
+    """Reduces the contents of a PNG file with more than 16 colors to 16
+    colors of the Master System, optionally with ordered dithering; returns
+    a ReducedImage. The transparency is ignored"""
+    result = ReducedImage()
+    try:
+        width, height, pixels, color_type, depth, palette, transparency = read_png(data)
+    except PNGError as e:
+        result.error = 'not a valid PNG image: {0}'.format(e)
+        return result
+
+    counts = {}
+    for row in pixels:
+        for pixel in row:
+            counts[pixel] = counts.get(pixel, 0) + 1
+    result.colors = len(counts)
+    if len(counts) <= MAX_COLORS:
+        return result
+
+    # Pixel -> (red, green, blue), in 0-255
+    maximum = 255 if color_type == 3 else (1 << depth) - 1
+    colors = {}
+    histogram = {}
+    for pixel, count in counts.iteritems():
+        color = make_color(pixel, color_type, palette, transparency)
+        if len(color) <= 2:
+            color = color[:1] * 3
+        color = tuple((sample * 255 + maximum // 2) // maximum for sample in color[:3])
+        colors[pixel] = color
+        histogram[color] = histogram.get(color, 0) + count
+    reduced = choose_palette(histogram)
+
+    # (color, threshold) -> index in reduced
+    nearest = {}
+    def index(color, threshold):
+        key = color, threshold
+        if not key in nearest:
+            if threshold is not None:
+                offset = ((threshold + 0.5) / 16 - 0.5) * DITHER_SPREAD
+                color = tuple(min(255, max(0, sample + offset)) for sample in color)
+            nearest[key] = min(range(len(reduced)), key=lambda i: color_distance(color, reduced[i]))
+        return nearest[key]
+
+    rows = []
+    for y, row in enumerate(pixels):
+        thresholds = BAYER[y % 4] if dither else (None,) * 4
+        rows.append([index(colors[pixel], thresholds[x % 4]) for x, pixel in enumerate(row)])
+
+    # The most used colors first; the unused ones are left out
+    usage = [0] * len(reduced)
+    for row in rows:
+        for i in row:
+            usage[i] += 1
+    order = sorted((i for i in range(len(reduced)) if usage[i]), key=lambda i: (-usage[i], i))
+    numbers = dict((old, new) for new, old in enumerate(order))
+    result.png = write_png(width, height, [[numbers[i] for i in row] for row in rows], [reduced[i] for i in order])
+    result.reduced_colors = len(order)
+    return result
+
+def reduce_file(path, dither=False):
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except IOError as e:
+        result = ReducedImage()
+        result.error = "it can't be read: {0}".format(e.strerror)
+        return result
+    return reduce_colors(data, dither)
+
+
+class ImageChecker(object):
+    """Checks and converts images, keeping the results by the hash of their
+    contents; with a path, the results are also kept on disk between runs"""
+
+    FILE_NAME = '.twee2sam.images'
+    VERSION = 3
+
+    def __init__(self, path=None):
+        self.path = path
+        # (function name, content hash, settings...) -> ImageReport, TileData
+        # or ReducedImage
+        self.results = {}
+        if path:
+            self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                version, results = pickle.load(f)
+        except Exception:
+            # Missing or unreadable; the images will be processed again
+            return
+        if version == ImageChecker.VERSION:
+            self.results = results
+
+    def check(self, paths, content_hash, jobs=1):
+        """Returns the ImageReport of each image file; content_hash gives the
+        hash of a file's contents, or raises IOError or OSError"""
+        return self._process(analyze_file, paths, content_hash, jobs)
+
+    def convert(self, paths, content_hash, jobs=1):
+        """Returns the TileData of each image file"""
+        return self._process(convert_file, paths, content_hash, jobs)
+
+    def reduce(self, paths, content_hash, jobs=1, dither=False):
+        """Returns the ReducedImage of each image file"""
+        return self._process(reduce_file, paths, content_hash, jobs, (dither,))
+
+    def _process(self, function, paths, content_hash, jobs, settings=()):
+        keys = []
+        for path in paths:
+            try:
+                keys.append((function.__name__, content_hash(path)) + settings)
+            except (IOError, OSError):
+                keys.append(None)
+
+        # Each new content once; the unreadable ones are reported each time
+        pending = []
+        seen = set()
+        for key, path in zip(keys, paths):
+            if key is None or not (key in self.results or key in seen):
+                pending.append((key, path))
+                seen.add(key)
+        if jobs > 1 and len(pending) > 1:
+            pool = multiprocessing.Pool(min(jobs, len(pending)))
+            try:
+                results = pool.map(call, [(function, path, settings) for key, path in pending])
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            results = [function(path, *settings) for key, path in pending]
+
+        unhashed = {}
+        for (key, path), result in zip(pending, results):
+            if key is None:
+                unhashed[path] = result
+            else:
+                self.results[key] = result
+
+        if pending and self.path:
+            with open(self.path, 'wb') as f:
+                pickle.dump((ImageChecker.VERSION, self.results), f, pickle.HIGHEST_PROTOCOL)
+
+        return [self.results[key] if key is not None else unhashed[path] for key, path in zip(keys, paths)]
+
+
+def call(args):
+    # For the process pool
+    function, path, settings = args
+    return function(path, *settings)
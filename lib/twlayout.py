@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+
+"""Lays out the passage text at compile time: wraps it to the width of the
+SAM text window and starts a new page when the window or the text buffer
+would overflow, so the interpreter never has to wrap or cut anything.
+
+The position of the cursor can't always be known exactly (a block may or
+may not run, a number may have any width), so the layout keeps upper
+bounds of it; a line or page may end a bit early, but never late."""
+
+# Widest number SAM can print: -32768
+NUMBER_WIDTH = 6
+
+
+class TextLayout(object):
+    """Upper bounds of the cursor position and buffer use on the current page"""
+
+    def __init__(self, columns=28, rows=18, buffer_size=511):
+        self.columns = columns
+        self.rows = rows
+        self.buffer_size = buffer_size
+        self.col = 0
+        self.row = 0
+        self.chars = 0
+        # Page breaks so far
+        self.pages = 0
+
+    def copy(self):
+        layout = TextLayout(self.columns, self.rows, self.buffer_size)
+        layout.col, layout.row, layout.chars, layout.pages = self.col, self.row, self.chars, self.pages
+        return layout
+
+    def join(self, other):
+        """Merges the state of another path that leads to the same point"""
+        self.col = max(self.col, other.col)
+        self.row = max(self.row, other.row)
+        self.chars = max(self.chars, other.chars)
+        self.pages = max(self.pages, other.pages)
+
+    def page(self):
+        """The text was shown; the next one starts a new page"""
+        self.col = self.row = self.chars = 0
+        self.pages += 1
+
+    def advance(self, chars):
+        """Accounts for text that goes on the current line"""
+        self.col += chars
+        self.chars += chars
+
+    def lay_out(self, text):
+        """Returns the pieces to output for the text: strings, and None for
+        each page break"""
+        pieces = []
+        lines = text.split('\n')
+        for i, line in enumerate(lines):
+            if i:
+                self._newline(pieces)
+            words = line.split()
+            for j, word in enumerate(words):
+                self._word(pieces, word, j > 0)
+        return merge(pieces)
+
+    def number(self):
+        """Returns the pieces to output before printing a number"""
+        pieces = []
+        if self.col + NUMBER_WIDTH > self.columns:
+            self._newline(pieces)
+        if self.chars + NUMBER_WIDTH > self.buffer_size:
+            self._page(pieces)
+        self.advance(NUMBER_WIDTH)
+        return merge(pieces)
+
+    def append(self, other):
+        """Returns the pieces that make room for text that was laid out on
+        its own, from the start of a page, as the other layout; the text goes
+        on a new line, or on a new page if it doesn't fit or has page breaks"""
+        pieces = []
+        start = self.row + (1 if self.col else 0)
+        if (other.pages or start + other.row >= self.rows or
+                self.chars + 1 + other.chars > self.buffer_size):
+            if self.col or self.row or self.chars:
+                self._page(pieces)
+        elif self.col:
+            self._newline(pieces)
+
+        if other.pages:
+            self.col, self.row, self.chars = other.col, other.row, other.chars
+            self.pages += other.pages
+        else:
+            self.col = other.col
+            self.row += other.row
+            self.chars += other.chars
+        return merge(pieces)
+
+    def _word(self, pieces, word, spaced):
+        if not word:
+            return
+        space = ' ' if spaced and self.col else ''
+        if self.col + len(space) + len(word) > self.columns:
+            if self.col:
+                self._newline(pieces)
+            space = ''
+            while len(word) > self.columns:
+                # Longer than a line; cut it
+                self._put(pieces, word[:self.columns])
+                word = word[self.columns:]
+                self._newline(pieces)
+        self._put(pieces, space + word)
+
+    def _put(self, pieces, text):
+        if self.chars + len(text) > self.buffer_size:
+            self._page(pieces)
+            text = text.lstrip(' ')
+        pieces.append(text)
+        self.advance(len(text))
+
+    def _newline(self, pieces):
+        if self.row + 1 >= self.rows or self.chars + 1 > self.buffer_size:
+            self._page(pieces)
+        else:
+            pieces.append('\n')
+            self.col = 0
+            self.row += 1
+            self.chars += 1
+
+    def _page(self, pieces):
+        pieces.append(None)
+        self.page()
+
+
+def merge(pieces):
+    """Joins the consecutive strings"""
+    result = []
+    for piece in pieces:
+        if piece is not None and result and result[-1] is not None:
+            result[-1] += piece
+        else:
+            result.append(piece)
+    return result
@@ -8,53 +8,75 @@ __version__ = "0.2"
 class TwParser(object):
     """Parses a TiddlyWiki object into an AST"""
 
-    def __init__(self, tw):
+    def __init__(self, tw, lazy=False, previous=None):
         self.passages = {}
-        self._parse(tw)
+        self.lazy = lazy
+        self._parse(tw, previous.passages if previous else {})
 
     def __repr__(self):
 #		return "<TwParser\n" + '\n'.join(["\t" + str(psg) for psg in self.passages.values()]) + ">"
         return "<TwParser {0}>".format(ident_list(self.passages.values()))
 
-    def _parse(self, tw):
-        """Parses the TiddlyWiki object"""
+    def _parse(self, tw, previous):
+        """Parses the TiddlyWiki object, reusing the unchanged passages of a previous parse"""
         for tiddler in tw.tiddlers.values():
-            self._parse_tiddler(tiddler)
+            passage = previous.get(tiddler.title)
+            if passage and passage.text == tiddler.text:
+                self.passages[passage.title] = passage
+            else:
+                self._parse_tiddler(tiddler)
 
     def _parse_tiddler(self, tiddler):
         """Parses a Tiddler object"""
-        passage = Passage(tiddler)
+        passage = Passage(tiddler, self.lazy)
         self.passages[passage.title] = passage
 
 
 class Passage(object):
     """Represents a parsed passage"""
 
-    RE_ITEM_LIST = re.compile(r'^([#\*])\s(.*)$', flags=re.MULTILINE)
-    RE_MACRO = re.compile(r'\<\<(\w+)(\s*.*?)\>\>')
-    RE_LINK = re.compile(r'\[\[(.*?)\]\]')
-    RE_IMG = re.compile(r'\[img\[(.*?)\]\]')
-    RE_TEXT = re.compile(r'(.*)', flags=re.DOTALL)
-
-    def __init__(self, tiddler):
+    # Single combined pattern: list items, macros, images and links.
+    # Anything in between is text. The token that starts first wins, as in
+    # Twine, and the order of the alternatives only matters for tokens that
+    # start at the same position. (The tokenizer this replaced looked for
+    # each kind in turn, so a macro inside a link, as in [[a|b<<c>>]],
+    # split the link into text, the macro and text; it is now a link.)
+    RE_TOKEN = re.compile(r"""
+        ^(?P<list>[#\*])\s(?P<item>.*)$
+        | \<\<(?P<macro>\w+)(?P<params>\s*.*?)\>\>
+        | \[img\[(?P<image>.*?)\]\]
+        | \[\[(?P<link>.*?)\]\]
+        """, flags=re.MULTILINE | re.VERBOSE)
+
+    def __init__(self, tiddler, lazy=False):
         self.title = tiddler.title
-        self.commands = []
-        self._parse(tiddler)
+        self.text = tiddler.text
+        self.warnings = []
+        self._commands = None
+        if not lazy:
+            self._parse()
 
     def __repr__(self):
         return "<Passage {0}{1}>".format(self.title, ident_list(self.commands))
 
-    def _parse(self, tiddler):
-        tokens = self._tokenize(tiddler)
+    @property
+    def commands(self):
+        """The parsed commands; a lazy passage is only parsed on first access"""
+        if self._commands is None:
+            self._parse()
+        return self._commands
+
+    def _parse(self):
+        self.warnings = []
+        tokens = self._tokenize(self.text)
         self._block_stack = []
-        self.commands += self._parse_commands(tokens)
+        self._commands = self._parse_commands(tokens)
 
     def _parse_commands(self, tokens):
+        """Consumes tokens from the iterator until the end of the current block"""
         commands = []
-        close_block = False
 
-        while tokens and not close_block:
-            token = tokens.pop(0)
+        for token in tokens:
             tk_type = token[0]
             if tk_type == 'tx':
                 commands.append(TextCmd(token))
@@ -62,81 +84,50 @@ class Passage(object):
                 macro = self._parse_macro(token, tokens)
                 if macro:
                     if isinstance(macro, EndMacro):
-                        close_block = True
-                    else:
-                        commands.append(macro)
+                        break
+                    commands.append(macro)
             elif tk_type == 'im':
                 commands.append(ImageCmd(token))
             elif tk_type == 'lk':
                 commands.append(LinkCmd(token))
             elif tk_type in ('ul','ol'):
-                commands.append(ListCmd(token, self._parse_commands(token[1])))
+                commands.append(ListCmd(token, self._parse_commands(iter(token[1]))))
 
         return commands
 
     # Well, it's not really a tokenizer, more like a 1st level parser, but meh.
-    def _tokenize(self, tiddler):
+    def _tokenize(self, text):
         # Remove the line continuations (\ followed by line break)
-        source = re.sub(r'\\[ \t]*\n', '', str(tiddler.text))
+        source = re.sub(r'\\[ \t]*\n', '', str(text))
         return self._tokenize_string(source)
 
     def _tokenize_string(self, string):
-        def test_command(string, remaining_tests):
-            # Determine what will be checked
-            if not remaining_tests:
-                return []
-
-            regex, action, skipped_chars = remaining_tests[0]
-            remaining_tests = remaining_tests[1:]
-
-            # Starts checking for snippets matching the regex
-            tokens = []
-
-            st_pos = 0
-            st_len = len(string)
-            for item in regex.finditer(string):
-                # Processes preceding non-matching text
-                it_st = item.start()
-                if st_pos < it_st and st_pos < st_len:
-                    tokens += test_command(string[st_pos:it_st], remaining_tests)
-                st_pos = item.end() + skipped_chars
-
-                # Executes the action
-                tokens += action(item)
-
-            # Processes remaining text, if any.
-            if st_pos < st_len:
-                tokens += test_command(string[st_pos:st_len], remaining_tests)
-
-            return tokens
-
-        def process_item_list(match):
-            kind = match.group(1)
-            contents = match.group(2)
-            list_type = 'ul' if kind == '*' else 'ol'
-            return [(list_type, self._tokenize_string(contents.strip()))]
-
-        def process_macro(match):
-            return [('mc', (match.group(1), match.group(2)))]
-
-        def process_image(match):
-            return [('im', match.group(1))]
-
-        def process_link(match):
-            return [('lk', match.group(1))]
-
-        def process_text(match):
-            return [('tx', match.group(1))]
-
-        tests = [
-            (Passage.RE_ITEM_LIST, process_item_list, 1),
-            (Passage.RE_MACRO, process_macro, 0),
-            (Passage.RE_IMG, process_image, 0),
-            (Passage.RE_LINK, process_link, 0),
-            (Passage.RE_TEXT, process_text, 0)
-        ]
-
-        return test_command(string, tests)
+        """Scans the string in a single pass, yielding the tokens in order"""
+        st_pos = 0
+        st_len = len(string)
+        while st_pos < st_len:
+            item = Passage.RE_TOKEN.search(string, st_pos)
+            if not item:
+                yield ('tx', string[st_pos:])
+                return
+
+            # Processes preceding non-matching text
+            it_st = item.start()
+            if st_pos < it_st:
+                yield ('tx', string[st_pos:it_st])
+            st_pos = item.end()
+
+            if item.group('list') is not None:
+                list_type = 'ul' if item.group('list') == '*' else 'ol'
+                yield (list_type, list(self._tokenize_string(item.group('item').strip())))
+                # Skips the line break that ends the list item
+                st_pos += 1
+            elif item.group('macro') is not None:
+                yield ('mc', (item.group('macro'), item.group('params')))
+            elif item.group('image') is not None:
+                yield ('im', item.group('image'))
+            else:
+                yield ('lk', item.group('link'))
 
     def _parse_macro(self, token, tokens):
         kind, params = token[1]
@@ -178,7 +169,7 @@ class Passage(object):
         return if_macro
 
     def _warning(self, msg):
-        print('Warning on {0}: {1}'.format(self.title, msg))
+        self.warnings.append(msg)
 
 class AbstractCmd(object):
     """Base class for the different kinds of commands"""
@@ -335,7 +326,6 @@ class CallMacro(AbstractMacro):
 
         match = CallMacro.RE_CALL.match(params.lstrip().rstrip())
         if match:
-            print("CallMacro: Call subroutine %s %s" % (kind, params))
             self.target = match.group(1)
             self.expr = self.target
             return
@@ -344,7 +334,6 @@ class ReturnMacro(AbstractMacro):
     """Class for a return-from-subroutine macro"""
 
     def _parse(self, token):
-        print("ReturnMacro: Return from subroutine")
         self.expr = True
         return
 
@@ -0,0 +1,363 @@
+# -*- coding: utf-8 -*-
+
+"""SAM script operations, and the optimization passes that run over them
+before they are rendered as .twsam text.
+
+The operands are kept as the text the code generator produced for them
+(expressions, variable references, the placeholders of images and music),
+so the passes only see the structure they need."""
+
+import re
+from collections import OrderedDict
+
+# The text buffer holds 512 chars, including the terminator
+MAX_STRING = 511
+
+
+class Op(object):
+    """A SAM operation"""
+
+    # True if the operation may add text to the buffer
+    prints = False
+    # The code of an operation without operands
+    code = ''
+
+    def render(self, out):
+        out(self.code)
+
+    def __repr__(self):
+        return '{0}{1!r}'.format(self.__class__.__name__, tuple(self.__dict__.values()))
+
+class Text(Op):
+    """Appends a string to the text buffer"""
+    prints = True
+
+    def __init__(self, text):
+        self.text = text
+
+    def render(self, out):
+        out('"{0}"\n'.format(self.text))
+
+class Print(Op):
+    """Appends the value of an expression to the text buffer"""
+    prints = True
+
+    def __init__(self, expr):
+        self.expr = expr
+
+    def render(self, out):
+        out(self.expr)
+        out('"\\#"')
+
+class Flush(Op):
+    """Shows the text buffer and waits for a button; a soft flush is only
+    there to show the pending text, so it can go if the buffer is empty"""
+
+    code = '!\n'
+
+    def __init__(self, soft=False):
+        self.soft = soft
+
+class Image(Op):
+    def __init__(self, ref):
+        self.ref = ref
+
+    def render(self, out):
+        out('{0}i\n'.format(self.ref))
+
+class Music(Op):
+    def __init__(self, ref):
+        self.ref = ref
+
+    def render(self, out):
+        out('{0}m\n'.format(self.ref))
+
+class Set(Op):
+    """Stores the value of an expression into a variable"""
+
+    def __init__(self, expr, var):
+        self.expr = expr
+        self.var = var
+
+    def render(self, out):
+        out(self.expr)
+        out(' ')
+        out(self.var + '\n')
+
+class SetFlag(Op):
+    """Sets a variable to 1"""
+
+    def __init__(self, var):
+        self.var = var
+
+    def render(self, out):
+        out('1' + self.var)
+
+class ClearFlag(Op):
+    """Sets a variable to 0"""
+
+    def __init__(self, var):
+        self.var = var
+
+    def render(self, out):
+        out('0' + self.var + '\n')
+
+class Block(Op):
+    """Runs the body if the condition is true"""
+
+    def __init__(self, cond, body, compact=False):
+        self.cond = cond
+        self.body = body
+        self.compact = compact
+
+    def render(self, out):
+        out(self.cond)
+        out('[' if self.compact else '[\n')
+        render_ops(self.body, out)
+        out('0]\n' if self.compact else ' 0]\n')
+
+class Call(Op):
+    """Runs another script, which comes back with a Return"""
+
+    def __init__(self, target):
+        self.target = target
+
+    def render(self, out):
+        out('{0}c\n'.format(self.target))
+
+class Return(Op):
+    code = '$\n'
+
+class Choice(Op):
+    """Shows the menu and stores the chosen option into A"""
+    code = '?A.\n'
+
+class MenuStart(Op):
+    """Resets B, the option being matched against A"""
+    code = '0B.\n'
+
+class MenuCase(Op):
+    """Jumps to the target if it's the chosen option, then moves to the next option"""
+
+    def __init__(self, target, increment=True):
+        self.target = target
+        self.increment = increment
+
+    def render(self, out):
+        out('A:B:=[{0}j]'.format(self.target))
+        if self.increment:
+            out('B:1+B.')
+        out('\n')
+
+class MenuRemap(Op):
+    """Turns the chosen option in A into the number of the link, skipping
+    the links whose conditions were false and so weren't shown"""
+
+    def __init__(self, conditions):
+        # (link number, code that reads its condition)
+        self.conditions = conditions
+
+    def render(self, out):
+        for link, cond in self.conditions:
+            # A = A + (not cond) * (A >= link)
+            if link:
+                out('A:{0}0=A:{1}<0=*+A.\n'.format(cond, link))
+            else:
+                out('A:{0}0=+A.\n'.format(cond))
+
+class MenuDispatch(Op):
+    """Jumps to the target of the link numbered A"""
+
+    def __init__(self, targets):
+        self.targets = targets
+
+    def render(self, out):
+        out(dispatch_code(self.targets))
+        out('\n')
+
+def dispatch_code(targets):
+    """Computes the target directly if the targets are evenly spaced, or
+    else finds it with a binary search on A"""
+    first = targets[0]
+    step = targets[1] - first if len(targets) > 1 else 0
+    if all(target == first + i * step for i, target in enumerate(targets)):
+        if step == 0:
+            return '{0}j'.format(first)
+        scale = '{0}*'.format(abs(step)) if abs(step) != 1 else ''
+        if step > 0:
+            return 'A:' + scale + ('{0}+'.format(first) if first else '') + 'j'
+        return '{0}A:{1}-j'.format(first, scale)
+
+    def search(lo, hi):
+        if hi - lo == 1:
+            return '{0}j'.format(targets[lo])
+        mid = (lo + hi) // 2
+        # The jumps leave the script, so the blocks need no '0]'
+        return 'A:{0}<['.format(mid) + search(lo, mid) + ']' + search(mid, hi)
+    return search(0, len(targets))
+
+# Roughly one interpreter step per number, variable access or operator
+RE_STEP = re.compile(r'\d+|\x00v\d+\x00[:.]|[A-Z][:.]|\S')
+
+def code_steps(code):
+    return len(RE_STEP.findall(code))
+
+def menu_cost(targets, conditional, indexed):
+    """Estimates the (bytes, average steps per choice) of dispatching a menu,
+    with the direct or binary search dispatch or with the compare chain"""
+    count = len(targets)
+    if indexed:
+        remap = ''.join('A:X:0=A:{0}<0=*+A.\n'.format(i) for i in range(count) if conditional[i])
+        code = dispatch_code(targets)
+        # Every choice runs the remap, then one path of the search
+        steps = code_steps(remap) + (code_steps(code) if not '[' in code else
+                                     float(sum(search_steps(targets, i) for i in range(count))) / count)
+        return len(remap) + len(code) + 1, steps
+
+    size = len('0B.\n')
+    steps = []
+    before = 2
+    for i, target in enumerate(targets):
+        case = 'A:B:=[{0}j]B:1+B.\n'.format(target)
+        guard = 'X:[0]\n' if conditional[i] else ''
+        size += len(case) + len(guard)
+        steps.append(before + code_steps('A:B:=[{0}j'.format(target)) + code_steps(guard) / 2)
+        before += code_steps(case) + code_steps(guard)
+    return size, float(sum(steps)) / count
+
+def search_steps(targets, index):
+    """Steps the binary search takes to reach the given link"""
+    steps = 0
+    lo, hi = 0, len(targets)
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        steps += code_steps('A:{0}<['.format(mid))
+        if index < mid:
+            hi = mid
+        else:
+            lo = mid
+    return steps + code_steps('{0}j'.format(targets[index]))
+
+class Halt(Op):
+    """Loops forever"""
+    code = '1[1]\n'
+
+
+def render_ops(ops, out):
+    for op in ops:
+        op.render(out)
+
+def render(ops):
+    script = []
+    render_ops(ops, script.append)
+    return ''.join(script)
+
+
+#
+# Optimization passes
+#
+
+# name -> function taking a list of ops and returning the optimized list
+PASSES = OrderedDict()
+
+def register_pass(name):
+    """Decorator that makes a pass available to optimize() under the given name"""
+    def register(function):
+        PASSES[name] = function
+        return function
+    return register
+
+def optimize(ops, passes):
+    """Runs the named passes in order, repeating them until the script stops changing"""
+    for name in passes:
+        if not name in PASSES:
+            raise ValueError('Unknown optimization pass: {0}'.format(name))
+
+    text = render(ops)
+    for attempt in range(8):
+        for name in passes:
+            ops = PASSES[name](ops)
+        new_text = render(ops)
+        if new_text == text:
+            break
+        text = new_text
+    return ops
+
+
+def transform_blocks(ops, function):
+    """Applies a pass to the body of every block, innermost first"""
+    for op in ops:
+        if isinstance(op, Block):
+            op.body = function(transform_blocks(op.body, function))
+    return ops
+
+
+@register_pass('peephole')
+def peephole(ops):
+    """Merges adjacent strings, drops the empty ones, and drops the
+    increment after the last menu case"""
+    def merge(ops):
+        result = []
+        for op in ops:
+            if isinstance(op, Text):
+                if not op.text:
+                    continue
+                last = result[-1] if result else None
+                if isinstance(last, Text) and len(last.text) + len(op.text) <= MAX_STRING:
+                    result[-1] = Text(last.text + op.text)
+                    continue
+            result.append(op)
+        return result
+
+    ops = merge(transform_blocks(ops, merge))
+
+    # Nothing reads B after the last case, conditional or not
+    last = ops[-1] if ops else None
+    if isinstance(last, Block) and last.body:
+        last = last.body[-1]
+    if isinstance(last, MenuCase):
+        last.increment = False
+    return ops
+
+
+@register_pass('flushes')
+def remove_redundant_flushes(ops):
+    """Drops the soft flushes that can only find the text buffer empty"""
+    def walk(ops, empty):
+        result = []
+        for op in ops:
+            if isinstance(op, Flush):
+                if op.soft and empty:
+                    continue
+                empty = True
+            elif isinstance(op, Block):
+                op.body, body_empty = walk(op.body, empty)
+                empty = empty and body_empty
+            elif op.prints or isinstance(op, (Call, Choice)):
+                empty = False
+            result.append(op)
+        return result, empty
+
+    # The caller of a script may have left text in the buffer
+    return walk(ops, False)[0]
+
+
+@register_pass('blocks')
+def remove_empty_blocks(ops):
+    """Drops the blocks with nothing inside, unless their condition draws a
+    random number, and the ones whose condition is a constant"""
+    def remove(ops):
+        result = []
+        for op in ops:
+            if isinstance(op, Block):
+                cond = op.cond.strip()
+                if cond == '1':
+                    result.extend(op.body)
+                    continue
+                if cond == '0' or (not op.body and not 'r' in cond):
+                    continue
+            result.append(op)
+        return result
+    return remove(transform_blocks(ops, remove))
+
+DEFAULT_PASSES = tuple(PASSES)
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+
+"""Story-wide string pool: the runs of text lines that are repeated across
+the scripts are moved into shared scripts that print them and return, and
+every copy is replaced with a call to the shared script.
+
+SAM appends each string to the text buffer, so printing a phrase from
+another script leaves the same text as printing it inline. The phrases are
+whole lines (as laid out), so the pool never splits a word; one is only
+shared when the calls take fewer bytes than the copies they replace."""
+
+import re
+from collections import defaultdict
+
+# Estimated bytes each script takes in the ROM besides its text, for its
+# entry in the script table
+SCRIPT_OVERHEAD = 4
+
+# Longest run of lines considered as a phrase
+MAX_PHRASE_LINES = 24
+
+RE_STRING = re.compile(r'"[^"]*"\n?')
+RE_LINE = re.compile(r'[^\n]*\n|[^\n]+')
+RE_CALL = re.compile(r'(?<!\d)(\d+)c\n')
+
+
+class Literal(object):
+    """A string literal, as a list of lines and of the indexes of the pool
+    scripts that replaced some of them"""
+
+    def __init__(self, text):
+        self.items = RE_LINE.findall(text)
+
+    def find(self, lines):
+        """Positions of the non-overlapping runs of lines equal to the given ones"""
+        found = []
+        i = 0
+        while i + len(lines) <= len(self.items):
+            if self.items[i:i + len(lines)] == lines:
+                found.append(i)
+                i += len(lines)
+            else:
+                i += 1
+        return found
+
+    def saving(self, position, count, text_length, call_length):
+        """Bytes saved by calling the phrase instead of printing it there"""
+        before = position == 0 or not isinstance(self.items[position - 1], basestring)
+        after = (position + count == len(self.items) or
+                 not isinstance(self.items[position + count], basestring))
+        saving = text_length - call_length
+        if before and after:
+            # The whole literal goes
+            saving += 3
+        elif not before and not after:
+            # The text on each side needs a literal of its own
+            saving -= 3
+        return saving
+
+    def render(self, numbers=None):
+        code = []
+        text = []
+        for item in self.items:
+            if isinstance(item, basestring):
+                text.append(item)
+                continue
+            if text:
+                code.append('"{0}"\n'.format(''.join(text)))
+                text = []
+            code.append('{0}c\n'.format(numbers[item] if numbers else item))
+        if text:
+            code.append('"{0}"\n'.format(''.join(text)))
+        return ''.join(code)
+
+
+def tokenize(script):
+    """Splits a script into its text literals and the code around them"""
+    tokens = []
+    last = 0
+    for match in RE_STRING.finditer(script):
+        string = match.group(0)
+        # Only the whole statements of plain text; not "\#" and the like
+        if string.endswith('\n') and not '\\' in string:
+            tokens.append(script[last:match.start()])
+            tokens.append(Literal(string[1:-2]))
+            last = match.end()
+    tokens.append(script[last:])
+    return tokens
+
+def pool_script(phrase):
+    return '"{0}"\n$\n'.format(phrase)
+
+def pool_strings(scripts, first_index, previous=()):
+    """Shares the phrases repeated across the scripts; returns the new
+    scripts, and the phrases of the pool scripts, numbered from first_index.
+
+    previous holds the phrases of the previous build, in the same order:
+    the ones still worth sharing keep their numbers and the new ones take
+    the free numbers, so an edit only changes the scripts that it touches"""
+    tokenized = [tokenize(script) for script in scripts]
+
+    # Phrase -> literals it appears in
+    where = defaultdict(list)
+    for tokens in tokenized:
+        for token in tokens:
+            if not isinstance(token, Literal):
+                continue
+            items = token.items
+            for start in range(len(items)):
+                phrase = ''
+                for end in range(start, min(len(items), start + MAX_PHRASE_LINES)):
+                    phrase += items[end]
+                    if where[phrase] and where[phrase][-1] is token:
+                        continue
+                    where[phrase].append(token)
+
+    def estimate(phrase):
+        # As if every copy were in the middle of a literal
+        call_length = len(str(first_index)) + 2
+        return len(where[phrase]) * (len(phrase) - call_length - 3) - len(pool_script(phrase)) - SCRIPT_OVERHEAD
+
+    candidates = [phrase for phrase, literals in where.iteritems() if len(literals) > 1 and estimate(phrase) > 0]
+    candidates.sort(key=lambda phrase: (-estimate(phrase), phrase))
+    previous_slots = dict((phrase, slot) for slot, phrase in enumerate(previous))
+    candidates = ([phrase for phrase in previous if len(where.get(phrase, ())) > 1] +
+                  [phrase for phrase in candidates if not phrase in previous_slots])
+
+    # Phrase -> number of its pool script, counted from 0
+    slots = {}
+    free = None
+    next_slot = len(previous)
+    for phrase in candidates:
+        lines = RE_LINE.findall(phrase)
+        if phrase in previous_slots:
+            slot = previous_slots[phrase]
+        else:
+            if free is None:
+                # The previous phrases come first, so the numbers they left are known
+                taken = set(slots.itervalues())
+                free = [slot for slot in range(len(previous)) if not slot in taken]
+            slot = free[0] if free else next_slot
+        index = first_index + slot
+        call_length = len(str(index)) + 2
+        uses = []
+        saving = -len(pool_script(phrase)) - SCRIPT_OVERHEAD
+        for literal in where[phrase]:
+            for position in literal.find(lines):
+                uses.append((literal, position))
+                saving += literal.saving(position, len(lines), len(phrase), call_length)
+        if len(uses) < 2 or saving <= 0:
+            continue
+        # Replaces from the end, so the positions stay valid
+        for literal, position in reversed(uses):
+            literal.items[position:position + len(lines)] = [index]
+        slots[phrase] = slot
+        if not phrase in previous_slots:
+            if free:
+                free.pop(0)
+            else:
+                next_slot += 1
+
+    # The pool scripts are numbered without gaps: the last ones fill the
+    # numbers the previous phrases that are gone left free
+    count = len(slots)
+    holes = sorted(set(range(count)) - set(slots.itervalues()))
+    moved = sorted((slot, phrase) for phrase, slot in slots.iteritems() if slot >= count)
+    numbers = dict((first_index + slot, first_index + slot) for slot in slots.itervalues())
+    for hole, (slot, phrase) in zip(holes, moved):
+        slots[phrase] = hole
+        numbers[first_index + slot] = first_index + hole
+    phrases = [phrase for slot, phrase in sorted((slot, phrase) for phrase, slot in slots.iteritems())]
+
+    return [''.join(token.render(numbers) if isinstance(token, Literal) else token for token in tokens)
+            for tokens in tokenized], phrases
+
+
+#
+# Reference decoder
+#
+
+def expand(script, phrases, first_index):
+    """Replaces the calls to the pool scripts with the phrases they print"""
+    def replace(match):
+        index = int(match.group(1)) - first_index
+        if 0 <= index < len(phrases):
+            return '"{0}"\n'.format(phrases[index])
+        return match.group(0)
+    return ''.join(RE_CALL.sub(replace, token) if not isinstance(token, Literal) else token.render()
+                   for token in tokenize(script))
+
+def normalize(script):
+    """Joins the adjacent text literals, which SAM prints as one"""
+    tokens = []
+    for token in tokenize(script):
+        if isinstance(token, Literal) and len(tokens) > 1 and tokens[-1] == '' and isinstance(tokens[-2], Literal):
+            tokens.pop()
+            tokens[-1].items += token.items
+        else:
+            tokens.append(token)
+    return ''.join(token.render() if isinstance(token, Literal) else token for token in tokens)
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+
+"""Shared by the tests: makes the lib modules and the tw submodule
+importable, and finds the example stories"""
+
+import os, sys, glob
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(ROOT, 'lib'), os.path.join(ROOT, 'tw')]
+
+EXAMPLES = os.path.join(ROOT, 'example')
+
+def example_twee_files():
+    """Returns the path of every twee source under the examples"""
+    return [path for path in sorted(glob.glob(os.path.join(EXAMPLES, '*', 'tw', '*.txt')) +
+                                    glob.glob(os.path.join(EXAMPLES, '*', 'tw', '*', '*.twee')))
+            if not path.endswith('.inf.txt')]
+
+def example_stories():
+    """Returns the (example name, twee source) of the story of each example,
+    the one twee2sam is run on"""
+    stories = []
+    for path in example_twee_files():
+        if os.path.basename(os.path.dirname(path)) == 'tw':
+            with open(path) as f:
+                stories.append((path.split(os.sep)[-3], f.read().decode('utf-8-sig')))
+    return stories
+
+def example_images():
+    """Returns the path of every PNG image of the examples"""
+    return sorted(glob.glob(os.path.join(EXAMPLES, '*', 'tw', '*.png')) +
+                  glob.glob(os.path.join(EXAMPLES, '*', 'tw', 'img', '*.png')))
+
+def twee(passages):
+    """Returns the twee source of a story, given as (title, text) pairs"""
+    return u''.join(u':: {0}\n{1}\n\n'.format(title, text) for title, text in passages)
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+import errno, os, shutil, tempfile, unittest
+import support
+import twassets
+from twassets import AssetStager
+from twcompiler import compile_story, CompileOptions
+
+
+class FailingFcntl(object):
+    """Stands for a filesystem without reflinks"""
+
+    def ioctl(self, fd, request, arg):
+        raise IOError(errno.EOPNOTSUPP, 'Operation not supported')
+
+
+class AssetStagerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.fcntl, self.link = twassets.fcntl, getattr(os, 'link', None)
+
+    def tearDown(self):
+        twassets.fcntl = self.fcntl
+        if self.link:
+            os.link = self.link
+        shutil.rmtree(self.directory)
+
+    def path(self, *parts):
+        return os.path.join(self.directory, *parts)
+
+    def write(self, name, data):
+        path = self.path(name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def read(self, name):
+        with open(self.path(name), 'rb') as f:
+            return f.read()
+
+    def no_hardlinks(self, src, dst):
+        raise OSError(errno.EXDEV, 'Invalid cross-device link')
+
+    def test_falls_back_to_hardlink(self):
+        twassets.fcntl = FailingFcntl()
+        src = self.write('door.png', 'door')
+        self.assertEqual(AssetStager().stage(src, self.path('out.png')), 'linked')
+        self.assertEqual(os.stat(src).st_ino, os.stat(self.path('out.png')).st_ino)
+
+    def test_falls_back_to_copy(self):
+        twassets.fcntl = FailingFcntl()
+        os.link = self.no_hardlinks
+        src = self.write('door.png', 'door')
+        self.assertEqual(AssetStager().stage(src, self.path('out.png')), 'copied')
+        self.assertNotEqual(os.stat(src).st_ino, os.stat(self.path('out.png')).st_ino)
+        self.assertEqual(self.read('out.png'), 'door')
+
+    def test_copy_assets(self):
+        src = self.write('door.png', 'door')
+        stager = AssetStager(links=False)
+        self.assertEqual(stager.stage(src, self.path('out.png')), 'copied')
+        # An edit in the destination leaves the source alone
+        self.write('out.png', 'edited')
+        self.assertEqual(self.read('door.png'), 'door')
+
+    def test_unchanged_rebuild_is_kept(self):
+        src = self.write('door.png', 'door')
+        dst = self.path('out', 'door.png')
+        os.mkdir(self.path('out'))
+        saved = self.path('out', AssetStager.FILE_NAME)
+        stager = AssetStager(saved)
+        self.assertNotEqual(stager.stage(src, dst), 'kept')
+        stager.commit()
+        self.assertEqual(stager.counts, {})
+
+        # Through the file, as a new run would
+        stager = AssetStager(saved)
+        self.assertEqual(stager.stage(src, dst), 'kept')
+        self.assertEqual(stager.counts, {'kept': 1})
+
+    def test_changed_source_is_staged_again(self):
+        twassets.fcntl = FailingFcntl()
+        os.link = self.no_hardlinks
+        src = self.write('door.png', 'door')
+        stager = AssetStager()
+        stager.stage(src, self.path('out.png'))
+        os.remove(src)
+        self.write('door.png', 'open door')
+        self.assertEqual(stager.stage(src, self.path('out.png')), 'copied')
+        self.assertEqual(self.read('out.png'), 'open door')
+
+    def test_existing_identical_file_is_kept(self):
+        src = self.write('door.png', 'door')
+        self.write('out.png', 'door')
+        self.assertEqual(AssetStager().stage(src, self.path('out.png')), 'kept')
+
+    def compile_images(self, images):
+        stager = AssetStager()
+        text = support.twee([('Start', ''.join('[img[{0}]]Room.\n'.format(image) for image in images))])
+        return compile_story([text], CompileOptions(asset_id=lambda path: stager.content_hash(self.path(path))))
+
+    def test_duplicate_content_is_merged(self):
+        self.write('a/door.png', 'door')
+        self.write('b/gate.png', 'door')
+        self.write('c/wall.png', 'wall')
+        result = self.compile_images(['a/door.png', 'b/gate.png', 'c/wall.png'])
+        self.assertEqual(result.merged_assets, [('b/gate.png', 'a/door.png')])
+        self.assertEqual(result.assets, [('a/door.png', 'door.png'), ('c/wall.png', 'wall.png')])
+        self.assertEqual(result.scripts['Start.twsam'].count('0i'), 2)
+
+    def test_name_collision_is_reported(self):
+        self.write('a/door.png', 'red door')
+        self.write('b/door.png', 'blue door')
+        result = self.compile_images(['a/door.png', 'b/door.png'])
+        self.assertEqual(result.merged_assets, [])
+        self.assertEqual(result.assets, [('a/door.png', 'door.png'), ('b/door.png', 'door_2.png')])
+        warnings = [message for kind, message in result.diagnostics if kind == 'warning']
+        self.assertEqual(len(warnings), 1)
+        self.assertTrue('door_2' in warnings[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
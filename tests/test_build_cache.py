@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+import os, shutil, tempfile, unittest
+import support
+from twcompiler import compile_story, CompileOptions, CompileSession, BuildCache
+
+STORY = [
+    ('Start', '<<set $door to true>><<set $lamp to false>>You wake up.\n[[Hall]]\n[[Cellar]]'),
+    ('Hall', '<<if $door>>The door is open.<<endif>>\n<<if $lamp>>[[Cellar]]<<endif>>\n[[Start]]'),
+    ('Cellar', 'It is dark.<<set $lamp to true>>\n[[Hall]]'),
+]
+
+def edit(passages, title, text):
+    return [(name, text if name == title else body) for name, body in passages]
+
+
+class BuildCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, BuildCache.FILE_NAME)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def assertRebuildMatchesFresh(self, before, after, **options):
+        options = CompileOptions(**options)
+        session = CompileSession(BuildCache(self.path))
+        compile_story([support.twee(before)], options, session)
+        # Through the file, as a new run would
+        session = CompileSession(BuildCache(self.path))
+        rebuilt = compile_story([support.twee(after)], options, session)
+        fresh = compile_story([support.twee(after)], options)
+        self.assertEqual(list(rebuilt.files()), list(fresh.files()))
+        return rebuilt
+
+    def test_unchanged(self):
+        rebuilt = self.assertRebuildMatchesFresh(STORY, STORY)
+        self.assertEqual((rebuilt.reused, rebuilt.regenerated), (3, 0))
+
+    def test_flag_becomes_numeric(self):
+        # $lamp isn't packed with $door any more, so Start and Hall change too
+        rebuilt = self.assertRebuildMatchesFresh(STORY, edit(STORY, 'Cellar', 'It is dark.<<set $lamp to 3>>\n[[Hall]]'))
+        self.assertEqual(rebuilt.reused, 0)
+
+    def test_passage_numbering_changes(self):
+        # Attic comes before Cellar, which gets a new number
+        after = STORY[:2] + [('Attic', 'Dusty.\n[[Cellar]]')] + STORY[2:]
+        after = edit(after, 'Hall', STORY[1][1] + '\n[[Attic]]')
+        rebuilt = self.assertRebuildMatchesFresh(STORY, after)
+        self.assertTrue(rebuilt.regenerated >= 2)
+
+    def test_string_pool_and_subroutines(self):
+        room = 'A long description of the room, worth sharing between passages.\n<<display Note>>\n[[Start]]'
+        before = STORY + [('Note', 'Something is written on the wall, in small letters.'),
+                          ('Room 1', room), ('Room 2', room)]
+        after = edit(before, 'Room 2', room.replace('long', 'short'))
+        self.assertRebuildMatchesFresh(before, after, string_pool=True)
+
+    def test_other_version_is_ignored(self):
+        cache = BuildCache(self.path)
+        cache.version = ('0.0', '0.0')
+        compile_story([support.twee(STORY)], CompileOptions(), CompileSession(cache))
+        rebuilt = compile_story([support.twee(STORY)], CompileOptions(), CompileSession(BuildCache(self.path)))
+        self.assertEqual(rebuilt.reused, 0)
+
+    def test_unreadable_file_is_ignored(self):
+        with open(self.path, 'wb') as f:
+            f.write('not a cache')
+        rebuilt = compile_story([support.twee(STORY)], CompileOptions(), CompileSession(BuildCache(self.path)))
+        self.assertEqual(rebuilt.reused, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
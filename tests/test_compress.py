@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+import random, unittest
+import support
+import twcompress, twimage
+
+def random_tile(rng):
+    """A tile with the kinds of bitplanes each method is for"""
+    kind = rng.randrange(5)
+    if kind == 0:
+        return ''.join(chr(rng.randrange(256)) for i in range(32))
+    if kind == 1:
+        return '\0' * 32
+    base = [rng.choice([0, 0xff, rng.randrange(256)]) for plane in range(4)]
+    data = []
+    for row in range(8):
+        for plane in range(4):
+            value = base[plane] if rng.random() < 0.7 else rng.randrange(256)
+            if kind == 3 and plane > 0 and rng.random() < 0.5:
+                # Inverted copy of the first bitplane
+                value = data[row * 4] ^ 0xff
+            if kind == 4 and plane > 1:
+                value = data[row * 4 + plane - 2]
+            data.append(value)
+    return ''.join(map(chr, data))
+
+def example_tiles():
+    tiles = []
+    for path in support.example_images():
+        converted = twimage.convert_file(path)
+        if not converted.error:
+            tiles.append(converted.tiles)
+    return tiles
+
+
+class CompressTest(unittest.TestCase):
+
+    def assertRoundTrip(self, data):
+        sizes = []
+        for mode in twcompress.MODES:
+            compressed = twcompress.compress(data, mode)
+            self.assertEqual(twcompress.decompress(compressed), data, mode)
+            sizes.append(len(compressed))
+        fast, best = sizes
+        self.assertTrue(best <= fast)
+
+    def test_random_tiles(self):
+        rng = random.Random(1)
+        for i in range(1000):
+            self.assertRoundTrip(''.join(random_tile(rng) for tile in range(rng.randrange(6))))
+
+    def test_examples(self):
+        tiles = example_tiles()
+        self.assertTrue(tiles)
+        for data in tiles:
+            self.assertRoundTrip(data)
+            self.assertTrue(len(twcompress.compress(data, 'max')) < len(data))
+
+    def test_methods(self):
+        plane = [0x12, 0x34, 0x12, 0x12, 0x56, 0x12, 0x12, 0x12]
+        rows = [(0, 0xff, value, value ^ 0xff) for value in plane]
+        data = ''.join(chr(byte) for row in rows for byte in row)
+        # Zeros, ones, mask 0x48 with 0x12 as the common byte, inverted copy of bitplane 2
+        self.assertEqual(twcompress.compress(data), '\x01\x00\x1f\x48\x12\x34\x56\x12')
+
+    def test_bad_data(self):
+        self.assertRaises(ValueError, twcompress.compress, '\0' * 31)
+        self.assertRaises(ValueError, twcompress.compress, '', 'slow')
+        self.assertRaises(ValueError, twcompress.decompress, '\x01')
+        # A tile with a raw bitplane that isn't there
+        self.assertRaises(ValueError, twcompress.decompress, '\x01\x00\x80\x00\x00')
+        # The first bitplane copying the third
+        self.assertRaises(ValueError, twcompress.decompress, '\x01\x00\xc0\x02')
+
+
+if __name__ == '__main__':
+    unittest.main()
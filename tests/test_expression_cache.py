@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+
+import pickle, unittest
+import support
+import twexpression
+from twexpression import parse, to_sam
+
+
+def nodes(parsed):
+    yield parsed
+    children = parsed.second if parsed.id == '(' else (parsed.first, parsed.second)
+    for child in children or ():
+        if child is not None:
+            for node in nodes(child):
+                yield node
+
+
+class ExpressionCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        twexpression.cache.clear()
+        twexpression.cache.enabled = True
+
+    def test_shared_trees_are_left_alone(self):
+        parsed = parse('$a + 2 * 3 gt random(4)')
+        self.assertTrue(parse('$a  +  2 * 3 gt random(4) ') is parsed)
+        before = [dict(node.__dict__) for node in nodes(parsed)]
+        to_sam(parsed, lambda name: 'A')
+        to_sam(parsed, lambda name: 'B', fold=False)
+        self.assertEqual([node.__dict__ for node in nodes(parsed)], before)
+        self.assertFalse([node for node in nodes(parsed) if node.parser is not None])
+
+    def test_locations_are_part_of_the_key(self):
+        parsed = parse('$a + 1')
+        self.assertEqual(to_sam(parsed, lambda name: 'A'), 'A:1+')
+        self.assertEqual(to_sam(parsed, lambda name: 'B'), 'B:1+')
+        self.assertEqual(to_sam(pickle.loads(pickle.dumps(parsed)), lambda name: 'B'), 'B:1+')
+        self.assertEqual(twexpression.cache.hits, 3)
+
+    def test_reset_stats_keeps_the_items(self):
+        to_sam('$a + 1', lambda name: 'A')
+        twexpression.cache.reset_stats()
+        self.assertEqual((twexpression.cache.hits, twexpression.cache.misses), (0, 0))
+        to_sam('$a + 1', lambda name: 'A')
+        self.assertEqual((twexpression.cache.hits, twexpression.cache.misses), (3, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
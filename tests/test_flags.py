@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+import support
+from tiddlywiki import TiddlyWiki
+from twparser import TwParser
+from twcompiler import FLAG_BITS, compile_story, CompileOptions, flag_layout, variable_facts
+from twexpression import flag_read, flag_assign, evaluate_sam
+
+def facts(*passages):
+    tw = TiddlyWiki()
+    tw.addTwee(support.twee(('P{0}'.format(i), text) for i, text in enumerate(passages)))
+    twp = TwParser(tw)
+    return [variable_facts(passage.commands) for title, passage in sorted(twp.passages.items())]
+
+def packed(*passages):
+    return sorted(flag_layout(facts(*passages)))
+
+
+class VariableFactsTest(unittest.TestCase):
+
+    def test_kinds(self):
+        self.assertEqual(facts('<<set $a to true>><<set $b to $x gt 3>><<set $c to 5>><<set $d to $a>>'
+                               '<<if $e>><<set $f to not $g>><<endif>><<print $h>>'),
+                         [([('a', 'bool'), ('b', 'bool'), ('c', 'num'), ('d', 'a'), ('f', 'bool')],
+                           ['a', 'e', 'g', 'h', 'x'])])
+
+
+class FlagLayoutTest(unittest.TestCase):
+
+    def test_booleans_and_numbers(self):
+        self.assertEqual(packed('<<set $a to true>><<set $b to 1>><<set $n to 2>><<if $c and $n gt 1>>x<<endif>>'),
+                         ['a', 'b', 'c'])
+
+    def test_flag_later_set_to_a_number(self):
+        self.assertEqual(packed('<<set $a to true>><<set $b to false>><<set $c to true>>', '<<set $b to $b + 1>>'),
+                         ['a', 'c'])
+
+    def test_copies(self):
+        # A copy of a number is a number, even through other copies
+        self.assertEqual(packed('<<set $a to true>><<set $b to $c>><<set $c to $d>><<set $d to 7>><<set $e to $a>>'),
+                         ['a', 'e'])
+
+    def test_fewer_than_two(self):
+        self.assertEqual(flag_layout(facts('<<set $a to true>><<set $n to 3>>')), {})
+        self.assertEqual(flag_layout(facts('<<set $n to 3>>')), {})
+
+    def test_more_than_a_word(self):
+        names = ['f{0:02}'.format(i) for i in range(FLAG_BITS * 2 + 1)]
+        layout = flag_layout(facts(''.join('<<set ${0} to true>>'.format(name) for name in names)))
+        self.assertEqual([layout[name] for name in names],
+                         [('*flags{0}'.format(i // FLAG_BITS), i % FLAG_BITS) for i in range(len(names))])
+        self.assertEqual(len(set(word for word, bit in layout.values())), 3)
+
+
+class FlagCodeTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        for location in ('C', '12'):
+            for word in (0, 0x5a, 0xa5, 0xff):
+                for bit in range(FLAG_BITS):
+                    variables = {location: word}
+                    self.assertEqual(evaluate_sam(flag_read(location, bit), variables), word >> bit & 1)
+                    for value in (0, 1):
+                        for code in (str(value), '1 {0}-'.format(1 - value), 'D:'):
+                            variables = {location: word, 'D': value}
+                            expected = word & ~(1 << bit) | value << bit
+                            self.assertEqual(evaluate_sam(flag_assign(location, bit, code), variables), expected,
+                                             (location, word, bit, code))
+
+    def test_story(self):
+        source = support.twee([('Start', '<<set $a to true>><<set $b to false>><<set $n to 4>>'
+                                         '<<if $a and not $b>>yes<<endif>>\n[[Next]]'),
+                               ('Next', '<<set $b to $n gt 3>><<print $b>>')])
+        packed = compile_story([source])
+        self.assertEqual((packed.flags, packed.flag_variables, packed.variables), (2, 1, 3))
+        unpacked = compile_story([source], CompileOptions(pack_flags=False))
+        self.assertEqual((unpacked.flags, unpacked.variables), (0, 4))
+
+
+if __name__ == '__main__':
+    unittest.main()
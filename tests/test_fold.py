@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+import random, re, unittest
+import support
+import twexpression
+from twexpression import to_sam, evaluate_sam
+
+LOCATIONS = {'a': 'A', 'b': 'B', 'flag': 'F', 'x': 'X', 'score': '12'}
+
+# (bits, signed) of the word sizes SAM could have
+WORDS = ((8, False), (16, False), (16, True))
+
+VALUES = (0, 1, 2, 3, 5, 100, 255, -1, -3)
+
+OPERATORS = ('+', '-', '*', '/', '%', 'and', 'or', '==', '!=', '<', '<=', '>', '>=', 'is', 'gt', 'lt')
+
+def random_expression(rng, depth):
+    choice = rng.random()
+    if depth == 0 or choice < 0.3:
+        return rng.choice(['$a', '$b', '$flag', '$score', '0', '1', '2', '3', '7', '16', '200', 'true', 'false'])
+    if choice < 0.45:
+        return rng.choice(['not ', '!', '-', '+']) + '(' + random_expression(rng, depth - 1) + ')'
+    if choice < 0.5:
+        return 'random({0})'.format(rng.randint(1, 9))
+    return '({0} {1} {2})'.format(random_expression(rng, depth - 1), rng.choice(OPERATORS),
+                                  random_expression(rng, depth - 1))
+
+def story_expressions():
+    expressions = []
+    for name, source in support.example_stories():
+        expressions += re.findall(r'<<(?:if|print)\s+(.*?)>>', source)
+        expressions += [assignment.split('=', 1)[-1].replace(' to ', ' ', 1)
+                        for assignment in re.findall(r'<<set\s+(.*?)>>', source)]
+    return [expression for expression in expressions if not '"' in expression]
+
+def locate(name):
+    return LOCATIONS.get(name, 'Z')
+
+
+class FoldTest(unittest.TestCase):
+
+    def setUp(self):
+        twexpression.cache.clear()
+
+    def assertEquivalent(self, expression, rng):
+        unfolded = to_sam(expression, locate, fold=False)
+        folded = to_sam(expression, locate)
+        for bits, signed in WORDS:
+            for trial in range(8):
+                variables = dict((location, rng.choice(VALUES)) for location in LOCATIONS.values() + ['Z'])
+                seed = rng.random()
+                expected_random, folded_random = random.Random(seed), random.Random(seed)
+                try:
+                    expected = evaluate_sam(unfolded, variables, lambda: expected_random.randint(0, 300), bits, signed)
+                except ZeroDivisionError:
+                    continue
+                self.assertEqual(evaluate_sam(folded, variables, lambda: folded_random.randint(0, 300), bits, signed), expected,
+                                 '{0}: {1!r} -> {2!r} with {3}, {4} bits{5}'.format(
+                                     expression, unfolded, folded, variables, bits, ' signed' if signed else ''))
+
+    def test_examples(self):
+        rng = random.Random(1)
+        expressions = story_expressions()
+        self.assertTrue(expressions)
+        for expression in expressions:
+            self.assertEquivalent(expression, rng)
+
+    def test_random_expressions(self):
+        rng = random.Random(2)
+        for i in range(1500):
+            self.assertEquivalent(random_expression(rng, 4), rng)
+
+    def test_simplifications(self):
+        for expression, code in (('2 * 8 + 1', '17'), ('$a + 0', 'A:'), ('$a * 1', 'A:'),
+                                 ('true and $a lt 3', 'A:3<'), ('not ($a == 1)', 'A:1=0=')):
+            self.assertEqual(to_sam(expression, locate), code)
+            self.assertTrue(len(code) < len(to_sam(expression, locate, fold=False)))
+
+    def test_keeps_side_effects(self):
+        self.assertTrue('r' in to_sam('random(3) * 0', locate))
+
+    def test_evaluator(self):
+        self.assertEqual(evaluate_sam('2 8 *1 +', {}), 17)
+        self.assertEqual(evaluate_sam('A:12 :-', {'A': 3, '12': 5}, bits=8), 254)
+        self.assertEqual(evaluate_sam('A:12 :-', {'A': 3, '12': 5}, signed=True), -2)
+        self.assertEqual(evaluate_sam('7 2\\r+', {}, lambda: 4), 5)
+        self.assertRaises(ZeroDivisionError, evaluate_sam, '1 0/', {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+import support
+from twcompiler import compile_story, CompileOptions
+
+STORY = [
+    ('StoryTitle', 'A test'),
+    ('Start', 'Hello\n[[Hall]]'),
+    ('Hall', '<<display Note>>\n[[Start]]'),
+    ('Note', 'Some text.'),
+    ('Secret', 'Hidden\n[[Secret]]\n[[Start]]'),
+    ('Menu', '<<call Help>>\n[[Start]]'),
+    ('Help', 'Help text.\n<<return>>'),
+]
+
+
+class GraphTest(unittest.TestCase):
+
+    def test_unreferenced(self):
+        result = compile_story([support.twee(STORY)])
+        # A passage linking to itself still counts as unreferenced
+        self.assertEqual(sorted(result.unreferenced), ['Menu', 'Secret'])
+
+    def test_entry_points_are_referenced(self):
+        result = compile_story([support.twee(STORY)], CompileOptions(entry_points=['Menu']))
+        self.assertEqual(result.unreferenced, ['Secret'])
+
+    def test_pruned_passages_are_not_reported(self):
+        result = compile_story([support.twee(STORY)], CompileOptions(prune_unreachable=True))
+        self.assertEqual(sorted(result.pruned), ['Help', 'Menu', 'Secret', 'StoryTitle'])
+        self.assertEqual(result.unreferenced, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
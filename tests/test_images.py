@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+
+"""Checks the conversion of the example images against the files in
+tests/golden; run this file with --regenerate to write them again after a
+deliberate change to the output"""
+
+import os, shutil, struct, sys, tempfile, unittest, zlib
+import support
+import twimage
+
+GOLDEN = os.path.join(support.ROOT, 'tests', 'golden')
+
+PARTS = ('tiles', 'tilemap', 'palette')
+
+def golden_path(image, part):
+    """tests/golden/<example>/<path under tw, without .png>.<part>.bin"""
+    relative = os.path.relpath(image, support.EXAMPLES).split(os.sep)
+    assert relative[1] == 'tw'
+    name = os.path.join(GOLDEN, relative[0], *relative[2:])
+    return '{0}.{1}.bin'.format(os.path.splitext(name)[0], part)
+
+def convert(image):
+    with open(image, 'rb') as f:
+        return twimage.convert(f.read())
+
+def regenerate():
+    for image in support.example_images():
+        converted = convert(image)
+        assert not converted.error, (image, converted.error)
+        for part in PARTS:
+            path = golden_path(image, part)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as f:
+                f.write(getattr(converted, part))
+
+def pixels(converted, width):
+    """Draws the converted image back, as --BBGGRR colors"""
+    palette = bytearray(converted.palette)
+    tiles = [bytearray(converted.tiles[i:i + 32]) for i in range(0, len(converted.tiles), 32)]
+    words = struct.unpack('<{0}H'.format(len(converted.tilemap) // 2), converted.tilemap)
+    columns = width // twimage.TILE_SIZE
+    rows = [[None] * width for i in range(len(words) // columns * twimage.TILE_SIZE)]
+    for cell, word in enumerate(words):
+        ty, tx = divmod(cell, columns)
+        tile = tiles[word & 0x1ff]
+        for y in range(8):
+            for x in range(8):
+                sx = 7 - x if word & twimage.TILE_HFLIP else x
+                sy = 7 - y if word & twimage.TILE_VFLIP else y
+                index = sum((tile[sy * 4 + plane] >> (7 - sx) & 1) << plane for plane in range(4))
+                rows[ty * 8 + y][tx * 8 + x] = palette[index]
+    return rows
+
+def truecolor_png(rows):
+    """Encodes rows of (red, green, blue) as an RGB PNG, for more than the 16
+    colors of twimage.write_png"""
+    def chunk(kind, body):
+        return struct.pack('>I', len(body)) + kind + body + struct.pack('>I', zlib.crc32(kind + body) & 0xffffffff)
+
+    raw = ''.join('\0' + str(bytearray(sample for color in row for sample in color)) for row in rows)
+    return (twimage.PNG_SIGNATURE +
+            chunk('IHDR', struct.pack('>IIBBBBB', len(rows[0]), len(rows), 8, 2, 0, 0, 0)) +
+            chunk('IDAT', zlib.compress(raw)) +
+            chunk('IEND', ''))
+
+def tile_rows(tiles):
+    """Joins rows of 8x8 tiles (lists of 8 rows) into the rows of an image"""
+    return [sum((tile[y] for tile in row), []) for row in tiles for y in range(twimage.TILE_SIZE)]
+
+GRAYS = [(level, level, level) for level in range(0, 256, 17)]
+
+# A tile that is different from its mirror images
+TILE = [[1, 2, 0, 0, 0, 0, 0, 0]] + [[0] * 8] * 6 + [[0, 0, 0, 0, 0, 0, 0, 3]]
+
+
+class ConvertTest(unittest.TestCase):
+
+    def test_examples_match_golden(self):
+        images = support.example_images()
+        self.assertTrue(images)
+        for image in images:
+            converted = convert(image)
+            self.assertEqual(converted.error, None, image)
+            for part in PARTS:
+                with open(golden_path(image, part), 'rb') as f:
+                    self.assertEqual(getattr(converted, part), f.read(), '{0}: {1}'.format(image, part))
+
+    def test_examples_draw_back(self):
+        for image in support.example_images():
+            with open(image, 'rb') as f:
+                data = f.read()
+            width, height, source, color_type, depth, palette, transparency = twimage.read_png(data)
+            maximum = 255 if color_type == 3 else (1 << depth) - 1
+            expected = [[twimage.sms_color(twimage.make_color(pixel, color_type, palette, transparency), maximum)
+                         for pixel in row] for row in source]
+            self.assertEqual(pixels(twimage.convert(data), width), expected, image)
+
+
+class AnalyzeTest(unittest.TestCase):
+
+    def test_flipped_tiles_count_once(self):
+        mirrored = [row[::-1] for row in TILE]
+        rows = tile_rows([[TILE, mirrored], [TILE[::-1], mirrored[::-1]]])
+        report = twimage.analyze(twimage.write_png(16, 16, rows, GRAYS))
+        self.assertEqual((report.width, report.height, report.colors), (16, 16, 4))
+        self.assertEqual((report.tiles, report.flipped_tiles), (4, 1))
+
+    def test_mirror_images_only_count_once(self):
+        mirrored = [row[::-1] for row in TILE]
+        rows = tile_rows([[TILE, mirrored, TILE]])
+        report = twimage.analyze(twimage.write_png(24, 8, rows, GRAYS))
+        self.assertEqual((report.tiles, report.flipped_tiles), (2, 1))
+
+    def test_fitting_image(self):
+        rows = [[(x // 16 + y // 16) % 16 for x in range(twimage.WIDTH)] for y in range(twimage.HEIGHT)]
+        report = twimage.analyze(twimage.write_png(twimage.WIDTH, twimage.HEIGHT, rows, GRAYS))
+        self.assertEqual(report.problems, [])
+        self.assertEqual(report.colors, 16)
+
+    def test_too_many_colors(self):
+        rows = [[(x * 8 + y, 0, 0) for x in range(8)] for y in range(8)]
+        report = twimage.analyze(truecolor_png(rows))
+        self.assertEqual(report.colors, 64)
+        self.assertTrue('it has 64 colors, but SAM can only show 16' in report.problems)
+
+    def test_too_many_tiles(self):
+        # Color 15 only in one corner, so no tile is a mirror image of another
+        tiles = []
+        for number in range(twimage.WIDTH // 8 * twimage.HEIGHT // 8):
+            digits = [number // 225, number // 15 % 15, number % 15]
+            tiles.append([[15] + [0] * 7, [0] + digits + [0] * 4] + [[0] * 8] * 6)
+        columns = twimage.WIDTH // 8
+        rows = tile_rows([tiles[i:i + columns] for i in range(0, len(tiles), columns)])
+        report = twimage.analyze(twimage.write_png(twimage.WIDTH, twimage.HEIGHT, rows, GRAYS))
+        self.assertEqual((report.tiles, report.flipped_tiles), (576, 576))
+        self.assertEqual(report.problems, ['it needs 576 distinct tiles, but SAM can only show 320; try simplifying it'])
+
+    def test_wrong_size_and_invalid_data(self):
+        report = twimage.analyze(twimage.write_png(8, 8, [[0] * 8] * 8, GRAYS))
+        self.assertEqual(report.problems, ['it is 8x8 pixels, but SAM images must be 256x144'])
+        report = twimage.analyze('not a PNG')
+        self.assertEqual(report.summary(), 'unreadable')
+        self.assertTrue(report.problems[0].startswith('not a valid PNG image'))
+
+
+class ReduceTest(unittest.TestCase):
+
+    # A gradient with 256 colors
+    ROWS = [[(x * 16, y * 16, 128) for x in range(16)] for y in range(16)]
+
+    def colors(self, png):
+        width, height, pixels = twimage.decode_png(png)
+        return set(color for row in pixels for color in row)
+
+    def test_reduces_to_master_palette(self):
+        reduced = twimage.reduce_colors(truecolor_png(self.ROWS))
+        self.assertEqual(reduced.error, None)
+        self.assertEqual(reduced.colors, 256)
+        colors = self.colors(reduced.png)
+        self.assertEqual(len(colors), reduced.reduced_colors)
+        self.assertTrue(reduced.reduced_colors <= twimage.MAX_COLORS)
+        for color in colors:
+            self.assertTrue(color[:3] in twimage.MASTER_PALETTE, color)
+
+    def test_few_colors_pass_through(self):
+        rows = [[GRAYS[(x + y) % 16] for x in range(16)] for y in range(16)]
+        reduced = twimage.reduce_colors(truecolor_png(rows))
+        self.assertEqual((reduced.png, reduced.colors, reduced.error), (None, 16, None))
+
+    def test_dithering(self):
+        data = truecolor_png(self.ROWS)
+        plain = twimage.reduce_colors(data).png
+        dithered = twimage.reduce_colors(data, dither=True).png
+        self.assertNotEqual(plain, dithered)
+        self.assertEqual(twimage.reduce_colors(data).png, plain)
+        self.assertEqual(twimage.reduce_colors(data, dither=True).png, dithered)
+
+    def test_cache_key_has_the_settings(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'gradient.png')
+            with open(path, 'wb') as f:
+                f.write(truecolor_png(self.ROWS))
+            checker = twimage.ImageChecker()
+            content_hash = lambda path: 'hash'
+            plain, = checker.reduce([path], content_hash)
+            dithered, = checker.reduce([path], content_hash, dither=True)
+            self.assertEqual(sorted(checker.results), [('reduce_file', 'hash', False), ('reduce_file', 'hash', True)])
+            self.assertNotEqual(plain.png, dithered.png)
+            self.assertTrue(checker.reduce([path], content_hash, dither=True)[0] is dithered)
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['--regenerate']:
+        regenerate()
+    else:
+        unittest.main()
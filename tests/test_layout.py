@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+import support
+from twlayout import TextLayout, NUMBER_WIDTH
+from twcompiler import compile_story, CompileOptions
+
+
+class TextLayoutTest(unittest.TestCase):
+
+    def test_wraps_at_line_width(self):
+        layout = TextLayout(columns=10)
+        self.assertEqual(layout.lay_out('one two three four five'), ['one two\nthree four\nfive'])
+        self.assertEqual((layout.row, layout.col), (2, 4))
+
+    def test_word_filling_a_line(self):
+        self.assertEqual(TextLayout(columns=5).lay_out('abcde fg'), ['abcde\nfg'])
+
+    def test_word_longer_than_a_line(self):
+        self.assertEqual(TextLayout(columns=5).lay_out('ab abcdefghijkl c'), ['ab\nabcde\nfghij\nkl c'])
+
+    def test_existing_newlines(self):
+        layout = TextLayout(columns=10)
+        self.assertEqual(layout.lay_out('one\n\ntwo  three\n'), ['one\n\ntwo three\n'])
+        self.assertEqual((layout.row, layout.col), (3, 0))
+
+    def test_continues_the_line(self):
+        # The parser strips the text around the macros, as SAM shows it
+        layout = TextLayout(columns=10)
+        layout.lay_out('one')
+        self.assertEqual(layout.lay_out('two three'), ['two\nthree'])
+
+    def test_page_break_when_rows_run_out(self):
+        layout = TextLayout(columns=10, rows=2)
+        self.assertEqual(layout.lay_out('a\nb\nc'), ['a\nb', None, 'c'])
+        self.assertEqual(layout.pages, 1)
+
+    def test_page_break_when_buffer_runs_out(self):
+        layout = TextLayout(columns=10, rows=100, buffer_size=12)
+        self.assertEqual(layout.lay_out('aaaa bbbb cccc'), ['aaaa bbbb\n', None, 'cccc'])
+
+    def test_number(self):
+        layout = TextLayout(columns=10)
+        layout.lay_out('abcde')
+        self.assertEqual(layout.number(), ['\n'])
+        self.assertEqual(layout.col, NUMBER_WIDTH)
+
+    def test_story(self):
+        words = ' '.join('word{0}'.format(i) for i in range(200))
+        source = support.twee([('Start', words + '\n[[End]]'), ('End', 'The end.')])
+        wrapped = compile_story([source], CompileOptions(wrap_text=True)).scripts['Start.twsam']
+        self.assertTrue(all(len(line) <= 28 for line in wrapped.replace('"', '').split('\n')), wrapped)
+        self.assertTrue('!' in wrapped)
+        # Left to SAM, the text is cut at the end of the buffer
+        plain = compile_story([source]).scripts['Start.twsam']
+        self.assertTrue(plain.startswith('"' + words[:400]), plain)
+        self.assertFalse(words in plain)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+import itertools, operator, re, unittest
+import support
+import twsam
+from twcompiler import compile_story, CompileOptions
+
+RE_CODE = re.compile(r'\s*(?:(\d+)|([A-Z])([:.])|(.))')
+
+OPERATORS = {'+': operator.add, '-': operator.sub, '*': operator.mul, '/': operator.floordiv,
+             '\\': operator.mod, '=': lambda x, y: int(x == y), '<': lambda x, y: int(x < y)}
+
+def run(code, variables):
+    """Runs straight menu code: numbers, variables, arithmetic, blocks and
+    jumps; returns the target of the jump it ends with"""
+    stack = []
+    pos = 0
+    while True:
+        match = RE_CODE.match(code, pos)
+        if not match or match.end() == pos:
+            raise AssertionError('the code ended without jumping: {0!r}'.format(code))
+        pos = match.end()
+        number, variable, access, symbol = match.groups()
+        if number:
+            stack.append(int(number))
+        elif variable and access == ':':
+            stack.append(variables[variable])
+        elif variable:
+            variables[variable] = stack.pop()
+        elif symbol == 'j':
+            return stack.pop()
+        elif symbol == '[':
+            if not stack.pop():
+                # Skips to the matching ]
+                depth = 1
+                while depth:
+                    depth += {'[': 1, ']': -1}.get(code[pos], 0)
+                    pos += 1
+        elif symbol == ']':
+            if stack.pop():
+                raise AssertionError('loops are not expected in a menu')
+        else:
+            y = stack.pop()
+            x = stack.pop()
+            stack.append(OPERATORS[symbol](x, y))
+
+CONDITION_VARIABLES = 'PQRSTUVW'
+
+def menu_code(targets, conditional, indexed):
+    """The dispatch code of a menu whose conditional links read P, Q..."""
+    readers = iter(CONDITION_VARIABLES)
+    conditions = [next(readers) + ':' if flag else None for flag in conditional]
+    if indexed:
+        ops = []
+        if any(conditional):
+            ops.append(twsam.MenuRemap([(i, cond) for i, cond in enumerate(conditions) if cond]))
+        ops.append(twsam.MenuDispatch(targets))
+    else:
+        ops = [twsam.MenuStart()]
+        for target, cond in zip(targets, conditions):
+            case = twsam.MenuCase(target)
+            ops.append(twsam.Block(cond, [case]) if cond else case)
+        ops = twsam.peephole(ops)
+    return twsam.render(ops), [cond[0] for cond in conditions if cond]
+
+
+class DispatchTest(unittest.TestCase):
+
+    def assertDispatches(self, targets, conditional):
+        for indexed in (True, False):
+            code, readers = menu_code(targets, conditional, indexed)
+            for shown in itertools.product((0, 1), repeat=len(readers)):
+                shown_links = iter(shown)
+                visible = [i for i, flag in enumerate(conditional) if not flag or next(shown_links)]
+                for option, link in enumerate(visible):
+                    variables = dict(zip(readers, shown), A=option, B=99)
+                    self.assertEqual(run(code, variables), targets[link],
+                                     '{0} {1}: option {2} with {3}\n{4}'.format(
+                                         'indexed' if indexed else 'linear', targets, option, shown, code))
+
+    def test_single_link(self):
+        self.assertDispatches([7], [False])
+        self.assertEqual(menu_code([7], [False], True)[0], '7j\n')
+
+    def test_evenly_spaced(self):
+        for targets in ([3, 4, 5, 6], [2, 5, 8], [0, 3, 6, 9], [9, 6, 3], [5, 4, 3, 2, 1], [4, 4, 4]):
+            self.assertDispatches(targets, [False] * len(targets))
+            self.assertFalse('[' in menu_code(targets, [False] * len(targets), True)[0], targets)
+
+    def test_binary_search(self):
+        for targets in ([3, 9, 4], [10, 2, 7, 1, 5], [1, 2, 4, 8, 16, 32, 64], [6, 6, 2]):
+            self.assertTrue('[' in menu_code(targets, [False] * len(targets), True)[0], targets)
+            self.assertDispatches(targets, [False] * len(targets))
+
+    def test_hidden_links(self):
+        targets = [11, 12, 13, 14, 15]
+        for conditional in ([True, False, False, False, False], [False, False, True, False, False],
+                            [False, False, False, False, True], [True, False, True, False, True],
+                            [True] * 5):
+            self.assertDispatches(targets, conditional)
+            self.assertDispatches([3, 9, 4, 20, 8], conditional)
+
+
+class MenuVariableTest(unittest.TestCase):
+
+    SOURCE = support.twee([('Start', '<<set $score to 5>><<print $score>>\n[[A]]\n[[B]]'), ('A', 'a'), ('B', 'b')])
+
+    def test_b_is_free_with_indexed_dispatch(self):
+        script = compile_story([self.SOURCE]).scripts['Start.twsam']
+        self.assertTrue(script.startswith('5 B.'), script)
+
+    def test_b_is_reserved_with_linear_dispatch(self):
+        script = compile_story([self.SOURCE], CompileOptions(menu_dispatch='linear')).scripts['Start.twsam']
+        self.assertTrue(script.startswith('5 C.'), script)
+        self.assertTrue('0B.' in script)
+
+
+if __name__ == '__main__':
+    unittest.main()
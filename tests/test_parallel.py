@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+import support
+from twcompiler import compile_story, CompileOptions
+
+def shared_story(rooms=24):
+    """Rooms that set and test variables first seen in different rooms,
+    display a shared description and show conditional links, images and music"""
+    passages = [('Start', '<<set $visits to 0>>[img[start.png]]\nHello\n[[Room 0]]'),
+                ('Description', 'The walls are made of grey stone, and water drips from the ceiling.\n'
+                                '<<if $lamp>>Your lamp shows a narrow crack in the floor.<<endif>>\n'),
+                ('Status', 'You have visited <<print $visits>> rooms.\n<<return>>')]
+    for room in range(rooms):
+        body = ('<<set $visits to $visits + 1>><<set $seen{0} to true>>'
+                '<<display Description>>\n'
+                '<<if $seen{1} and $key{2}>>You were here before.<<endif>>\n'
+                '<<if $visits gt {0}>><<set $key{2} to $visits * 2>><<endif>>\n'
+                '<<call Status>>\n').format(room % 8, (room + 5) % 8, room % 4)
+        if room % 3 == 0:
+            body += '[img[room{0}.png]]\n<<music "theme{1}.epsgmod">>\n'.format(room, room % 2)
+        body += '[[Room {0}]]\n<<if $seen{1}>>[[Room {2}]]<<endif>>\n<<if $lamp>>[[Back|Start]]<<endif>>'.format(
+            (room + 1) % rooms, (room + 3) % 8, (room + 3) % rooms)
+        passages.append(('Room {0}'.format(room), body))
+    return support.twee(passages)
+
+
+class ParallelTest(unittest.TestCase):
+
+    def assertSameOutput(self, source, **options):
+        serial = compile_story([source], CompileOptions(jobs=1, **options))
+        parallel = compile_story([source], CompileOptions(jobs=4, **options))
+        self.assertEqual(parallel.scripts.keys(), serial.scripts.keys())
+        for name, script in serial.scripts.items():
+            self.assertEqual(parallel.scripts[name], script, name)
+        self.assertEqual(list(parallel.files()), list(serial.files()))
+
+    def test_examples(self):
+        for name, source in support.example_stories():
+            self.assertSameOutput(source)
+
+    def test_shared_variables_and_subroutines(self):
+        source = shared_story()
+        result = compile_story([source])
+        self.assertTrue('Description__display.twsam' in result.scripts)
+        self.assertTrue(len(result.image_list.split()) > 2)
+        self.assertSameOutput(source)
+        self.assertSameOutput(source, pack_flags=False, display_mode='inline')
+
+
+if __name__ == '__main__':
+    unittest.main()
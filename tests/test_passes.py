@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+import support
+import twsam
+from twsam import (Text, Print, Flush, Call, Choice, Block, MenuStart, MenuCase, Set,
+                   MAX_STRING, optimize, peephole, remove_redundant_flushes, remove_empty_blocks, render)
+
+
+class PeepholeTest(unittest.TestCase):
+
+    def test_merges_adjacent_strings(self):
+        ops = peephole([Text('a'), Text(''), Text('b'), Print('A:'), Text('c')])
+        self.assertEqual(render(ops), '"ab"\nA:"\\#""c"\n')
+
+    def test_merges_up_to_the_buffer_size(self):
+        ops = peephole([Text('x' * (MAX_STRING - 1)), Text('y')])
+        self.assertEqual([op.text for op in ops], ['x' * (MAX_STRING - 1) + 'y'])
+        ops = peephole([Text('x' * (MAX_STRING - 1)), Text('yz')])
+        self.assertEqual([op.text for op in ops], ['x' * (MAX_STRING - 1), 'yz'])
+
+    def test_merges_inside_blocks(self):
+        ops = peephole([Block('A:', [Text('a'), Text('b')])])
+        self.assertEqual([op.text for op in ops[0].body], ['ab'])
+
+    def test_last_menu_case_keeps_b(self):
+        ops = peephole([MenuStart(), MenuCase(3), Block('C:', [MenuCase(4)])])
+        self.assertTrue(ops[1].increment)
+        self.assertFalse(ops[2].body[0].increment)
+
+
+class FlushTest(unittest.TestCase):
+
+    def test_soft_flush_on_empty_buffer_goes(self):
+        ops = remove_redundant_flushes([Text('a'), Flush(), Flush(soft=True), Set('1', 'A.')])
+        self.assertEqual([type(op) for op in ops], [Text, Flush, Set])
+
+    def test_caller_may_have_left_text(self):
+        ops = remove_redundant_flushes([Flush(soft=True)])
+        self.assertEqual(len(ops), 1)
+
+    def test_soft_flush_after_call_or_choice_stays(self):
+        for op in (Call(5), Choice()):
+            ops = remove_redundant_flushes([Flush(), op, Flush(soft=True)])
+            self.assertEqual(len(ops), 3, op)
+
+    def test_block_that_may_print(self):
+        ops = remove_redundant_flushes([Flush(), Block('A:', [Text('a')]), Flush(soft=True)])
+        self.assertEqual(len(ops), 3)
+        ops = remove_redundant_flushes([Flush(), Block('A:', [Set('1', 'B.')]), Flush(soft=True)])
+        self.assertEqual(len(ops), 2)
+
+
+class BlockTest(unittest.TestCase):
+
+    def test_empty_blocks_go(self):
+        self.assertEqual(remove_empty_blocks([Block('A:', []), Block('A:', [Block('B:', [])])]), [])
+
+    def test_random_conditions_stay(self):
+        # The random number generator advances even if the block is empty
+        ops = remove_empty_blocks([Block('3r 1=', [])])
+        self.assertEqual(len(ops), 1)
+
+    def test_constant_conditions(self):
+        body = [Text('a')]
+        self.assertEqual(remove_empty_blocks([Block('1', body)]), body)
+        self.assertEqual(remove_empty_blocks([Block(' 1 ', [Block('1', body)])]), body)
+        self.assertEqual(remove_empty_blocks([Block('0', body)]), [])
+
+
+class OptimizeTest(unittest.TestCase):
+
+    def test_repeats_until_stable(self):
+        # Inlining the block lets the strings merge on the next round
+        ops = optimize([Text('a'), Block('1', [Text('b')]), Text('c')], twsam.DEFAULT_PASSES)
+        self.assertEqual(render(ops), '"abc"\n')
+
+    def test_unknown_pass(self):
+        self.assertRaises(ValueError, optimize, [], ['peephole', 'unroll'])
+
+    def test_no_passes(self):
+        ops = [Block('1', [Text('a')])]
+        self.assertEqual(optimize(ops, []), ops)
+
+
+if __name__ == '__main__':
+    unittest.main()
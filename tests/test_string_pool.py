@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+import support
+import twstrings
+from twcompiler import compile_story, CompileOptions, CompileSession, BuildCache
+
+LINE = 'A line that is long enough to be worth sharing\n'
+OTHER_LINE = 'Another line, also long enough to be shared\n'
+
+def pool_of(result):
+    """Returns the number of the first pool script, and the phrases"""
+    names = result.script_list.split()
+    pool = [name for name in names if name.endswith('__pool.twsam')]
+    first = names.index(pool[0]) if pool else len(names)
+    return first, [result.scripts[name][1:-len('"\n$\n')] for name in pool]
+
+def expanded(result):
+    first, phrases = pool_of(result)
+    return dict((name, twstrings.normalize(twstrings.expand(script, phrases, first)))
+                for name, script in result.scripts.items() if not name.endswith('__pool.twsam'))
+
+def plain(result):
+    return dict((name, twstrings.normalize(script)) for name, script in result.scripts.items())
+
+
+class StringPoolTest(unittest.TestCase):
+
+    def test_examples_match_unpooled(self):
+        shared = 0
+        for name, source in support.example_stories():
+            pooled = compile_story([source], CompileOptions(string_pool=True))
+            unpooled = compile_story([source], CompileOptions())
+            self.assertEqual(expanded(pooled), plain(unpooled), name)
+            shared += pooled.pooled_strings
+        self.assertTrue(shared > 0)
+
+    def test_numbers_are_kept(self):
+        name, source = [story for story in support.example_stories() if story[0] == 'ccadv'][0]
+        options = CompileOptions(string_pool=True)
+        session = CompileSession(BuildCache())
+        before = compile_story([source], options, session)
+
+        # One of the two copies of a shared phrase goes, and so does the phrase
+        edited = source.replace('with holes everywhere.', 'full of holes.', 1)
+        self.assertNotEqual(edited, source)
+        after = compile_story([edited], options, session)
+        self.assertEqual(after.pooled_strings, before.pooled_strings - 1)
+        self.assertEqual(expanded(after), plain(compile_story([edited], CompileOptions())))
+
+        changed = [name for name, script in after.scripts.items() if before.scripts.get(name) != script]
+        fresh = compile_story([edited], options)
+        rewritten = [name for name, script in fresh.scripts.items() if before.scripts.get(name) != script]
+        self.assertTrue(len(changed) < len(rewritten) / 2, (changed, len(rewritten)))
+
+        # Back as it was, the phrase comes back without moving the others
+        again = compile_story([source], options, session)
+        self.assertEqual(pool_of(again)[1][:-1], pool_of(after)[1])
+        self.assertEqual(expanded(again), plain(compile_story([source], CompileOptions())))
+
+    def test_first_build(self):
+        scripts = ['"{0}short\n"\n'.format(LINE), '1c\n"{0}short\n"\n'.format(LINE), '"{0}"\n'.format(LINE)]
+        pooled, phrases = twstrings.pool_strings(scripts, 3)
+        self.assertEqual(phrases, [LINE])
+        self.assertEqual(pooled, ['3c\n"short\n"\n', '1c\n3c\n"short\n"\n', '3c\n'])
+
+    def test_previous_phrases_keep_their_numbers(self):
+        scripts = ['"{0}"\n'.format(LINE)] * 2 + ['"{0}"\n'.format(OTHER_LINE)] * 2
+        pooled, phrases = twstrings.pool_strings(scripts, 4, [OTHER_LINE, LINE])
+        self.assertEqual(phrases, [OTHER_LINE, LINE])
+        self.assertEqual(pooled, ['5c\n', '5c\n', '4c\n', '4c\n'])
+
+        # A new phrase takes the number of one that is gone, and the last
+        # one fills the gap the other leaves
+        pooled, phrases = twstrings.pool_strings(scripts, 4, ['gone\n', 'gone too\n', LINE])
+        self.assertEqual(phrases, [OTHER_LINE, LINE])
+        self.assertEqual(pooled, ['5c\n', '5c\n', '4c\n', '4c\n'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+import support
+from twcompiler import compile_story, CompileOptions, CompileError
+
+LONG_TEXT = 'The walls are covered in old carvings of ships, stars and strange animals.'
+
+def story(note, uses=3, extra=()):
+    """A story whose rooms each display Note"""
+    passages = [('Start', 'Hello\n[[Room 0]]'), ('Note', note)]
+    for room in range(uses):
+        passages.append(('Room {0}'.format(room), 'Room {0}.\n<<display Note>>\n[[Start]]'.format(room)))
+    return support.twee(passages + list(extra))
+
+def subroutines(source, **options):
+    result = compile_story([source], CompileOptions(**options))
+    return [name for name in result.scripts if name.endswith('__display.twsam')]
+
+
+class DisplaySubroutineTest(unittest.TestCase):
+
+    def test_shared_when_displayed_often(self):
+        source = story(LONG_TEXT)
+        self.assertEqual(subroutines(source), ['Note__display.twsam'])
+        result = compile_story([source])
+        rooms = [script for name, script in result.scripts.items() if name.startswith('Room')]
+        self.assertEqual(len(rooms), 3)
+        self.assertFalse([script for script in rooms if LONG_TEXT in script])
+
+    def test_inlined_when_it_would_not_save_space(self):
+        self.assertEqual(subroutines(story(LONG_TEXT, uses=1)), [])
+        self.assertEqual(subroutines(story('Hi.')), [])
+
+    def test_inline_mode(self):
+        self.assertEqual(subroutines(story(LONG_TEXT), display_mode='inline'), [])
+
+    def test_menus_and_returns_stay_inline(self):
+        for note in ('[[Start]]', '* [[Start]]', '[img[note.png]]', '<<return>>',
+                     '<<if $x>>[[Start]]<<endif>>', '<<display Other>>'):
+            source = story(LONG_TEXT + '\n' + note, extra=[('Other', '[[Start]]')])
+            self.assertEqual(subroutines(source), [], note)
+
+    def test_nested_displays(self):
+        source = story(LONG_TEXT + '\n<<display Other>>', extra=[('Other', LONG_TEXT.upper())])
+        self.assertEqual(subroutines(source), ['Note__display.twsam'])
+
+    def test_display_cycle(self):
+        source = story('<<display Other>>', extra=[('Other', LONG_TEXT + '<<display Note>>')])
+        with self.assertRaises(CompileError) as raised:
+            compile_story([source])
+        self.assertTrue(str(raised.exception).startswith('Display cycle: '), str(raised.exception))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+import re, unittest
+import support
+from twcompiler import compile_story, CompileOptions, CompileError, GeneratedScript, temp_bases
+
+def script(title, temps, calls=()):
+    generated = GeneratedScript(title, '')
+    generated.temps = [list(temp) for temp in temps]
+    generated.calls = list(calls)
+    return generated
+
+def stored(script):
+    """Variables the script stores a 1 into, as the link conditions do"""
+    return set(re.findall(r'1([A-Z])\.', script))
+
+
+class TempSlotTest(unittest.TestCase):
+
+    def test_slot_reused_after_last_read(self):
+        generated = script('A', [('t0', 0, 5), ('t1', 3, 8), ('t2', 6, 9), ('t3', 9, 12)])
+        # t2 starts after t0's last read; t3 starts on t2's last read, so can't share it
+        self.assertEqual(generated.temp_slots(), {'t0': 0, 't1': 1, 't2': 0, 't3': 1})
+
+    def test_live_slots(self):
+        generated = script('A', [('t0', 0, 5), ('t1', 3, 8)])
+        self.assertEqual([generated.live_slots(position) for position in (0, 2, 4, 6, 9)], [0, 1, 2, 2, 0])
+
+    def test_callee_base_above_live_slots(self):
+        scripts = {0: script('Caller', [('t0', 0, 5), ('t1', 1, 5)], [(1, 3), (2, 7)]),
+                   1: script('Callee', [('t0', 0, 2)], [(3, 1)]),
+                   2: script('After', [('t0', 0, 2)]),
+                   3: script('Nested', [])}
+        diagnostics = []
+        self.assertEqual(temp_bases(scripts, diagnostics), {0: 0, 1: 2, 2: 0, 3: 3})
+        self.assertEqual(diagnostics, [])
+
+    def test_calls_back(self):
+        scripts = {0: script('A', [('t0', 0, 5)], [(1, 3)]),
+                   1: script('B', [('t0', 0, 5)], [(0, 3)])}
+        diagnostics = []
+        temp_bases(scripts, diagnostics)
+        self.assertEqual(len(diagnostics), 1)
+        self.assertTrue('may overwrite the conditions' in diagnostics[0][1])
+
+
+class StoryTest(unittest.TestCase):
+
+    def test_not_shared_across_call(self):
+        source = support.twee([
+            ('Start', '<<if $a>>[[X]]<<endif>>\n<<call Sub>>\n[[Y]]'),
+            ('Sub', 'Sub\n<<if $b>>[[Z]]<<endif>>\n[[X]]'),
+            ('Other', '<<if $b>>[[Z]]<<endif>>\n[[X]]'),
+            ('X', 'x'), ('Y', 'y'), ('Z', 'z')])
+        result = compile_story([source])
+        caller, callee, other = [stored(result.scripts[name]) for name in ('Start.twsam', 'Sub.twsam', 'Other.twsam')]
+        self.assertEqual(len(caller), 1)
+        self.assertEqual(len(callee), 1)
+        self.assertNotEqual(caller, callee)
+        # A script nothing calls starts from the first slot again
+        self.assertEqual(other, caller)
+        self.assertEqual(result.temp_variables, 2)
+
+    def test_over_budget(self):
+        source = support.twee([('Start', ''.join('<<set $v{0} to {1}>>'.format(i, i + 2) for i in range(30)) + 'Done')])
+        with self.assertRaises(CompileError) as raised:
+            compile_story([source])
+        self.assertEqual(str(raised.exception),
+                         'The story needs 31 variables, but only 26 are available (30 named, 0 temporary, 1 for the menus)')
+
+        source = support.twee([('Start', '<<set $a to 2>><<set $b to 3>><<if $a>>[[X]]<<endif>>\n<<if $b>>[[X]]<<endif>>\n[[X]]'),
+                               ('X', 'x')])
+        compile_story([source], CompileOptions(max_variables=5))
+        with self.assertRaises(CompileError) as raised:
+            compile_story([source], CompileOptions(max_variables=4))
+        self.assertTrue('(2 named, 2 temporary, 1 for the menus)' in str(raised.exception), str(raised.exception))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+import re, unittest
+import support
+from tiddlywiki import TiddlyWiki
+from twparser import Passage
+
+
+#
+# The tokenizer the scanner replaced, as a reference: each kind of token is
+# looked for in turn, in the text between the tokens of the kinds before it
+#
+
+RE_ITEM_LIST = re.compile(r'^([#\*])\s(.*)$', flags=re.MULTILINE)
+RE_MACRO = re.compile(r'\<\<(\w+)(\s*.*?)\>\>')
+RE_LINK = re.compile(r'\[\[(.*?)\]\]')
+RE_IMG = re.compile(r'\[img\[(.*?)\]\]')
+RE_TEXT = re.compile(r'(.*)', flags=re.DOTALL)
+
+def old_tokenize(string):
+    def test_command(string, remaining_tests):
+        if not remaining_tests:
+            return []
+
+        regex, action, skipped_chars = remaining_tests[0]
+        remaining_tests = remaining_tests[1:]
+
+        tokens = []
+        st_pos = 0
+        st_len = len(string)
+        for item in regex.finditer(string):
+            it_st = item.start()
+            if st_pos < it_st and st_pos < st_len:
+                tokens += test_command(string[st_pos:it_st], remaining_tests)
+            st_pos = item.end() + skipped_chars
+            tokens += action(item)
+
+        if st_pos < st_len:
+            tokens += test_command(string[st_pos:st_len], remaining_tests)
+        return tokens
+
+    def process_item_list(match):
+        list_type = 'ul' if match.group(1) == '*' else 'ol'
+        return [(list_type, old_tokenize(match.group(2).strip()))]
+
+    tests = [
+        (RE_ITEM_LIST, process_item_list, 1),
+        (RE_MACRO, lambda match: [('mc', (match.group(1), match.group(2)))], 0),
+        (RE_IMG, lambda match: [('im', match.group(1))], 0),
+        (RE_LINK, lambda match: [('lk', match.group(1))], 0),
+        (RE_TEXT, lambda match: [('tx', match.group(1))], 0)
+    ]
+    return test_command(string, tests)
+
+def without_empty_text(tokens):
+    # The old text regex also matched the empty string at the end of the text
+    result = []
+    for token in tokens:
+        if token == ('tx', ''):
+            continue
+        if token[0] in ('ul', 'ol'):
+            token = (token[0], without_empty_text(token[1]))
+        result.append(token)
+    return result
+
+def tokenize(string):
+    return list(Passage.__new__(Passage)._tokenize_string(string))
+
+
+class TokenizerTest(unittest.TestCase):
+
+    def test_examples_match_old_tokenizer(self):
+        count = 0
+        for path in support.example_twee_files():
+            tw = TiddlyWiki()
+            with open(path) as f:
+                tw.addTwee(f.read().decode('utf-8-sig'))
+            for tiddler in tw.tiddlers.values():
+                source = re.sub(r'\\[ \t]*\n', '', str(tiddler.text))
+                self.assertEqual(tokenize(source), without_empty_text(old_tokenize(source)),
+                                 '{0}: {1}'.format(path, tiddler.title))
+                count += 1
+        self.assertTrue(count > 100)
+
+    def test_kinds(self):
+        self.assertEqual(tokenize('a [[b|c]] <<set $x = 1>>[img[d.png]]\n* e\n# [[f]]\ng'), [
+            ('tx', 'a '), ('lk', 'b|c'), ('tx', ' '), ('mc', ('set', ' $x = 1')), ('im', 'd.png'), ('tx', '\n'),
+            ('ul', [('tx', 'e')]), ('ol', [('lk', 'f')]), ('tx', 'g')])
+
+    def test_leftmost_token_wins(self):
+        # The old tokenizer split the link around the macro
+        source = '[[a|b<<c>>]]'
+        self.assertEqual(without_empty_text(old_tokenize(source)), [('tx', '[[a|b'), ('mc', ('c', '')), ('tx', ']]')])
+        self.assertEqual(tokenize(source), [('lk', 'a|b<<c>>')])
+        self.assertEqual(tokenize('<<print "[[a]]">>'), [('mc', ('print', ' "[[a]]"'))])
+
+
+if __name__ == '__main__':
+    unittest.main()
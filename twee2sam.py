@@ -2,365 +2,399 @@
 # -*- coding: utf-8 -*-
 
 from __future__ import print_function
-import argparse, sys, os, glob, re, shutil, os.path
-from operator import itemgetter
+import argparse, sys, os, glob, os.path, multiprocessing, time, socket, json, traceback
+from StringIO import StringIO
 scriptPath = os.path.realpath(os.path.dirname(sys.argv[0]))
 sys.path.append(os.path.join(scriptPath, 'tw'))
 sys.path.append(os.path.join(scriptPath, 'lib'))
-from tiddlywiki import TiddlyWiki
-from twparser import TwParser
 import twexpression
+import twsam
+from twcompiler import compile_story, CompileOptions, CompileSession, CompileError, BuildCache
+from twassets import AssetStager
+from twimage import ImageChecker
+import twcompress
+import twee2samc
 
 __version__ = "0.7.1"
 
 def main (argv):
 
+    parser = make_arg_parser()
+    opts = parser.parse_args(argv[1:])
+
+    if opts.serve:
+        serve(opts)
+        return
+
+    if not opts.sources or not opts.destination:
+        parser.error('the sources and the destination are required')
+    if opts.compress_tiles and not opts.convert_images:
+        parser.error('--compress-tiles needs --convert-images')
+
+    twexpression.cache.enabled = not opts.no_expr_cache
+
+    state = BuildState(opts)
+    try:
+        build(opts, state)
+    except CompileError as e:
+        print('twee2sam: {0}\n'.format(e))
+        if not opts.watch:
+            sys.exit(2)
+
+    if opts.watch:
+        watch(opts, state)
+
+
+def make_arg_parser():
     parser = argparse.ArgumentParser(description="Convert twee source code into SAM source code")
     parser.add_argument("-a", "--author", default="twee")
     parser.add_argument("-m", "--merge", default="")
     parser.add_argument("-p", "--plugins", nargs="*", default=[])
     parser.add_argument("-r", "--rss", default="")
     parser.add_argument("-t", "--target", default="jonah")
-    parser.add_argument("sources")
-    parser.add_argument("destination")
-    opts = parser.parse_args()
-
-    # construct a TW object
-
-    tw = TiddlyWiki()
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="number of passages to generate in parallel")
+    parser.add_argument("-v", "--verbose", action="store_true", help="report compilation statistics")
+    parser.add_argument("-w", "--watch", action="store_true", help="keep running, recompiling whenever the sources change")
+    parser.add_argument("--prune-unreachable", action="store_true", help="leave out the passages that can't be reached from Start")
+    parser.add_argument("--entry-point", action="append", default=[], help="passage to keep as reachable when pruning (repeatable)")
+    parser.add_argument("--display-mode", choices=["auto", "inline"], default="auto", help="share displayed passages as subroutines when it saves space (auto), or always copy them (inline)")
+    parser.add_argument("--passes", type=pass_list, default=twsam.DEFAULT_PASSES, help="comma separated optimization passes to run (default: {0}); empty for none".format(','.join(twsam.DEFAULT_PASSES)))
+    parser.add_argument("--no-fold", action="store_true", help="generate the expressions exactly as written")
+    parser.add_argument("--max-variables", type=int, default=26, help="SAM variables the story may use (at most 26)")
+    parser.add_argument("--no-pack-flags", action="store_true", help="give every boolean variable a SAM variable of its own")
+    parser.add_argument("--menu-dispatch", choices=["indexed", "linear"], default="indexed", help="jump straight to the chosen link (indexed), or compare the choice with each link (linear)")
+    parser.add_argument("--wrap", action="store_true", help="wrap the text and break it into pages at compile time, instead of leaving it to SAM")
+    parser.add_argument("--text-columns", type=int, default=28, help="width of the text window the text is wrapped to")
+    parser.add_argument("--text-rows", type=int, default=18, help="lines of text shown on each page")
+    parser.add_argument("--string-pool", action="store_true", help="share the text repeated across the scripts in scripts of their own")
+    parser.add_argument("--convert-images", action="store_true", help="also convert the images into Master System tiles, tilemaps and palettes (NAME.tiles.bin, NAME.tilemap.bin, NAME.palette.bin)")
+    parser.add_argument("--compress-tiles", choices=twcompress.MODES, help="with --convert-images, write the tiles compressed in the Phantasy Star Gaiden format (NAME.tiles.psgcompr), favoring speed (fast) or size (max)")
+    parser.add_argument("--reduce-colors", action="store_true", help="reduce the images with more than 16 colors to 16 colors of the Master System")
+    parser.add_argument("--dither", action="store_true", help="with --reduce-colors, use ordered dithering")
+    parser.add_argument("--no-image-check", action="store_true", help="don't check the images against SAM's limits")
+    parser.add_argument("--copy-assets", action="store_true", help="always copy the images and music, instead of linking them when possible; a hard link shares its contents with the source, so editing it in place changes the source too")
+    parser.add_argument("--no-build-cache", action="store_true", help="regenerate every script, ignoring the previous build")
+    parser.add_argument("--no-expr-cache", action="store_true", help="disable the expression cache (for debugging)")
+    parser.add_argument("--serve", action="store_true", help="run as a compile server for twee2samc.py")
+    parser.add_argument("--socket", default=twee2samc.socket_path(), help="Unix socket the compile server listens on")
+    parser.add_argument("sources", nargs="?")
+    parser.add_argument("destination", nargs="?")
+    return parser
+
+def pass_list(value):
+    passes = tuple(name for name in value.split(',') if name)
+    for name in passes:
+        if not name in twsam.PASSES:
+            raise argparse.ArgumentTypeError('unknown pass: {0}'.format(name))
+    return passes
+
+
+class BuildState(object):
+    """What is kept in memory from one build to the next"""
+
+    def __init__(self, opts):
+        cache = None if opts.no_build_cache else BuildCache(os.path.join(opts.destination, BuildCache.FILE_NAME))
+        self.session = CompileSession(cache)
+        self.assets = AssetStager(None if opts.no_build_cache else os.path.join(opts.destination, AssetStager.FILE_NAME),
+                                  links=not opts.copy_assets)
+        self.images = ImageChecker(None if opts.no_build_cache else os.path.join(opts.destination, ImageChecker.FILE_NAME))
+        self.written = {}
+
+    def write(self, path, text, binary=False):
+        """Writes an output file if its contents changed; returns True if it did"""
+        if self.written.get(path) == text and os.path.exists(path):
+            return False
+        self.written[path] = text
+        return write_if_changed(path, text, binary)
+
+
+def build(opts, state):
+    """Compiles the sources into the destination directory"""
+
+    # The items are kept from one build to the next; -v shows this build's lookups
+    twexpression.cache.reset_stats()
 
     # read in a file to be merged
 
+    merge_html = None
     if opts.merge:
         with open(opts.merge) as f:
-            tw.addHtml(f.read())
+            merge_html = f.read()
 
     # read source files
 
     sources = glob.glob(opts.sources)
 
     if not sources:
-        print('twee2sam: no source files specified\n')
-        sys.exit(2)
+        raise CompileError('no source files specified')
 
+    texts = []
     for source in sources:
         with open(source) as f:
-            tw.addTwee(f.read().decode('utf-8-sig'))
+            texts.append(f.read().decode('utf-8-sig'))
 
     src_dir = os.path.dirname(sources[0])
 
-    #
-    # Parse the file
-    #
-
-    twp = TwParser(tw)
-
-
-    #
-    # Number the passages
-    #
-
-    passage_indexes = {}
-
-    def process_passage_index(passage):
-        global next_seq
-
-        if not passage.title in passage_indexes:
-            passage_indexes[passage.title] = process_passage_index.next_seq
-            process_passage_index.next_seq += 1
-
-    process_passage_index.next_seq = 0
-
-    # 'Start' _must_ be the first script
-    if not 'Start' in twp.passages:
-        print('twee2sam: "Start" passage not found.\n')
+    def asset_id(path):
+        try:
+            return state.assets.content_hash(os.path.join(src_dir, path))
+        except (IOError, OSError):
+            # Reported when it's copied
+            return path
+
+    try:
+        options = CompileOptions(jobs=opts.jobs, merge_html=merge_html,
+                                 prune_unreachable=opts.prune_unreachable, entry_points=opts.entry_point,
+                                 display_mode=opts.display_mode, passes=opts.passes,
+                                 fold_constants=not opts.no_fold, max_variables=opts.max_variables,
+                                 pack_flags=not opts.no_pack_flags, menu_dispatch=opts.menu_dispatch,
+                                 wrap_text=opts.wrap, text_columns=opts.text_columns, text_rows=opts.text_rows,
+                                 string_pool=opts.string_pool, asset_id=asset_id)
+        result = compile_story(texts, options, state.session)
+    except CompileError as e:
+        print_diagnostics(e.diagnostics)
+        raise
+
+    print_diagnostics(result.diagnostics)
+
+    for file_name, text in result.files():
+        state.write(os.path.join(opts.destination, file_name), text)
+
+    # The reduced images are written instead of being staged, and are the
+    # ones checked and converted
+    image_paths = [os.path.join(src_dir, path) for path in result.images]
+    reduced_images = []
+    if result.images and opts.reduce_colors:
+        asset_names = dict(result.assets)
+        reductions = state.images.reduce(image_paths, state.assets.content_hash, opts.jobs, opts.dither)
+        for i, (path, reduced) in enumerate(zip(result.images, reductions)):
+            if reduced.png is None:
+                # Either it doesn't need it, or the check reports why
+                continue
+            image_paths[i] = os.path.join(opts.destination, asset_names[path])
+            state.write(image_paths[i], reduced.png, binary=True)
+            reduced_images.append((path, reduced))
+    reduced_paths = set(path for path, reduced in reduced_images)
+
+    image_reports = []
+    if result.images and not opts.no_image_check:
+        image_reports = state.images.check(image_paths, state.assets.content_hash, opts.jobs)
+        for path, report in zip(result.images, image_reports):
+            for problem in report.problems:
+                print('Warning on image {0}: {1}'.format(path, problem))
+
+    # Bytes of tiles before and after compressing them
+    tile_sizes = [0, 0]
+    if result.images and opts.convert_images:
+        converted = state.images.convert(image_paths, state.assets.content_hash, opts.jobs)
+        for path, item_name, tile_data in zip(result.images, result.image_list.split('\n'), converted):
+            if tile_data.error:
+                print("Warning on image {0}: it can't be converted, as {1}".format(path, tile_data.error))
+                continue
+            for part in ('tiles', 'tilemap', 'palette'):
+                data, extension = getattr(tile_data, part), 'bin'
+                if part == 'tiles' and opts.compress_tiles:
+                    tile_sizes[0] += len(data)
+                    data, extension = twcompress.compress(data, opts.compress_tiles), 'psgcompr'
+                    tile_sizes[1] += len(data)
+                state.write(os.path.join(opts.destination, '{0}.{1}.{2}'.format(item_name, part, extension)), data, binary=True)
+
+    for file_path, file_name in result.assets:
+        if file_path in reduced_paths:
+            continue
+        destination = os.path.join(opts.destination, file_name)
+        # A reduced image may have been written there by an earlier build
+        state.written.pop(destination, None)
+        state.assets.stage(os.path.join(src_dir, file_path), destination)
+    asset_counts = state.assets.counts
+    state.assets.commit()
+
+    if result.pruned:
+        print('twee2sam: pruned {0} unreachable passage(s), saving {1} bytes of script'.format(len(result.pruned), result.pruned_size))
+        if opts.verbose:
+            for title in result.pruned:
+                print('  ' + title)
+
+    if opts.verbose and result.unreferenced:
+        print('{0} passage(s) that nothing links to, calls or displays; --entry-point marks the ones reached otherwise:'.format(
+            len(result.unreferenced)))
+        for title in result.unreferenced:
+            print('  ' + title)
+
+    if opts.verbose:
+        print(twexpression.cache.stats())
+        print('build cache: {0} of {1} passages reused'.format(result.reused, result.reused + result.regenerated))
+        print('variables: {0} used, {1} of them for link conditions'.format(result.variables, result.temp_variables))
+        if result.menus:
+            print('menus: {0} dispatched in {1} bytes, ~{2:.1f} steps per choice ({3} dispatch: {4} bytes, ~{5:.1f} steps)'.format(
+                result.menus, result.menu_cost[0], result.menu_cost[1] / result.menus,
+                'linear' if opts.menu_dispatch == 'indexed' else 'indexed',
+                result.other_menu_cost[0], result.other_menu_cost[1] / result.menus))
+        if result.page_breaks:
+            print('layout: {0} page break(s) added'.format(result.page_breaks))
+        if result.pooled_strings:
+            print('string pool: {0} phrase(s) shared, saving {1} bytes'.format(result.pooled_strings, result.pool_saving))
+        if result.assets:
+            print('assets: {0}'.format(', '.join('{0} {1}'.format(asset_counts[how], how)
+                                                 for how in ('kept', 'reflinked', 'linked', 'copied') if how in asset_counts)))
+        for path, first in result.merged_assets:
+            print('  {0} is identical to {1}; using that one'.format(path, first))
+        for path, report in zip(result.images, image_reports):
+            print('image {0}: {1}'.format(path, report.summary()))
+        for path, reduced in reduced_images:
+            print('image {0}: reduced from {1} to {2} colors'.format(path, reduced.colors, reduced.reduced_colors))
+        if tile_sizes[0]:
+            print('tile compression ({0}): {1} bytes of tiles compressed to {2} ({3:.0f}%)'.format(
+                opts.compress_tiles, tile_sizes[0], tile_sizes[1], 100.0 * tile_sizes[1] / tile_sizes[0]))
+        if result.flags:
+            print('flags: {0} booleans packed into {1} variable(s), saving {2}'.format(
+                result.flags, result.flag_variables, result.flags - result.flag_variables))
+
+    return result
+
+
+def print_diagnostics(diagnostics):
+    for level, msg in diagnostics:
+        print(msg, file=sys.stderr if level == 'error' else sys.stdout)
+
+
+def watch(opts, state):
+    """Polls the sources, rebuilding whenever one of them changes"""
+    WATCH_INTERVAL = 0.5
+
+    def snapshot():
+        paths = glob.glob(opts.sources) + ([opts.merge] if opts.merge else [])
+        mtimes = {}
+        for path in paths:
+            try:
+                mtimes[path] = os.stat(path).st_mtime
+            except OSError:
+                pass
+        return mtimes
+
+    print('twee2sam: watching {0} for changes; press Ctrl+C to stop'.format(opts.sources))
+    last = snapshot()
+    try:
+        while True:
+            time.sleep(WATCH_INTERVAL)
+            current = snapshot()
+            if current == last:
+                continue
+            last = current
+
+            start = time.time()
+            try:
+                result = build(opts, state)
+            except CompileError as e:
+                print('twee2sam: {0}\n'.format(e))
+                continue
+            print('twee2sam: regenerated {0} passage(s) in {1:.0f} ms'.format(result.regenerated, (time.time() - start) * 1000))
+    except KeyboardInterrupt:
+        pass
+
+
+
+def serve(opts):
+    """Compiles the requests sent by twee2samc.py, keeping the parsed stories
+    and caches of each destination in memory between requests"""
+    if not hasattr(socket, 'AF_UNIX'):
+        print('twee2sam: --serve needs Unix domain sockets')
         sys.exit(2)
 
-    process_passage_index(twp.passages['Start'])
-    for passage in twp.passages.values():
-        process_passage_index(passage)
-
-    #
-    # Generate the file list
-    #
-    passage_order = [psg for psg, idx in sorted(passage_indexes.items(), key=itemgetter(1))]
-
-
-    def name_to_identifier(s):
-        return re.sub(r'[^0-9A-Za-z]', '_', s)
-
-    def script_name(s):
-        return name_to_identifier(s) + '.twsam'
-
-    with open(os.path.join(opts.destination, 'Script.list.txt'), 'w') as f_list:
-        for passage_name in passage_order:
-            passage = twp.passages[passage_name]
-            f_list.write(script_name(passage.title))
-            f_list.write('\n')
-
-
-    #
-    # Generate SAM scripts
-    #
-
-    # A is used as a temp var for menu selection
-    # B is used as a temp var for menu selection
-    # C and above are available
-    variables = VariableFactory(2)
-
-    image_list = []
-    music_list = []
-    for passage in twp.passages.values():
-        with open(os.path.join(opts.destination, script_name(passage.title)), 'w') as script:
-
-            def check_print():
-                if check_print.pending:
-                    script.write('!\n')
-                    check_print.in_buffer = 0
-                    check_print.pending = False
-
-            check_print.pending = False
-            check_print.in_buffer = 0
-
-            def warning(msg):
-                print('Warning on {0}: {1}'.format(passage.title, msg))
-
-            def out_string(msg):
-                MAX_LEN = 512
-                # go through the string and replace characters
-                msg = ''.join(map(lambda x: {'"': "'", '[': '{', ']':'}'}[x] if x in ('"','[','{') else x, msg))
-                msg_len = len(msg)
-
-                # Checks for buffer overflow
-                if check_print.in_buffer + msg_len > MAX_LEN - 1:
-                    warning("The text exceeds the maximum buffer size; try to intersperse the text with some <<pause>> macros")
-                    remaining = max(0, MAX_LEN - 1 -  check_print.in_buffer)
-                    msg = msg[:remaining]
-
-                script.write('"{0}"'.format(msg))
-                script.write('\n')
-
-                check_print.in_buffer += len(msg)
-
-            def out_set(cmd):
-                out_expr(cmd.expr)
-                script.write(' ')
-                target = variables.set_var(cmd.target)
-                script.write(target + '\n')
-
-            def out_if(cmd):
-                out_expr(cmd.expr)
-                script.write('[\n')
-                process_command_list(cmd.children, True)
-                script.write(' 0]\n')
-
-            def out_print(cmd):
-                # print a numeric qvariable
-                out_expr(cmd.expr)
-                script.write('"\#"')
-
-            def out_expr(expr):
-                def var_locator(name):
-                    return variables.get_var(name).replace(':', '')
-                generated = twexpression.to_sam(expr, var_locator = var_locator)
-                script.write(generated)
-
-            def out_call(cmd):
-                call_target = None
-                for k in passage_indexes.keys():
-                    if cmd.target == k:
-                        call_target = passage_indexes[k]
-                if call_target:
-                    script.write(str(call_target))
-                    script.write('c')
-                    script.write('\n')
-
-            # Outputs all the text
-
-            links = []
-
-            def register_link(cmd, is_conditional):
-                temp_var = variables.new_temp_var() if is_conditional else None
-                links.append((cmd, temp_var))
-                if temp_var:
-                    script.write('1' + variables.set_var(temp_var))
-
-            def process_command_list(commands, is_conditional=False):
-                for cmd in commands:
-                    if cmd.kind == 'text':
-                        text = cmd.text.strip()
-                        if text:
-                            out_string(text)
-                            check_print.pending = True
-                    elif cmd.kind == 'print':
-                        out_print(cmd)
-                    elif cmd.kind == 'image':
-                        check_print()
-                        if not cmd.path in image_list:
-                            image_list.append(cmd.path)
-                        script.write('{0}i\n'.format(image_list.index(cmd.path)))
-                    elif cmd.kind == 'link':
-                        register_link(cmd, is_conditional)
-                        out_string(cmd.actual_label())
-                    elif cmd.kind == 'list':
-                        for lcmd in cmd.children:
-                            if lcmd.kind == 'link':
-                                register_link(lcmd, is_conditional)
-                    elif cmd.kind == 'pause':
-                        check_print.pending = True
-                        check_print()
-                    elif cmd.kind == 'set':
-                        out_set(cmd)
-                    elif cmd.kind == 'if':
-                        out_if(cmd)
-                    elif cmd.kind == 'call':
-                        out_call(cmd)
-                    elif cmd.kind == 'return':
-                        script.write('$\n')
-                    elif cmd.kind == 'music':
-                        if not cmd.path in music_list:
-                            music_list.append(cmd.path)
-                        script.write('{0}m\n'.format(music_list.index(cmd.path)))
-                    elif cmd.kind == 'display':
-                        try:
-                            target = twp.passages[cmd.target]
-                        except KeyError:
-                            print("Display macro target passage {0} not found!".format(cmd.target), file=sys.stderr)
-                            return
-                        process_command_list(target.commands)
-
-            process_command_list(passage.commands)
-
-            check_print()
-
-            # Builds the menu from the links
-
-            if links:
-                # Outputs the options separated by line breaks, max 28 chars per line
-                for link, temp_var in links:
-                    if temp_var:
-                        script.write('{0}['.format(variables.get_var(temp_var)))
-
-                    out_string(link.actual_label()[:28] + '\n')
-
-                    if temp_var:
-                        script.write('0]\n')
-
-                script.write('?A.\n')
-                check_print.in_buffer = 0
-
-                # Outputs the menu destinations
-                script.write('0B.\n');
-
-                for link, temp_var in links:
-                    if temp_var:
-                        script.write('{0}['.format(variables.get_var(temp_var)))
-
-                    if not link.target in passage_indexes:
-                        # TODO: Create a better exception
-                        raise BaseException('Link points to a nonexisting passage: "{0}"'.format(link.target))
-
-                    script.write('A:B:=[{0}j]'.format(passage_indexes[link.target]))
-                    script.write('B:1+B.\n')
-
-                    if temp_var:
-                        script.write('0]\n')
-
-            else:
-                # No links? Generates an infinite loop.
-                script.write('1[1]\n')
-
-
-
-    #
-    # Function to copy the files on a list and generate a list file
-    #
-    def copy_and_build_list(list_file_name, file_list, item_extension, item_suffix = '', empty_item = 'blank'):
-        with open(os.path.join(opts.destination, list_file_name), 'w') as list_file:
-            for file_path in file_list:
-                item_name = name_to_identifier(os.path.splitext(os.path.basename(file_path))[0])
-                list_file.write(item_name + item_suffix + '\n')
-                shutil.copyfile(os.path.join(src_dir, file_path), os.path.join(opts.destination, '%s.%s' % (item_name, item_extension)))
-
-            if not file_list:
-                list_file.write(empty_item + item_suffix + '\n')
-
-
-
-    #
-    # Copy images and builds the image list
-    #
-    copy_and_build_list('Images.txt', image_list, 'png')
-
-
-
-    #
-    # Copy music and builds the music list
-    #
-    copy_and_build_list('Music.list.txt', music_list, 'epsgmod', '.epsgmod', 'empty')
-
-
-
-class VariableFactory(object):
-
-    def __init__(self, first_available):
-        self.next_available = first_available
-
-        self.vars = {}
-        self.never_used = []
-        self.never_set = []
-
-        self.next_temp = 0;
-        self.temps = []
-
-    def set_var(self, name):
-        name = self._normalize_name(name)
-
-        if not name in self.vars:
-            self._create_var(name)
-            self.never_used.append(name)
-
-        if name in self.never_set:
-            self.never_set.remove(name)
-
-        return '{0}.'.format(self.vars[name])
-
-    def get_var(self, name):
-        name = self._normalize_name(name)
-
-        if not name in self.vars:
-            self._create_var(name)
-            self.never_set.append(name)
-
-        if name in self.never_used:
-            self.never_used.remove(name)
-
-        return '{0}:'.format(self.vars[name])
-
-    def new_temp_var(self):
-        if self.next_temp >= len(self.temps):
-            self.temps.append('*temp{0}'.format(self.next_temp))
-
-        temp = self.temps[self.next_temp]
-        self.next_temp += 1
-
-        return temp
-
-    def clear_temp_vars(self):
-        self.next_temp = 0
-
-    def _create_var(self, name):
-        self.vars[name] = self._num_to_ref(self.next_available)
-        self.next_available += 1
-
-    def _num_to_ref(self, num):
-        return chr(ord('A') + num)
-
-    def _normalize_name(self, name):
-        return name.replace('$', '').strip()
-
+    if os.path.exists(opts.socket):
+        os.remove(opts.socket)
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # Only the current user may send requests
+    umask = os.umask(0o177)
+    try:
+        server.bind(opts.socket)
+    finally:
+        os.umask(umask)
+    server.listen(5)
+
+    print('twee2sam: serving on {0}; press Ctrl+C to stop'.format(opts.socket))
+    states = {}
+    try:
+        while True:
+            conn, _ = server.accept()
+            try:
+                request = json.loads(conn.makefile('rb').readline())
+                reply = handle_request(request, states)
+                conn.sendall(json.dumps(reply) + '\n')
+            except (socket.error, ValueError) as e:
+                print('twee2sam: bad request: {0}'.format(e))
+            finally:
+                conn.close()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        os.remove(opts.socket)
+
+def handle_request(request, states):
+    """Runs a single build for a client; returns its exit status and output"""
+    output = StringIO()
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout = sys.stderr = output
+    status = 0
+    try:
+        opts = make_arg_parser().parse_args(request['argv'])
+        if opts.serve or opts.watch:
+            raise CompileError('--serve and --watch are not available through the compile server')
+        if not opts.sources or not opts.destination:
+            raise CompileError('the sources and the destination are required')
+        if opts.compress_tiles and not opts.convert_images:
+            raise CompileError('--compress-tiles needs --convert-images')
+
+        # Paths are relative to the client's working directory
+        cwd = request['cwd']
+        opts.sources = os.path.join(cwd, opts.sources)
+        opts.destination = os.path.abspath(os.path.join(cwd, opts.destination))
+        if opts.merge:
+            opts.merge = os.path.join(cwd, opts.merge)
+
+        twexpression.cache.enabled = not opts.no_expr_cache
+
+        state = states.get(opts.destination)
+        if not state or opts.no_build_cache:
+            state = states[opts.destination] = BuildState(opts)
+
+        start = time.time()
+        build(opts, state)
+        if opts.verbose:
+            print('compile server: built in {0:.0f} ms'.format((time.time() - start) * 1000))
+    except CompileError as e:
+        print('twee2sam: {0}\n'.format(e))
+        status = 2
+    except SystemExit as e:
+        # Raised by argparse on invalid arguments
+        status = e.code
+    except Exception:
+        traceback.print_exc()
+        status = 1
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+
+    return {'status': status, 'output': output.getvalue()}
+
+
+
+def write_if_changed(path, text, binary=False):
+    """Writes the file, unless it already has exactly this content; this keeps
+    the modification times of the unchanged files"""
+    if os.path.exists(path):
+        with open(path, 'rb' if binary else 'r') as f:
+            if f.read() == text:
+                return False
+        # It may be a link to a source file
+        os.remove(path)
+    with open(path, 'wb' if binary else 'w') as f:
+        f.write(text)
+    return True
 
 
 
 if __name__ == '__main__':
+    multiprocessing.freeze_support()
     main(sys.argv)
@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Thin client for a running "twee2sam.py --serve" daemon.
+
+Takes the same arguments as twee2sam.py; the compilation itself is done by
+the daemon, which keeps its parsers and caches warm between builds. The
+socket can be chosen with the TWEE2SAM_SOCKET environment variable."""
+
+import sys, os, socket, json, tempfile
+
+def socket_path():
+    default = 'twee2sam-{0}.sock'.format(os.getuid() if hasattr(os, 'getuid') else 0)
+    return os.environ.get('TWEE2SAM_SOCKET', os.path.join(tempfile.gettempdir(), default))
+
+def main (argv):
+    path = socket_path()
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(path)
+    except socket.error:
+        sys.stderr.write('twee2samc: no server listening on {0}; start one with "twee2sam.py --serve"\n'.format(path))
+        sys.exit(2)
+
+    client.sendall(json.dumps({'argv': argv[1:], 'cwd': os.getcwd()}) + '\n')
+    reply = json.loads(client.makefile('rb').readline())
+    client.close()
+
+    sys.stdout.write(reply['output'].encode('utf-8'))
+    sys.exit(reply['status'])
+
+
+if __name__ == '__main__':
+    main(sys.argv)